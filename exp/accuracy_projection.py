@@ -0,0 +1,84 @@
+"""Accuracy of 2D images obtained by projecting the 3D volume, compared to the 2D render with image2D.
+
+Galaxy.get_projected_images() sums the rendered 3D images along the line of sight instead of rendering the 2D images.
+This script renders synthetic disc galaxies in both ways and reports the deviations of the mass image and of a mass weighted field.
+
+Example
+-------
+$ python exp/accuracy_projection.py --n-particles 200000 --res 64 --plot-factor 5
+"""
+import argparse
+import time
+
+import numpy as np
+
+from megs.data.image import image2D, image3D
+
+
+def synthetic_galaxy(n, seed=0):
+    """Exponential disc with a bulge and an extended stellar halo, in units of the half mass radius."""
+    rng = np.random.default_rng(seed)
+    n_disc, n_bulge = int(0.7 * n), int(0.2 * n)
+    n_halo = n - n_disc - n_bulge
+    r = rng.gamma(2, 0.6, n_disc)
+    phi = rng.uniform(0, 2 * np.pi, n_disc)
+    disc = np.column_stack(
+        [r * np.cos(phi), r * np.sin(phi), rng.laplace(0, 0.1, n_disc)]
+    )
+    bulge = rng.normal(0, 0.3, (n_bulge, 3))
+    direction = rng.normal(size=(n_halo, 3))
+    direction /= np.linalg.norm(direction, axis=1)[:, None]
+    halo = direction * rng.pareto(2, n_halo)[:, None]
+    coordinates = np.concatenate([disc, bulge, halo])
+    masses = rng.uniform(0.5, 1.5, n)
+    # Metallicity gradient with scatter
+    metallicity = np.exp(-np.linalg.norm(coordinates, axis=1)) * rng.lognormal(0, 0.2, n)
+    # Smoothing lengths grow with the distance to the centre like for a nearest neighbour estimate
+    hsml = 0.05 * (1 + np.linalg.norm(coordinates, axis=1)) * rng.lognormal(0, 0.3, n)
+    return coordinates, masses, metallicity, hsml
+
+
+def weighted(weights_img, mass_img):
+    image = weights_img.copy()
+    mask = mass_img != 0
+    image[mask] = weights_img[mask] / mass_img[mask]
+    return image
+
+
+def report(name, projected, rendered):
+    significant = rendered > 1e-3 * rendered.max()
+    relative = np.abs(projected[significant] - rendered[significant]) / rendered[significant]
+    print(
+        f"{name:<26} total ratio {projected.sum() / rendered.sum():.4f}  "
+        f"median rel. error {np.median(relative):.2e}  95% {np.quantile(relative, 0.95):.2e}  max {relative.max():.2e}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare projected 3D images with 2D renders.")
+    parser.add_argument("--n-particles", type=int, default=200000, dest="n_particles")
+    parser.add_argument("--res", type=int, default=64)
+    parser.add_argument("--plot-factor", type=float, default=5, dest="plot_factor")
+    parser.add_argument("--n-galaxies", type=int, default=3, dest="n_galaxies")
+    args = parser.parse_args()
+
+    for seed in range(args.n_galaxies):
+        coordinates, masses, metallicity, hsml = synthetic_galaxy(args.n_particles, seed)
+        weights = np.column_stack([masses, masses * metallicity])
+        kwargs = dict(R_half=1.0, smoothing_length=hsml, plot_factor=args.plot_factor, res=args.res)
+
+        start = time.perf_counter()
+        rendered = image2D(coordinates, weights=weights, **kwargs)
+        time_2D = time.perf_counter() - start
+        start = time.perf_counter()
+        volume = image3D(coordinates, weights=weights, **kwargs)
+        time_3D = time.perf_counter() - start
+        projected = volume.sum(axis=-1) / args.res
+
+        print(f"Galaxy {seed}: 2D render {time_2D:.2f} s, 3D render {time_3D:.2f} s")
+        report("Masses", projected[0], rendered[0])
+        report("Metallicity (mass weighted)", weighted(projected[1], projected[0]), weighted(rendered[1], rendered[0]))
+
+
+if __name__ == "__main__":
+    main()
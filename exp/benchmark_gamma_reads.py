@@ -0,0 +1,97 @@
+"""Benchmark of reading random single galaxies with Gamma.
+
+A file with synthetic galaxy images is read one galaxy at a time in random order, once opening the file for every read (the
+behaviour of Gamma before it kept a persistent handle) and once with the persistent handle of Gamma, with and without a chunk cache.
+Gamma keeps the datasets open with the file, so the chunk cache holds the galaxies that were read before. The latency per galaxy and
+the throughput are reported.
+
+Example
+-------
+$ python exp/benchmark_gamma_reads.py --n-galaxies 2000 --res 64 --dim 2 --n-reads 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from megs.data.generate import _create_data_structure
+from megs.data.load import Gamma
+from benchmark_layout import FIELDS, synthetic_images
+
+
+def reopen_read(file_path, dim, index):
+    """Read all fields of a galaxy, opening the file like Gamma did before it kept the file open."""
+    with h5py.File(file_path, "r") as f:
+        return [f[f"Galaxies/Particles/stars/Images/dim{dim}/{field}"][index] for field in FIELDS]
+
+
+def run(read, indices, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for index in indices:
+            start = time.perf_counter()
+            read(index)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare single galaxy reads with and without a persistent file handle.")
+    parser.add_argument("--n-galaxies", type=int, default=2000, dest="n_galaxies")
+    parser.add_argument("--res", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=2)
+    parser.add_argument("--n-reads", type=int, default=2000, dest="n_reads")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--cache-mb", type=float, default=64, dest="cache_mb", help="Chunk cache of the cached run in MB.")
+    args = parser.parse_args()
+
+    images = synthetic_images(args.n_galaxies, args.res, args.dim)
+    indices = np.random.default_rng(1).integers(0, args.n_galaxies, size=args.n_reads)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = "benchmark.hdf5"
+        file_path = os.path.join(directory, filename)
+        _create_data_structure(
+            n_galaxies=args.n_galaxies,
+            image_res=args.res,
+            galaxy_parameters=["halo_id"],
+            particle_types=["stars"],
+            fields=FIELDS,
+            path=directory,
+            dim=args.dim,
+            filename=filename,
+        )
+        with h5py.File(file_path, "a") as f:
+            for field in FIELDS:
+                f[f"Galaxies/Particles/stars/Images/dim{args.dim}/{field}"][:] = images
+
+        cache_bytes = int(args.cache_mb * 1024**2)
+        with Gamma(file_path, show_structure=False) as persistent, Gamma(
+            file_path, show_structure=False, rdcc_nbytes=cache_bytes
+        ) as cached:
+            runs = {
+                "reopen per read": lambda index: reopen_read(file_path, args.dim, index),
+                "persistent handle": lambda index: [
+                    persistent.get_image("stars", field, index, dim=args.dim) for field in FIELDS
+                ],
+                f"persistent + {args.cache_mb:g} MB cache": lambda index: [
+                    cached.get_image("stars", field, index, dim=args.dim) for field in FIELDS
+                ],
+            }
+            # Warm up the page cache, so all runs read from memory
+            run(runs["reopen per read"], indices, 1)
+            galaxy_bytes = len(FIELDS) * images[0].nbytes
+            print(f"{args.n_reads} random reads of {len(FIELDS)} fields, {args.dim}D, res {args.res}, {args.repeats} repeats")
+            print(f"{'method':<30} {'median [ms]':>12} {'p99 [ms]':>9} {'galaxies/s':>11} {'MB/s':>8}")
+            for name, read in runs.items():
+                latencies = run(read, indices, args.repeats)
+                print(
+                    f"{name:<30} {np.median(latencies) * 1e3:>12.3f} {np.percentile(latencies, 99) * 1e3:>9.3f} "
+                    f"{len(latencies) / latencies.sum():>11.0f} {galaxy_bytes * len(latencies) / latencies.sum() / 1024**2:>8.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
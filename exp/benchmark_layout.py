@@ -0,0 +1,117 @@
+"""Benchmark of the storage layouts of the image datasets created by _create_data_structure().
+
+For every layout a file with synthetic galaxy images is written in slabs, like the generation does, and the write throughput,
+the latency of reading a single random galaxy and the size of the file on disk are reported.
+
+Example
+-------
+$ python exp/benchmark_layout.py --n-galaxies 500 --res 64 --dim 3
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from megs.data.generate import _create_data_structure
+
+LAYOUTS = {
+    "contiguous": dict(chunks="contiguous"),
+    "auto": dict(chunks="auto"),
+    "galaxy": dict(chunks="galaxy"),
+    "galaxy+lzf": dict(chunks="galaxy", compression="lzf"),
+    "galaxy+shuffle+lzf": dict(chunks="galaxy", compression="lzf", shuffle=True),
+    "galaxy+gzip1": dict(chunks="galaxy", compression="gzip", compression_opts=1),
+    "galaxy+shuffle+gzip4": dict(
+        chunks="galaxy", compression="gzip", compression_opts=4, shuffle=True
+    ),
+}
+
+FIELDS = ["Masses", "GFM_Metallicity", "GFM_StellarFormationTime"]
+
+
+def synthetic_images(n, res, dim, seed=0):
+    """Creates images of exponential discs with noise, which compress similar to rendered galaxies."""
+    rng = np.random.default_rng(seed)
+    axes = np.meshgrid(*[np.linspace(-1, 1, res)] * dim, indexing="ij")
+    images = np.empty((n,) + (res,) * dim, dtype=np.float32)
+    for i in range(n):
+        scale = rng.uniform(0.05, 0.3, size=dim)
+        r = np.sqrt(sum((a / s) ** 2 for a, s in zip(axes, scale)))
+        image = np.exp(-r) * (1 + 0.1 * rng.standard_normal(r.shape))
+        # Rendered images are exactly zero where no particle contributes
+        image[r > 6] = 0
+        images[i] = image
+    return images
+
+
+def benchmark(layout, images, dim, batch_size, n_reads, directory):
+    n, res = images.shape[0], images.shape[1]
+    filename = "benchmark.hdf5"
+    file_path = os.path.join(directory, filename)
+    _create_data_structure(
+        n_galaxies=n,
+        image_res=res,
+        galaxy_parameters=["halo_id"],
+        particle_types=["stars"],
+        fields=FIELDS,
+        path=directory,
+        dim=dim,
+        filename=filename,
+        **layout,
+    )
+
+    start = time.perf_counter()
+    with h5py.File(file_path, "a") as f:
+        group = f[f"Galaxies/Particles/stars/Images/dim{dim}"]
+        for i in range(0, n, batch_size):
+            for field in FIELDS:
+                group[field][i : i + batch_size] = images[i : i + batch_size]
+    write_time = time.perf_counter() - start
+    write_throughput = len(FIELDS) * images.nbytes / write_time / 1024**2
+
+    rng = np.random.default_rng(1)
+    latencies = []
+    with h5py.File(file_path, "r", rdcc_nbytes=0) as f:
+        group = f[f"Galaxies/Particles/stars/Images/dim{dim}"]
+        for index in rng.integers(0, n, size=n_reads):
+            start = time.perf_counter()
+            for field in FIELDS:
+                group[field][index]
+            latencies.append(time.perf_counter() - start)
+
+    size = os.path.getsize(file_path)
+    os.remove(file_path)
+    return write_throughput, np.median(latencies) * 1e3, size / 1024**2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the HDF5 storage layouts.")
+    parser.add_argument("--n-galaxies", type=int, default=500, dest="n_galaxies")
+    parser.add_argument("--res", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=2, choices=[2, 3])
+    parser.add_argument("--batch-size", type=int, default=16, dest="batch_size")
+    parser.add_argument("--n-reads", type=int, default=200, dest="n_reads")
+    parser.add_argument(
+        "--dir", type=str, default=None, help="Directory for the benchmark files."
+    )
+    args = parser.parse_args()
+
+    images = synthetic_images(args.n_galaxies, args.res, args.dim)
+    print(
+        f"{args.n_galaxies} galaxies, {len(FIELDS)} fields, dim{args.dim}, res {args.res}, "
+        f"{len(FIELDS) * images.nbytes / 1024**2:.1f} MB of float32 images"
+    )
+    print(f"{'layout':<22} {'write [MB/s]':>12} {'read [ms]':>10} {'size [MB]':>10}")
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for name, layout in LAYOUTS.items():
+            throughput, latency, size = benchmark(
+                layout, images, args.dim, args.batch_size, args.n_reads, directory
+            )
+            print(f"{name:<22} {throughput:>12.1f} {latency:>10.3f} {size:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Benchmark of the masked reads of Gamma.
+
+Gamma applies its mass mask with _masked_read, which coalesces the selected rows into contiguous runs and reads them either run by
+run or in blocks that are masked in memory (see _plan_masked_read). This script compares both strategies and the choice of the
+planner with the boolean indexing of h5py for random and clustered masks of different densities, and checks that all reads agree.
+
+Example
+-------
+$ python exp/benchmark_masked_reads.py --n-galaxies 20000 --res 32 --dim 2
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from megs.data.generate import _create_data_structure
+from megs.data.load import _masked_read, _plan_masked_read
+from benchmark_layout import synthetic_images
+
+
+def masks(n, densities, seed=0):
+    """Random masks and clustered masks (runs of about 50 galaxies, like a mass cut of a catalog sorted by halo) of every density."""
+    rng = np.random.default_rng(seed)
+    for density in densities:
+        yield "random", density, rng.random(n) < density
+        # Runs with exponential lengths, every run is selected with the probability density
+        lengths = rng.exponential(50, size=n).astype(int) + 1
+        yield "clustered", density, np.repeat(rng.random(n) < density, lengths)[:n]
+
+
+def timed_read(read, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = read()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the strategies of masked reads.")
+    parser.add_argument("--n-galaxies", type=int, default=20000, dest="n_galaxies")
+    parser.add_argument("--res", type=int, default=32)
+    parser.add_argument("--dim", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--densities", type=float, nargs="+", default=[0.001, 0.01, 0.1, 0.5, 0.9])
+    parser.add_argument("--skip-h5py", action="store_true", dest="skip_h5py", help="Skip the slow boolean indexing of h5py.")
+    args = parser.parse_args()
+
+    images = synthetic_images(args.n_galaxies, args.res, args.dim)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = "benchmark.hdf5"
+        _create_data_structure(
+            n_galaxies=args.n_galaxies,
+            image_res=args.res,
+            galaxy_parameters=["halo_id"],
+            particle_types=["stars"],
+            fields=["Masses"],
+            path=directory,
+            dim=args.dim,
+            filename=filename,
+        )
+        with h5py.File(os.path.join(directory, filename), "a") as f:
+            f[f"Galaxies/Particles/stars/Images/dim{args.dim}/Masses"][:] = images
+
+        with h5py.File(os.path.join(directory, filename), "r") as f:
+            dataset = f[f"Galaxies/Particles/stars/Images/dim{args.dim}/Masses"]
+            row_bytes = images[0].nbytes
+            print(f"{args.n_galaxies} galaxies, {args.dim}D, res {args.res}, times in s")
+            print(f"{'mask':<10} {'density':>8} {'runs':>6} {'h5py':>8} {'runs':>8} {'block':>8} {'planner':>8} {'plan':>6}")
+            for kind, density, mask in masks(args.n_galaxies, args.densities):
+                reference = images[mask]
+                strategy, starts, _ = _plan_masked_read(mask, row_bytes)
+                columns = []
+                if args.skip_h5py:
+                    columns.append(float("nan"))
+                else:
+                    result, seconds = timed_read(lambda: dataset[mask], args.repeats)
+                    assert np.array_equal(result, reference)
+                    columns.append(seconds)
+                for forced in ["runs", "block", None]:
+                    result, seconds = timed_read(lambda: _masked_read(dataset, mask, strategy=forced), args.repeats)
+                    assert np.array_equal(result, reference), f"{kind} {density} {forced}"
+                    columns.append(seconds)
+                print(
+                    f"{kind:<10} {mask.mean():>8.3f} {len(starts):>6} "
+                    + " ".join(f"{seconds:>8.4f}" for seconds in columns)
+                    + f" {strategy:>6}"
+                )
+
+
+if __name__ == "__main__":
+    main()
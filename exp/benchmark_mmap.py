@@ -0,0 +1,97 @@
+"""Benchmark of the memory of several processes reading the same catalog with and without Gamma.get_image(..., mmap=True).
+
+Every worker process loads all images of a contiguous catalog, keeps them (like a training loop that holds the catalog in memory)
+and touches every image. With normal reads every worker holds a private copy of the catalog. With mmap=True the images are views of
+a memory map of the file, whose pages are shared by all workers through the page cache. The private and shared memory of the workers
+is read from /proc/self/smaps_rollup, so the script only runs on Linux.
+
+Example
+-------
+$ python exp/benchmark_mmap.py --n-galaxies 5000 --res 64 --workers 10
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from megs.data.generate import _create_data_structure
+from megs.data.load import Gamma
+from benchmark_layout import synthetic_images
+
+
+def memory():
+    """Private and shared resident memory of this process in MB."""
+    values = dict()
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0].rstrip(":") in ("Private_Clean", "Private_Dirty", "Shared_Clean", "Shared_Dirty"):
+                values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    return values["Private_Clean"] + values["Private_Dirty"], values["Shared_Clean"] + values["Shared_Dirty"]
+
+
+def worker(args):
+    path, dim, mmap, barrier = args
+    data = Gamma(path, show_structure=False)
+    private_before, _ = memory()
+    start = time.perf_counter()
+    images = data.get_image("stars", "Masses", dim=dim, mmap=mmap)
+    # Touch every image, e.g. one epoch of training
+    total = sum(float(image.sum()) for image in images)
+    elapsed = time.perf_counter() - start
+    private, shared = memory()
+    # Keep the images until all workers are measured
+    barrier.wait()
+    return private - private_before, shared, elapsed, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the memory of workers reading a catalog with and without mmap.")
+    parser.add_argument("--n-galaxies", type=int, default=5000, dest="n_galaxies")
+    parser.add_argument("--res", type=int, default=64)
+    parser.add_argument("--dim", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=10)
+    args = parser.parse_args()
+
+    images = synthetic_images(args.n_galaxies, args.res, args.dim)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = "benchmark.hdf5"
+        path = os.path.join(directory, filename)
+        _create_data_structure(
+            n_galaxies=args.n_galaxies,
+            image_res=args.res,
+            galaxy_parameters=["halo_id"],
+            particle_types=["stars"],
+            fields=["Masses"],
+            path=directory,
+            dim=args.dim,
+            filename=filename,
+            chunks="contiguous",
+        )
+        with h5py.File(path, "a") as f:
+            f[f"Galaxies/Particles/stars/Images/dim{args.dim}/Masses"][:] = images
+
+        print(f"Catalog of {images.nbytes / 1024**2:.1f} MB, {args.workers} workers")
+        print(f"{'method':<8} {'private/worker [MB]':>20} {'shared/worker [MB]':>19} {'total private [MB]':>19} {'time [s]':>9}")
+        context = multiprocessing.get_context("fork")
+        for mmap in [False, True]:
+            with context.Manager() as manager:
+                barrier = manager.Barrier(args.workers)
+                with context.Pool(args.workers) as pool:
+                    results = pool.map(worker, [(path, args.dim, mmap, barrier)] * args.workers)
+            private = np.array([result[0] for result in results])
+            shared = np.array([result[1] for result in results])
+            elapsed = np.array([result[2] for result in results])
+            assert np.allclose([result[3] for result in results], float(images.sum(dtype=np.float64)), rtol=1e-4)
+            print(
+                f"{'mmap' if mmap else 'read':<8} {private.mean():>20.1f} {shared.mean():>19.1f} {private.sum():>19.1f} "
+                f"{np.median(elapsed):>9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark of the serial and the parallel scatter backends of image2D and image3D.
+
+The parallel scatter splits the particles over the numba threads and sums one image per thread. It only pays off above a
+certain number of particles, since every thread allocates and sums a full image. This script times both backends for
+an increasing number of particles and reports the crossover point, which can be used as parallel_threshold of the
+"auto" backend (GalaxyArgs in the config file). Set NUMBA_NUM_THREADS to the number of cores available per worker.
+
+Example
+-------
+$ NUMBA_NUM_THREADS=8 python exp/benchmark_render_backend.py --res 64 --channels 3
+"""
+import argparse
+import time
+
+import numba
+import numpy as np
+
+from megs.data.image import image2D, image3D
+from accuracy_projection import synthetic_galaxy
+
+
+def best_time(render, repeats):
+    render()  # compile and warm up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        render()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the serial and the parallel SPH scatter.")
+    parser.add_argument("--res", type=int, default=64)
+    parser.add_argument("--plot-factor", type=float, default=10, dest="plot_factor")
+    parser.add_argument("--channels", type=int, default=3, help="Number of weight channels rendered in one pass.")
+    parser.add_argument("--max-particles", type=float, default=1e7, dest="max_particles")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--dims", type=int, nargs="+", default=[2, 3])
+    args = parser.parse_args()
+
+    print(f"numba threads: {numba.get_num_threads()}")
+    n_values = [int(n) for n in np.logspace(3, np.log10(args.max_particles), int(np.log10(args.max_particles)) * 2 - 5)]
+    for dim in args.dims:
+        render = image2D if dim == 2 else image3D
+        crossover = None
+        print(f"\n{dim}D, res {args.res}, {args.channels} channels")
+        print(f"{'particles':>10} {'serial [s]':>11} {'parallel [s]':>13} {'speedup':>8} {'max rel. diff':>14}")
+        for n in n_values:
+            coordinates, masses, _, hsml = synthetic_galaxy(n)
+            weights = np.column_stack([masses] * args.channels) if args.channels > 1 else masses
+            images = dict()
+
+            def run(backend):
+                images[backend] = render(
+                    coordinates, 1.0, weights, hsml, plot_factor=args.plot_factor, res=args.res, backend=backend
+                )
+
+            serial = best_time(lambda: run("serial"), args.repeats)
+            parallel = best_time(lambda: run("parallel"), args.repeats)
+            scale = np.abs(images["serial"]).max()
+            difference = np.abs(images["parallel"] - images["serial"]).max() / scale if scale > 0 else 0.0
+            # First particle number from which on the parallel backend stays faster
+            if parallel >= serial:
+                crossover = None
+            elif crossover is None:
+                crossover = n
+            print(f"{n:>10d} {serial:>11.4f} {parallel:>13.4f} {serial / parallel:>8.2f} {difference:>14.2e}")
+        if crossover is None:
+            print("The parallel backend was not faster for any particle number.")
+        else:
+            print(f"The parallel backend is faster from about {crossover} particles on.")
+
+
+if __name__ == "__main__":
+    main()
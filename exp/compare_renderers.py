@@ -0,0 +1,68 @@
+"""Common harness for the registered image renderers.
+
+Every renderer of megs.data.renderers is called with the same synthetic galaxy and the same arguments. The script checks the
+shared signature (image shape for single and multi-channel weights, the mass inside the image) and reports the render time and
+the deviation from the exact SPH scatter, so cheap renderers can be judged for quick-look catalogs.
+
+Example
+-------
+$ python exp/compare_renderers.py --n-particles 200000 --res 64 --plot-factor 5
+"""
+import argparse
+import time
+
+import numpy as np
+
+from megs.data.renderers import RENDERERS, get_renderer
+from accuracy_projection import synthetic_galaxy, weighted
+
+
+def check(name, dim, images, weights, res, coordinates, plot_range):
+    """Check the shape and the mass conservation of the multi-channel images."""
+    expected = (weights.shape[1],) + (res,) * dim
+    assert images.shape == expected, f"{name} {dim}D: shape {images.shape} != {expected}"
+    # The deposits only count particles inside the image, the SPH kernels also spread mass over the edges
+    inside = np.all(np.abs(coordinates[:, :dim]) < plot_range, axis=1)
+    return images[0].sum() / res**dim / weights[inside, 0].sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the registered image renderers.")
+    parser.add_argument("--n-particles", type=int, default=200000, dest="n_particles")
+    parser.add_argument("--res", type=int, default=64)
+    parser.add_argument("--plot-factor", type=float, default=5, dest="plot_factor")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--dims", type=int, nargs="+", default=[2, 3])
+    args = parser.parse_args()
+
+    coordinates, masses, metallicity, hsml = synthetic_galaxy(args.n_particles)
+    weights = np.column_stack([masses, metallicity * masses])
+    for dim in args.dims:
+        print(f"\n{dim}D, {args.n_particles} particles, res {args.res}")
+        print(f"{'renderer':<14} {'time [s]':>9} {'mass ratio':>11} {'mass rel. error':>16} {'metallicity rel. error':>23}")
+        reference = None
+        for name in ["sph"] + sorted(key for key in RENDERERS if key != "sph" and dim in RENDERERS[key]):
+            render = get_renderer(name, dim)
+            # Single channel weights must give the first channel of the multi-channel render
+            single = render(coordinates, 1.0, masses, hsml, plot_factor=args.plot_factor, res=args.res)
+            render(coordinates, 1.0, weights, hsml, plot_factor=args.plot_factor, res=args.res)  # compile
+            times = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                images = render(coordinates, 1.0, weights, hsml, plot_factor=args.plot_factor, res=args.res)
+                times.append(time.perf_counter() - start)
+            assert np.allclose(single, images[0], rtol=1e-5, atol=1e-6 * images[0].max()), f"{name}: channels differ"
+            mass_ratio = check(name, dim, images, weights, args.res, coordinates, args.plot_factor)
+            metallicity_img = weighted(images[1], images[0])
+            if reference is None:
+                reference = images[0], metallicity_img
+            significant = reference[0] > 1e-2 * reference[0].max()
+            mass_error = np.median(np.abs(images[0] - reference[0])[significant] / reference[0][significant])
+            metallicity_error = np.median(
+                np.abs(metallicity_img - reference[1])[significant] / reference[1][significant]
+            )
+            print(f"{name:<14} {min(times):>9.4f} {mass_ratio:>11.4f} {mass_error:>16.2e} {metallicity_error:>23.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Validation of the horizontal alignment methods of the Galaxy class.
+
+The "image" method renders a temporary mass image and uses horizontal_rotation, which fits a PCA to the brightest pixels.
+Galaxy(alignment="moments") uses moment_horizontal_rotation, which calculates the angle from the second moments of the particles.
+This script builds a reference sample of face-on synthetic discs with random axis ratios and known position angles, runs both
+methods and reports the angles, the residual misalignment of the major axis with the x-axis and the time per galaxy.
+
+Note: horizontal_rotation clips the image to its 90% quantile before selecting the pixels above the 75% quantile, which selects all
+pixels of the image. The PCA of the full pixel grid is isotropic and the "image" angle is 0 for every galaxy, i.e. the "image"
+method keeps the orientation of the face-on rotation. Galaxy(alignment="image") therefore skips the render and uses the identity.
+The "moments" method aligns the major axis with the x-axis.
+
+Example
+-------
+$ python exp/validate_alignment.py --n-galaxies 50 --n-particles 50000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from megs.data.image import (
+    calc_rotation_matrix,
+    clip_image,
+    get_horizontal_angle,
+    get_moment_angle,
+    image2D,
+)
+from accuracy_projection import synthetic_galaxy
+
+
+def position_angle_residual(angle):
+    """Misalignment of an axis with the x-axis in degrees, in [0, 90]."""
+    residual = np.degrees(angle) % 180
+    return min(residual, 180 - residual)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the horizontal alignment methods.")
+    parser.add_argument("--n-galaxies", type=int, default=50, dest="n_galaxies")
+    parser.add_argument("--n-particles", type=int, default=50000, dest="n_particles")
+    parser.add_argument("--res", type=int, default=64)
+    parser.add_argument("--plot-factor", type=float, default=10, dest="plot_factor")
+    parser.add_argument("--radius", type=float, default=2, help="Radius of the moment tensor in half mass radii.")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    rows = []
+    for i in range(args.n_galaxies):
+        coordinates, masses, _, hsml = synthetic_galaxy(args.n_particles, seed=i)
+        axis_ratio = rng.uniform(0.3, 1.0)
+        position_angle = rng.uniform(-np.pi / 2, np.pi / 2)
+        coordinates[:, 1] *= axis_ratio
+        coordinates = np.dot(calc_rotation_matrix(position_angle), coordinates.T).T
+
+        start = time.perf_counter()
+        img = image2D(coordinates, 1.0, masses, hsml, plot_factor=args.plot_factor, res=args.res)
+        image_angle = get_horizontal_angle(clip_image(img, lower=0.9, upper=1.0))
+        image_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        moment_angle = get_moment_angle(coordinates, masses, 1.0, radius=args.radius)
+        moment_time = time.perf_counter() - start
+
+        # Both methods rotate by the negative of their angle
+        rows.append(
+            (
+                axis_ratio,
+                np.degrees(position_angle),
+                np.degrees(image_angle),
+                np.degrees(moment_angle),
+                position_angle_residual(position_angle - image_angle),
+                position_angle_residual(position_angle - moment_angle),
+                image_time,
+                moment_time,
+            )
+        )
+
+    rows = np.array(rows)
+    print(f"{'q':>5} {'true PA':>8} {'image PA':>9} {'moment PA':>10} {'image res.':>11} {'moment res.':>12}")
+    for row in rows:
+        print(f"{row[0]:>5.2f} {row[1]:>8.1f} {row[2]:>9.1f} {row[3]:>10.1f} {row[4]:>11.1f} {row[5]:>12.1f}")
+
+    elongated = rows[:, 0] < 0.8
+    for name, column in [("image", 4), ("moments", 5)]:
+        print(
+            f"\n{name}: median residual {np.median(rows[:, column]):.2f} deg, "
+            f"for q < 0.8 {np.median(rows[elongated, column]):.2f} deg, "
+            f"within 5 deg for q < 0.8: {np.mean(rows[elongated, column] < 5):.0%}"
+        )
+    print(f"\nMedian time per galaxy: image {np.median(rows[:, 6]) * 1e3:.2f} ms, moments {np.median(rows[:, 7]) * 1e3:.2f} ms")
+    print(f"Median |image PA - moment PA|: {np.median([position_angle_residual(np.radians(a - b)) for a, b in rows[:, 2:4]]):.1f} deg")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,2 @@
 from .galaxy import Galaxy
-from .load import Gamma
+from .load import Gamma, GammaDataset
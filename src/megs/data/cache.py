@@ -0,0 +1,253 @@
+"""Local cache for the particle data of single halos.
+
+Loading a halo from the snapshot opens and scans the snapshot chunk files, which is slow on network filesystems. The ParticleCache
+stores the arrays a simulation class loaded for a halo in a local directory, one subdirectory per halo with one .npy file per array.
+The arrays are memory-mapped when they are loaded again, so a second pass over the same halos does not touch the snapshot.
+
+The total size of the cache can be limited. If it is exceeded, the least recently used halos are removed. The number of halo loads of the
+current process that hit or missed the cache can be accessed with get_cache_counts.
+
+Example
+-------
+>>> cache = ParticleCache("/scratch/megs_cache", max_size=50)  # at most 50 GB
+>>> particles = cache.get("IllustrisTNG_99_stars_0", "particles", ["Coordinates", "Masses"])
+>>> if particles is None:
+...     particles = load_from_snapshot()
+...     cache.put("IllustrisTNG_99_stars_0", "particles", particles)
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Number of halo loads of this process that found their arrays in the cache (hits) or not (misses), and the number of removed halos
+_cache_counts = {"hits": 0, "misses": 0, "evictions": 0}
+# Name of the file in every halo directory holding the size of the halo in bytes
+_SIZE_FILE = "size"
+# Fraction of max_size a process may add to the cache before it scans the cache directory again for the additions of other processes
+_RESCAN_FRACTION = 0.05
+
+
+def get_cache_counts(reset=False):
+    """Get the number of hits, misses and evictions of the particle caches of this process.
+
+    Parameters
+    ----------
+    reset : bool, optional
+        If True, the counters are set to zero after reading them. The default is False.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys "hits", "misses" and "evictions".
+    """
+    counts = dict(_cache_counts)
+    if reset:
+        for key in _cache_counts:
+            _cache_counts[key] = 0
+    return counts
+
+
+class ParticleCache:
+    """Directory cache for the particle arrays of single halos with a size limit and least recently used eviction.
+
+    Every halo is stored in its own subdirectory named by its key. The arrays are saved in groups (e.g. "particles" and "catalog")
+    with one .npy file per array, and the size of the halo is kept in a file in its directory. The modification time of the halo
+    directory marks the last access and is used for the eviction. Files are written to a temporary name and renamed, so several
+    processes can share one cache.
+
+    Every process keeps a running estimate of the total size: the size found by its last scan of the cache directory plus the bytes
+    it added since. The directory is only scanned again if the estimate exceeds max_size or the process added more than
+    _RESCAN_FRACTION of max_size, so the cache can exceed max_size by about the data the other processes added since the last scan.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache. It is created if it does not exist.
+    max_size : float, optional
+        Maximum size of the cache in GB. If None, the size is not limited. The default is None.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_bytes = None if max_size is None else int(max_size * 1024**3)
+        os.makedirs(self.path, exist_ok=True)
+        self._scanned_size = None
+        self._added_size = 0
+
+    def _group_path(self, key, group):
+        return os.path.join(self.path, str(key), group)
+
+    def get(self, key, group, names=None, mmap_mode="r", count=True):
+        """Load the arrays of a halo from the cache.
+
+        Parameters
+        ----------
+        key : str
+            The key of the halo, e.g. "IllustrisTNG_99_stars_0".
+        group : str
+            The group of the arrays, e.g. "particles".
+        names : list, optional
+            Names of the arrays to load. If None, all arrays of the group are loaded. The default is None.
+        mmap_mode : str, optional
+            Memory-map mode passed to numpy.load. The default is "r".
+        count : bool, optional
+            If True, the lookup is counted as a hit or miss, see get_cache_counts. Use False for the secondary lookups of a halo load,
+            so every halo is counted once. The default is True.
+
+        Returns
+        -------
+        dict or None
+            Dictionary with the names and the arrays, or None if the group or any of the requested arrays is not cached.
+        """
+        group_path = self._group_path(key, group)
+        if names is None:
+            names = (
+                [name[:-4] for name in os.listdir(group_path) if name.endswith(".npy")]
+                if os.path.isdir(group_path)
+                else []
+            )
+        arrays = dict()
+        for name in names:
+            try:
+                arrays[name] = np.load(os.path.join(group_path, f"{name}.npy"), mmap_mode=mmap_mode)
+            except FileNotFoundError:
+                arrays = None
+                break
+        if not arrays:
+            if count:
+                _cache_counts["misses"] += 1
+            return None
+        if count:
+            _cache_counts["hits"] += 1
+        try:
+            # Mark the halo as recently used
+            os.utime(os.path.join(self.path, str(key)))
+        except FileNotFoundError:
+            pass
+        return arrays
+
+    def contains(self, key, group, names):
+        """Return True if all arrays names of a group of a halo are cached. Unlike get, the lookup is not counted."""
+        group_path = self._group_path(key, group)
+        return all(os.path.exists(os.path.join(group_path, f"{name}.npy")) for name in names)
+
+    def put(self, key, group, arrays):
+        """Save arrays of a halo in the cache and remove the least recently used halos if the cache is too large.
+
+        If another process removes the halo while it is written, the arrays are written again once and otherwise not cached.
+
+        Parameters
+        ----------
+        key : str
+            The key of the halo.
+        group : str
+            The group of the arrays.
+        arrays : dict
+            Dictionary with the names and the arrays to save. Values that can not be converted to a numeric array are skipped.
+        """
+        for _ in range(2):
+            try:
+                added = self._write(key, group, arrays)
+                break
+            except FileNotFoundError:
+                # The halo directory was removed by the eviction of another process
+                continue
+        else:
+            return
+        if self.max_bytes is None:
+            return
+        self._added_size += added
+        if self._scanned_size is None:
+            self._evict(keep=str(key))
+        elif (
+            self._scanned_size + self._added_size > self.max_bytes
+            or self._added_size > _RESCAN_FRACTION * self.max_bytes
+        ):
+            self._evict(keep=str(key))
+
+    def _write(self, key, group, arrays):
+        """Write the arrays of a halo and update its size file. Returns the number of bytes added to the cache."""
+        halo_path = os.path.join(self.path, str(key))
+        group_path = self._group_path(key, group)
+        os.makedirs(group_path, exist_ok=True)
+        # Size before the new arrays are written, a halo without size file is measured from its files
+        size = self._halo_size(halo_path)
+        added = 0
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            if array.dtype == object:
+                continue
+            target = os.path.join(group_path, f"{name}.npy")
+            handle, temporary = tempfile.mkstemp(dir=group_path, suffix=".tmp")
+            with os.fdopen(handle, "wb") as f:
+                np.save(f, array)
+            added += os.path.getsize(temporary)
+            if os.path.exists(target):
+                added -= os.path.getsize(target)
+            os.replace(temporary, target)
+        # Replacing the size file also marks the halo as recently used
+        self._write_size(halo_path, size + added)
+        return added
+
+    def _write_size(self, halo_path, size):
+        handle, temporary = tempfile.mkstemp(dir=halo_path, suffix=".tmp")
+        with os.fdopen(handle, "w") as f:
+            f.write(str(size))
+        os.replace(temporary, os.path.join(halo_path, _SIZE_FILE))
+
+    def _halo_size(self, halo_path):
+        """Size of a halo in bytes from its size file, or from its files if it has no size file."""
+        try:
+            with open(os.path.join(halo_path, _SIZE_FILE)) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            pass
+        size = 0
+        for root, _, files in os.walk(halo_path):
+            for name in files:
+                if name.endswith(".npy"):
+                    try:
+                        size += os.path.getsize(os.path.join(root, name))
+                    except FileNotFoundError:
+                        pass
+        return size
+
+    def _scan(self):
+        """List the cached halos as (last access time, key, size in bytes)."""
+        halos = []
+        for key in os.listdir(self.path):
+            halo_path = os.path.join(self.path, key)
+            try:
+                halos.append((os.path.getmtime(halo_path), key, self._halo_size(halo_path)))
+            except FileNotFoundError:
+                # Removed by another process
+                continue
+        return halos
+
+    def _evict(self, keep=None):
+        """Scan the cache and remove the least recently used halos until it is smaller than max_bytes. The halo keep is never removed."""
+        halos = self._scan()
+        total = sum(size for _, _, size in halos)
+        for _, key, size in sorted(halos):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= size
+            _cache_counts["evictions"] += 1
+        self._scanned_size = total
+        self._added_size = 0
+
+    def info(self):
+        """Get the number of cached halos and the size of the cache.
+
+        Returns
+        -------
+        dict
+            Dictionary with the keys "halos" and "size" (in bytes).
+        """
+        halos = self._scan()
+        return {"halos": len(halos), "size": sum(size for _, _, size in halos)}
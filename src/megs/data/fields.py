@@ -0,0 +1,144 @@
+'''
+Derived Fields for the Image Rendering
+
+This module evaluates expressions of particle fields, so derived quantities can be rendered like the fields of the snapshot. An expression combines
+field names, numbers, the operators + - * / ** and the functions in FUNCTIONS, for example
+
+    "Masses*GFM_Metallicity"
+    "log10(GFM_Metallicity)"
+    "GFM_StellarFormationTime/1e9"
+
+The expressions are evaluated vectorized on the arrays returned by the get_field method of the Galaxy class, which caches the fields per galaxy.
+Expressions can be passed to Galaxy.get_field and Galaxy.get_image directly. In the "fields" entry of the generation config, the field name is used
+as the name of the HDF5 dataset, so expressions with a "/" have to be given in the "expression" attribute of a field with a plain name:
+
+>>> fields = {"log_metallicity": {"expression": "log10(GFM_Metallicity)", "mass_weighted": True, "normed": False}}
+'''
+import ast
+from functools import lru_cache
+
+import numpy as np
+
+# Functions that can be used in the expressions
+FUNCTIONS = {
+    "log10": np.log10,
+    "log": np.log,
+    "exp": np.exp,
+    "sqrt": np.sqrt,
+    "abs": np.abs,
+}
+
+_BINARY_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power,
+}
+_UNARY_OPERATORS = {ast.USub: np.negative, ast.UAdd: np.positive}
+
+
+def is_expression(field):
+    '''Return True if field is an expression and not the name of a single field.'''
+    return not field.isidentifier()
+
+
+@lru_cache(maxsize=None)
+def _parse(expression):
+    '''Parse the expression and check that it only contains field names, numbers and the allowed operators and functions.'''
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError:
+        raise ValueError(f"Invalid field expression {expression}.")
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError(
+                    f"Invalid function in field expression {expression}. Available functions: {sorted(FUNCTIONS)}."
+                )
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise ValueError(f"Invalid constant {node.value!r} in field expression {expression}.")
+        elif not isinstance(
+            node,
+            (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Name, ast.Load)
+            + tuple(_BINARY_OPERATORS)
+            + tuple(_UNARY_OPERATORS),
+        ):
+            raise ValueError(f"Invalid syntax {type(node).__name__} in field expression {expression}.")
+    return tree.body
+
+
+def expression_fields(expression):
+    '''Names of the fields used in an expression, in the order of their first appearance.
+
+    Parameters
+    ----------
+    expression : str
+        The expression or the name of a single field.
+
+    Returns
+    -------
+    list
+        The field names.
+    '''
+    if not is_expression(expression):
+        return [expression]
+    names = []
+    functions = {id(node.func) for node in ast.walk(_parse(expression)) if isinstance(node, ast.Call)}
+    for node in ast.walk(_parse(expression)):
+        # The function names of the calls are no fields
+        if isinstance(node, ast.Name) and id(node) not in functions and node.id not in names:
+            names.append(node.id)
+    return names
+
+
+def required_fields(fields):
+    '''Names of the particle fields needed to render the fields of the generation config.
+
+    Parameters
+    ----------
+    fields : dict
+        Dictionary with the field names as keys and the keyword arguments of get_image (including an optional "expression") as values.
+
+    Returns
+    -------
+    list
+        The names of the particle fields used by the fields and their expressions.
+    '''
+    names = []
+    for field, field_kwargs in fields.items():
+        for name in expression_fields(field_kwargs.get("expression", field)):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def evaluate(expression, get_field):
+    '''Evaluate an expression of fields.
+
+    Parameters
+    ----------
+    expression : str
+        The expression, see the module documentation.
+    get_field : callable
+        Function that returns the array of a field name, e.g. the get_field method of the Galaxy class.
+
+    Returns
+    -------
+    numpy.array
+        The values of the expression for all particles.
+    '''
+
+    def _evaluate(node):
+        if isinstance(node, ast.Name):
+            return get_field(node.id)
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.BinOp):
+            return _BINARY_OPERATORS[type(node.op)](_evaluate(node.left), _evaluate(node.right))
+        if isinstance(node, ast.UnaryOp):
+            return _UNARY_OPERATORS[type(node.op)](_evaluate(node.operand))
+        return FUNCTIONS[node.func.id](*[_evaluate(argument) for argument in node.args])
+
+    return _evaluate(_parse(expression))
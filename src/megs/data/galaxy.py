@@ -2,7 +2,10 @@ from .simulations import *  # Import all Galaxy Classes of the simulations
 
 import numpy as np
 import sys
-from .image import image2D, image3D, norm, face_on_rotation, horizontal_rotation
+from .image import norm, face_on_rotation, moment_horizontal_rotation, PARALLEL_THRESHOLD
+from .renderers import get_renderer
+from .fields import evaluate, is_expression
+from .timing import timed
 
 def str_to_class(classname):
     """Converts a string to a class."""
@@ -26,6 +29,22 @@ class Galaxy:
     ----------
     simulation : str, optional
         The simulation the galaxy is from. Curenntly only "IllustrisTNG" is supported. You can add your own simulation by adding a new class to the simulations.py file.
+    renderer : str, optional
+        The name of the image renderer, see the renderers.py module. "sph" renders with the exact SPH scatter, "cic" and "histogram" are cheap deposits
+        for quick-look images. Own renderers can be added with the register_renderer decorator. The default is "sph".
+    alignment : str, optional
+        The method for the horizontal alignment after the face-on rotation. "image" keeps the orientation of the face-on rotation: the
+        horizontal_rotation method on a temporary mass image returns an angle of 0 for every galaxy (see its documentation), so the image is
+        not rendered and the horizontal rotation matrix is the identity. "moments" uses the moment_horizontal_rotation method, which calculates
+        the angle from the particles and aligns the major axis with the x-axis. The default is "image", so existing catalogs keep their
+        orientation. See exp/validate_alignment.py for a comparison.
+    rotation_matrix : numpy.array, optional
+        The total rotation matrix of an earlier run, e.g. saved in the Galaxies/Orientation group of the generated HDF5 file. If given, the particles are centered
+        and rotated with this matrix and the face-on and horizontal alignment are skipped. The default is None.
+    backend : str, optional
+        The scatter backend of the image rendering, one of "serial", "parallel" or "auto". The default is "serial". See the documentation of the image2D function.
+    parallel_threshold : int, optional
+        The number of particles from which on the "auto" backend renders with the parallel scatter. The default is PARALLEL_THRESHOLD of the image.py module.
 
     **kwargs : dict
         Additional arguments for the galaxy class. This is used to initialize the galaxy class of a specific simulation. See the documentation of the galaxy class defined in simulations.py for more information.
@@ -38,6 +57,14 @@ class Galaxy:
         Factor used in the horizontal_rotation method defined in the rotation.py module to scale the image. The default is 10. For more information see the documentation of the horizontal_rotation method.
     res : int
         Resolution of the image. The default is 64. For more information see the documentation of the horizontal_rotation method.
+    renderer : str
+        The name of the image renderer.
+    alignment : str
+        The method for the horizontal alignment.
+    backend : str
+        The scatter backend of the image rendering.
+    parallel_threshold : int
+        The number of particles from which on the "auto" backend renders with the parallel scatter.
     smoothing_length : numpy.array
         Smoothing length of the galaxy. This is used for the image rendering.
     coordinates : numpy.array
@@ -52,8 +79,17 @@ class Galaxy:
     >>> galaxy.get_rotation_matrix() # Get the rotation matrix used to rotate the galaxy to face-on and horizontal orientation
     """
 
-    def __init__(self, simulation="IllustrisTNG", **kwargs):
+    def __init__(self, simulation="IllustrisTNG", renderer="sph", alignment="image", rotation_matrix=None, backend="serial", parallel_threshold=PARALLEL_THRESHOLD, **kwargs):
         self.simulation = simulation
+        # Check that the renderer exists before the galaxy is loaded
+        get_renderer(renderer, 2)
+        self.renderer = renderer
+        if alignment not in ["image", "moments"]:
+            raise ValueError("alignment must be either 'image' or 'moments'.")
+        self.alignment = alignment
+        self._cached_rotation_matrix = rotation_matrix
+        # Fields in physical units, see get_field
+        self._field_cache = dict()
         # Gemeral Galaxy Properties??
         self.rotated_flag = False
 
@@ -62,6 +98,8 @@ class Galaxy:
         # Set default Atributes for the image rendering
         self.plot_factor = 10
         self.res = 64
+        self.backend = backend
+        self.parallel_threshold = parallel_threshold
         if hasattr(self.galaxy_object, "hsml"):
             self.smoothing_length = self.galaxy_object.hsml
         else:
@@ -88,7 +126,8 @@ class Galaxy:
         """Rotate the galaxy to face-on and horizontal orientation.
 
         This function is called when the galaxy object is initialized. It is not necessary to call it again. First the galaxy is rotated face-on and then horizontal.
-        The rotation is done using the rotation.py module.
+        The rotation is done using the rotation.py module. The horizontal alignment method is selected with the alignment attribute.
+        If a rotation matrix was passed to the Galaxy class, the particles are only centered and rotated with this matrix.
 
         Parameters
         ----------
@@ -103,37 +142,96 @@ class Galaxy:
         if self.rotated_flag:
             return self.coordinates
 
-        face_on_rotated_coords, rotation_matrix_face_on = face_on_rotation(
-            coordinates=self.particle_coordinates,
-            particle_masses=self.particle_masses,
-            rHalf=self.halfmassrad,
-            subhalo_pos=self.center,
-            return_rotation_matrix=True,
-        )
-        # maybe horizontal rotataion is not working properly
-        # Create temporary image to get the rotation angle: Maybe there is a better way to do this. Only calculating a hist does not work properly.
-        img = self._render_image_2D(
-            field=self.particle_masses, coordinates=face_on_rotated_coords
-        )
-        horizontal_rotated_coords, rotation_matrix_horizontal = horizontal_rotation(
-            img=img,
-            coordinates=face_on_rotated_coords,
-            halfmassrad=self.halfmassrad,
-            plotfactor=_plotfactor,
-            return_rotation_matrix=True,
-        )
+        if self._cached_rotation_matrix is not None:
+            self._total_rotation_matrix = np.asarray(self._cached_rotation_matrix, dtype=np.float64)
+            if self._total_rotation_matrix.shape != (3, 3):
+                raise ValueError("rotation_matrix must have the shape (3, 3).")
+            # The saved rotation replaces the face-on and horizontal alignment
+            with timed("face_on"):
+                pos = self.particle_coordinates - self.center
+                self.rotated_flag = True
+                return np.dot(self._total_rotation_matrix, pos.T).T
+
+        with timed("face_on"):
+            face_on_rotated_coords, rotation_matrix_face_on = face_on_rotation(
+                coordinates=self.particle_coordinates,
+                particle_masses=self.particle_masses,
+                rHalf=self.halfmassrad,
+                subhalo_pos=self.center,
+                return_rotation_matrix=True,
+            )
+        with timed("horizontal"):
+            horizontal_rotated_coords, rotation_matrix_horizontal = self._horizontal_rotation(face_on_rotated_coords)
         self._total_rotation_matrix = np.dot(
             rotation_matrix_horizontal, rotation_matrix_face_on
         )
         self.rotated_flag = True
         return horizontal_rotated_coords
 
+    def _horizontal_rotation(self, face_on_rotated_coords):
+        """Align the major axis of the face-on rotated galaxy with the x-axis, with the method selected by the alignment attribute."""
+        if self.alignment == "moments":
+            # Angle from the second moments of the particles, no image needed
+            horizontal_rotated_coords, rotation_matrix_horizontal = moment_horizontal_rotation(
+                coordinates=face_on_rotated_coords,
+                particle_masses=self.particle_masses,
+                halfmassrad=self.halfmassrad,
+                return_rotation_matrix=True,
+            )
+        else:
+            # horizontal_rotation on a temporary mass image always returns the angle 0, since it selects all pixels of the clipped image.
+            # The face-on orientation is kept without rendering the image
+            horizontal_rotated_coords = face_on_rotated_coords
+            rotation_matrix_horizontal = np.identity(3)
+        return horizontal_rotated_coords, rotation_matrix_horizontal
+
     def __getattr__(self, name):
         """Delegate all other attributes to the galaxy object. This is used to access the attributes of the simulation galaxy class defined in the simulations.py file,
         if they are not defined in the general Galaxy class.
         """
         return getattr(self.galaxy_object, name)
 
+    def get_field(self, field, particle_type=None):
+        """
+        Get a field of the particles in physical units.
+
+        The field is loaded with the get_field method of the galaxy object and cached, so the masking and the unit conversion only run once per galaxy.
+        The cache is dropped with the galaxy or with clear_field_cache. field can also be an expression of fields like "Masses*GFM_Metallicity"
+        or "log10(GFM_Metallicity)", which is evaluated on the cached fields, see the fields.py module.
+        The returned arrays are shared between the calls and must not be changed in place.
+
+        Parameters
+        ----------
+        field : str
+            The name of the field or an expression of fields.
+        particle_type : str, optional
+            Passed to the get_field method of the galaxy object. The default is None.
+
+        Returns
+        -------
+        numpy.array
+            The field in physical units.
+        """
+        key = (field, particle_type)
+        if key not in self._field_cache:
+            with timed("fields"):
+                if is_expression(field):
+                    value = evaluate(field, lambda name: self.get_field(name, particle_type))
+                elif particle_type is None:
+                    value = self.galaxy_object.get_field(field)
+                else:
+                    value = self.galaxy_object.get_field(field, particle_type)
+            self._field_cache[key] = value
+        return self._field_cache[key]
+
+    def clear_field_cache(self):
+        """Remove all cached fields of get_field."""
+        self._field_cache.clear()
+
+    def _mass_weighted_field(self, field):
+        """The field multiplied by the particle masses, the weights of mass weighted images. Cached like the other fields."""
+        return self.get_field(f"Masses*({field})" if is_expression(field) else f"Masses*{field}")
+
     # -----------------Image Rendering-----------------#
 
     def _render_image_2D(
@@ -142,8 +240,8 @@ class Galaxy:
         coordinates=None,
     ):
         """Image Render Module for 2D images.
-        This function is called by the get_image function. It renders the image using the image2D function from the image_modules.py file.
-        You can change the image rendering by implementing your own image rendering function here.
+        This function is called by the get_image function. It renders the image using the renderer selected with the renderer attribute,
+        by default the image2D function from the image.py file. You can add your own image rendering function with the register_renderer decorator of the renderers.py module.
 
         For more information of the default render method see the documentation of the image2D function.
         """
@@ -158,13 +256,15 @@ class Galaxy:
                 raise ValueError(
                     "Coordinates, smoothing length and field must have the same length."
                 )
-            img = image2D(
+            img = get_renderer(self.renderer, 2)(
                 coordinates=coordinates,
                 R_half=self.halfmassrad,
                 weights=field,
                 smoothing_length=self.smoothing_length,
                 plot_factor=self.plot_factor,
                 res=self.res,
+                backend=self.backend,
+                parallel_threshold=self.parallel_threshold,
             )
         else:
             if (
@@ -176,13 +276,15 @@ class Galaxy:
                     "Coordinates, smoothing length and field must have the same length."
                 )
 
-            img = image2D(
+            img = get_renderer(self.renderer, 2)(
                 coordinates=self.coordinates,
                 R_half=self.halfmassrad,
                 weights=field,
                 smoothing_length=self.smoothing_length,
                 plot_factor=self.plot_factor,
                 res=self.res,
+                backend=self.backend,
+                parallel_threshold=self.parallel_threshold,
             )
         return img
 
@@ -192,8 +294,8 @@ class Galaxy:
         coordinates=None,
     ):
         """Image Render Module for 3D images.
-        This function is called by the get_image function. It renders the image using the image3D function from the image_modules.py file.
-        You can change the image rendering by implementing your own image rendering function here.
+        This function is called by the get_image function. It renders the image using the renderer selected with the renderer attribute,
+        by default the image3D function from the image.py file. You can add your own image rendering function with the register_renderer decorator of the renderers.py module.
 
         For more information of the default render method see the documentation of the image3D function.
         """
@@ -208,13 +310,15 @@ class Galaxy:
                 raise ValueError(
                     "Coordinates, smoothing length and field must have the same length."
                 )
-            img = image3D(
+            img = get_renderer(self.renderer, 3)(
                 coordinates=coordinates,
                 R_half=self.halfmassrad,
                 weights=field,
                 smoothing_length=self.smoothing_length,
                 plot_factor=self.plot_factor,
                 res=self.res,
+                backend=self.backend,
+                parallel_threshold=self.parallel_threshold,
             )
         else:
             if (
@@ -226,13 +330,15 @@ class Galaxy:
                     "Coordinates, smoothing length and field must have the same length."
                 )
 
-            img = image3D(
+            img = get_renderer(self.renderer, 3)(
                 coordinates=self.coordinates,
                 R_half=self.halfmassrad,
                 weights=field,
                 smoothing_length=self.smoothing_length,
                 plot_factor=self.plot_factor,
                 res=self.res,
+                backend=self.backend,
+                parallel_threshold=self.parallel_threshold,
             )
         return img
 
@@ -241,7 +347,7 @@ class Galaxy:
         Render the image of a given field.
         
         This function is called by the get_image function. It renders the image using the _render_image_2D or _render_image_3D function based on the dimension of the image.
-        You can change the image rendering by implementing your own image rendering function in the _render_image_2D or _render_image_3D function.
+        You can change the image rendering by registering your own image rendering function in the renderers.py module and selecting it with the renderer argument.
 
         Parameters
         ----------
@@ -290,7 +396,7 @@ class Galaxy:
         Parameters
         ----------
         field : str
-            The field to be rendered. Can be any field that is available in the snapshot. Used to call the get_field function of the galaxy object.
+            The field to be rendered. Can be any field that is available in the snapshot or an expression of fields like "log10(GFM_Metallicity)". Used to call the get_field function.
         mass_weighted : bool, optional
             If True, the image is mass weighted. The default is True.
         normed : bool, optional
@@ -334,7 +440,7 @@ class Galaxy:
                 image = mass_img
             else:
                 # Create the mass weighted field image.
-                weights = self.get_field(field) * masses  # mass weighted weights
+                weights = self._mass_weighted_field(field)  # mass weighted weights
                 weights_img = self.render_image(weights, dim)
 
                 # Avoid division by zero: If the mass image value is zero, return the weights image value
@@ -354,6 +460,147 @@ class Galaxy:
 
         return image
 
+    def get_images(self, fields, dim=2, res=None, plotfactor=None):
+        """
+        Get the images of several fields.
+
+        This gives the same images as calling get_image for every field, but renders all of them together. The mass image is rendered once
+        and all other fields are rendered in a single multi-channel pass over the particles, instead of two renders per mass weighted field.
+
+        Parameters
+        ----------
+        fields : dict or list
+            The fields to be rendered. Either a dictionary with the field names as keys and the keyword arguments of get_image (mass_weighted, normed 
+            and the arguments of the normalization function) as values, like the "fields" entry of the generation config, or a list of field names 
+            which are rendered with the default arguments of get_image. An "expression" value renders the expression of fields (see the fields.py
+            module) under the field name.
+        dim : int, optional
+            The dimension of the images. The default is 2.
+        res : int, optional
+            The resolution of the images. If None, the resolution of the Galaxy class is used.
+        plotfactor : int, optional
+            The plotfactor used to scale the images. If None, the plotfactor of the Galaxy class is used.
+
+        Returns
+        -------
+        dict
+            The images with the field names as keys.
+
+        Examples
+        --------
+        >>> galaxy = Galaxy(halo_id=0, particle_type="stars", base_path="data", snapshot=99)
+        >>> images = galaxy.get_images({"Masses": {"mass_weighted": False}, "GFM_Metallicity": {"mass_weighted": True}})
+        >>> plt.imshow(images["GFM_Metallicity"])
+        """
+        # Set the resolution and plotfactor
+        if res is not None:
+            self.res = res
+        if plotfactor is not None:
+            self.plot_factor = plotfactor
+
+        # Check if dim is 2 or 3
+        if dim not in [2, 3]:
+            raise ValueError("dim must be 2 or 3. This is the dimension of the image.")
+
+        if not isinstance(fields, dict):
+            fields = {field: {} for field in fields}
+
+        channel_images, channels = self._render_channels(fields, dim)
+        return self._combine_channels(fields, channel_images, channels)
+
+    def get_projected_images(self, fields, res=None, plotfactor=None):
+        """
+        Get the 3D images of several fields together with 2D images obtained by projecting them.
+
+        Only the 3D volume is rendered. The 2D surface density images are calculated by summing the 3D images along the line of sight (z-axis),
+        and mass weighted fields are divided by the projected mass image after the projection. This replaces the separate 2D render
+        when both 2D and 3D images are needed.
+
+        In contrast to the 2D render, only the particle mass inside the image cube, i.e. -plotfactor*R_half < z < plotfactor*R_half,
+        contributes to the projected images. Since the 3D and 2D kernels differ for smoothing lengths below the voxel size, single pixels of
+        sparsely sampled galaxies can deviate strongly, while the total mass agrees. See exp/accuracy_projection.py for a comparison with the 2D render.
+
+        Parameters
+        ----------
+        fields : dict or list
+            The fields to be rendered, see get_images.
+        res : int, optional
+            The resolution of the images. If None, the resolution of the Galaxy class is used.
+        plotfactor : int, optional
+            The plotfactor used to scale the images. If None, the plotfactor of the Galaxy class is used.
+
+        Returns
+        -------
+        tuple
+            (images_2D, images_3D), two dicts with the field names as keys.
+        """
+        # Set the resolution and plotfactor
+        if res is not None:
+            self.res = res
+        if plotfactor is not None:
+            self.plot_factor = plotfactor
+
+        if not isinstance(fields, dict):
+            fields = {field: {} for field in fields}
+
+        channel_images, channels = self._render_channels(fields, 3)
+        # Integrate the density along the line of sight. The voxel depth is 1/res in the units of the rendered image
+        projected_images = channel_images.sum(axis=-1) / self.res
+        return (
+            self._combine_channels(fields, projected_images, channels),
+            self._combine_channels(fields, channel_images, channels),
+        )
+
+    def _render_channels(self, fields, dim):
+        """Render the weights of all fields in one multi-channel pass.
+
+        The masses are the first channel, since they are needed for the mass weighted fields.
+
+        Returns
+        -------
+        tuple
+            (channel_images, channels) with the rendered images of shape (N_channels, res, res[, res]) and a dict mapping the fields to their channel.
+        """
+        masses = self.get_field("Masses")
+        weights = [masses]
+        channels = dict()
+        for field, field_kwargs in fields.items():
+            mass_weighted = field_kwargs.get("mass_weighted", True)
+            # The expression of a derived field, see the fields.py module
+            expression = field_kwargs.get("expression", field)
+            if expression == "Masses":
+                channels[field] = 0
+            elif mass_weighted:
+                channels[field] = len(weights)
+                weights.append(self._mass_weighted_field(expression))  # mass weighted weights
+            else:
+                channels[field] = len(weights)
+                weights.append(self.get_field(expression))
+
+        return self.render_image(np.column_stack(weights), dim), channels
+
+    def _combine_channels(self, fields, channel_images, channels):
+        """Calculate the field images from the rendered channels. Divides the mass weighted fields by the mass image and normalizes the images."""
+        mass_img = channel_images[0]
+
+        images = dict()
+        for field, field_kwargs in fields.items():
+            field_kwargs = dict(field_kwargs)
+            mass_weighted = field_kwargs.pop("mass_weighted", True)
+            normed = field_kwargs.pop("normed", False)
+            expression = field_kwargs.pop("expression", field)
+            image = channel_images[channels[field]]
+            if mass_weighted and expression != "Masses":
+                # Avoid division by zero: If the mass image value is zero, return the weights image value
+                mask = np.where(mass_img != 0)
+                image = image.copy()
+                image[mask] = image[mask] / mass_img[mask]
+            if normed:
+                image = norm(image, **field_kwargs)
+            images[field] = image
+
+        return images
+
     def get_rotation_matrix(self):
         """Get the total rotation matrix of the galaxy.
 
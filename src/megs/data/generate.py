@@ -2,12 +2,42 @@
 """
 import json
 import argparse
+import inspect
+import multiprocessing
+import queue
+import threading
+import time
 import h5py
 import os
 import numpy as np
+from functools import partial
 from tqdm import tqdm
 
 from . import Galaxy
+from .galaxy import str_to_class
+from .load import _quantization_path
+from .cache import get_cache_counts
+from .image import get_cull_counts
+from .fields import required_fields
+from .timing import STAGES, get_stage_times, profile_options, profile_path, start_galaxy, stop_galaxy, timed
+
+# Data types the images can be stored in, see _encode_image()
+STORAGE_DTYPES = ["float32", "float16", "uint8", "uint16"]
+
+# Group with the rotation matrix, centre and halo ID of every galaxy, used to re-render a catalog without aligning the galaxies again
+ORIENTATION_GROUP = "Galaxies/Orientation"
+
+# Group with the predicted and measured cost of every galaxy, see _calculate_images()
+COST_GROUP = "Galaxies/Cost"
+
+# Orders in which the galaxies can be handed to the workers, see _tasks()
+SCHEDULE_ORDERS = ["cost", "index"]
+
+# Predicted peak memory of a worker per particle of a galaxy in bytes: the loaded fields, the rotated coordinates, the field cache and the render weights
+MEMORY_PER_PARTICLE = 256
+
+# Maximum number of bytes held in memory when copying the shards in merge_shards()
+_MERGE_BLOCK_BYTES = 256 * 1024**2
 
 def _create_data_structure(
     n_galaxies,
@@ -17,6 +47,13 @@ def _create_data_structure(
     fields,
     path="./",
     dim=None,
+    filename="galaxy_data.hdf5",
+    attrs=None,
+    chunks="galaxy",
+    compression=None,
+    compression_opts=None,
+    shuffle=False,
+    dtype="float32",
 ):
     """Creates the HDF5 data structure for the galaxy data
 
@@ -37,6 +74,34 @@ def _create_data_structure(
         Path to the HDF5 file
     dim: int
         Dimension of the images. If None, both 2D and 3D images are saved. If 2, only 2D images and if 3, only 3D images are saved.
+    filename: str, default="galaxy_data.hdf5"
+        Name of the HDF5 file. Shards of a sharded run use the name returned by _shard_filename().
+    attrs: dict, optional
+        Additional attributes saved in the root of the HDF5 file, e.g. the shard information.
+    chunks: str or int, default="galaxy"
+        Chunk layout of the image datasets. "galaxy" stores every image of a galaxy in its own chunk, so reading a single galaxy
+        only touches one chunk. An int n stores n galaxies per chunk, "auto" lets h5py guess the chunk shape and "contiguous"
+        stores the datasets without chunking. Contiguous datasets can not be compressed or resized.
+    compression: str, optional
+        Compression filter of the image datasets, either None, "gzip" or "lzf".
+    compression_opts: int, optional
+        Compression level for the "gzip" filter between 0 and 9. If None, the h5py default of 4 is used.
+    shuffle: bool, default=False
+        Whether to apply the shuffle filter before the compression. This usually improves the compression of float images.
+    dtype: str, default="float32"
+        Storage data type of the images. One of "float32", "float16", "uint8" or "uint16". "float16" needs normalized images of all fields,
+        see _check_storage_dtype(). For "uint8" and "uint16" the images are
+        quantized with a scale and offset per image, which are saved in the "Quantization" group of each particle type, see _encode_image().
+        The Gamma class converts the images back to float32 when loading them.
+
+    The storage layout is saved in the "chunks", "compression", "compression_opts", "shuffle" and "dtype" attributes of the file.
+    The "Orientation" group holds the total rotation matrix, the centre and the halo ID of every galaxy, see _load_rotations().
+    The "Cost" group holds the number of particles predicted from the catalog (-1 if unknown), the number of rendered particles and the time
+    in seconds to load, rotate and render every galaxy, which can be used to calibrate the cost model of _calculate_images(). It also holds the
+    time of every stage (the columns of stage_time are listed in its "stages" attribute, see the timing.py module; the "write" column is the
+    galaxy's share of the time of writing its slab, see _SlabWriter), the largest resident set size
+    of the worker process up to this galaxy (process_max_rss, -1 if unknown), which is a property of the process and not of the single galaxy, and the
+    peak of the memory allocated for the galaxy if MEGS_PROFILE=tracemalloc is set (peak_traced, else -1).
 
     Example:
     --------
@@ -48,6 +113,17 @@ def _create_data_structure(
         Attributes
             mass: (1000,)
             halo_id: (1000,)
+        Orientation
+            rotation_matrix: (1000,3,3)
+            center: (1000,3)
+            halo_id: (1000,)
+        Cost
+            predicted_particles: (1000,)
+            n_particles: (1000,)
+            time: (1000,)
+            process_max_rss: (1000,)
+            peak_traced: (1000,)
+            stage_time: (1000,9)
         Particles
             stars
                 Images
@@ -66,8 +142,33 @@ def _create_data_structure(
     if dim is None:
         # If dim is None, save both 2D and 3D images
         dim = [2, 3]
+    else:
+        dim = [dim]
+    # Check if the storage layout is valid
+    if chunks not in ["galaxy", "auto", "contiguous"] and not (
+        isinstance(chunks, int) and chunks > 0
+    ):
+        raise ValueError(
+            'chunks should be either "galaxy", "auto", "contiguous" or a positive number of galaxies per chunk.'
+        )
+    if compression not in [None, "gzip", "lzf"]:
+        raise ValueError('compression should be either None, "gzip" or "lzf".')
+    if chunks == "contiguous" and (compression is not None or shuffle):
+        raise ValueError("Contiguous datasets can not be compressed or shuffled.")
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"dtype should be one of {STORAGE_DTYPES}.")
+    _check_storage_dtype(fields, dtype)
     # Open the HDF5 file in "w" mode to create a new file
-    with h5py.File(os.path.join(path, "galaxy_data.hdf5"), "w") as f:
+    with h5py.File(os.path.join(path, filename), "w") as f:
+        if attrs is not None:
+            for key, value in attrs.items():
+                f.attrs[key] = value
+        # Save the storage layout of the image datasets
+        f.attrs["chunks"] = chunks
+        f.attrs["compression"] = "none" if compression is None else compression
+        f.attrs["compression_opts"] = -1 if compression_opts is None else compression_opts
+        f.attrs["shuffle"] = shuffle
+        f.attrs["dtype"] = dtype
         # Create the Galaxies group
         galaxies_group = f.create_group("Galaxies")
         galaxy_attributes = galaxies_group.create_group("Attributes")
@@ -76,6 +177,31 @@ def _create_data_structure(
             galaxy_attributes.create_dataset(
                 parameter, shape=(n_galaxies,), maxshape=(None,)
             )
+        # Create the datasets for the orientation of the galaxies
+        orientation = f.create_group(ORIENTATION_GROUP)
+        orientation.create_dataset(
+            "rotation_matrix", shape=(n_galaxies, 3, 3), maxshape=(None, 3, 3), dtype="f8"
+        )
+        orientation.create_dataset(
+            "center", shape=(n_galaxies, 3), maxshape=(None, 3), dtype="f8"
+        )
+        orientation.create_dataset(
+            "halo_id", shape=(n_galaxies,), maxshape=(None,), dtype="i8"
+        )
+        # Create the datasets for the predicted and measured cost of the galaxies
+        cost = f.create_group(COST_GROUP)
+        for name, cost_dtype in [
+            ("predicted_particles", "i8"),
+            ("n_particles", "i8"),
+            ("time", "f8"),
+            ("process_max_rss", "i8"),
+            ("peak_traced", "i8"),
+        ]:
+            cost.create_dataset(name, shape=(n_galaxies,), maxshape=(None,), dtype=cost_dtype)
+        stage_time = cost.create_dataset(
+            "stage_time", shape=(n_galaxies, len(STAGES)), maxshape=(None, len(STAGES)), dtype="f8"
+        )
+        stage_time.attrs["stages"] = STAGES
 
         particles_group = galaxies_group.create_group("Particles")
         # Create the Particle Types group
@@ -98,7 +224,524 @@ def _create_data_structure(
                     if d == 3:
                         shape = (n_galaxies, image_res, image_res, image_res)
                         maxshape = (None, None, None, None)
-                    dim_group.create_dataset(field, shape=shape, maxshape=maxshape)
+                    if dtype in ["uint8", "uint16"]:
+                        # Create the datasets for the scale and offset of the quantized images
+                        quantization = f.require_group(
+                            _quantization_path(particle_type, f"dim{d}", field)
+                        )
+                        for name in ["scale", "offset"]:
+                            quantization.create_dataset(
+                                name, shape=(n_galaxies,), maxshape=(None,), dtype="f8"
+                            )
+                    if chunks == "contiguous":
+                        dim_group.create_dataset(field, shape=shape, dtype=dtype)
+                        continue
+                    if chunks == "auto":
+                        chunk_shape = True
+                    else:
+                        n_chunk = 1 if chunks == "galaxy" else min(chunks, max(n_galaxies, 1))
+                        chunk_shape = (n_chunk,) + shape[1:]
+                    dim_group.create_dataset(
+                        field,
+                        shape=shape,
+                        maxshape=maxshape,
+                        dtype=dtype,
+                        chunks=chunk_shape,
+                        compression=compression,
+                        compression_opts=compression_opts,
+                        shuffle=shuffle,
+                    )
+
+
+def _image_datasets(f):
+    """Lists the image datasets of the HDF5 file that need to be filled for every galaxy.
+
+    Parameters
+    ----------
+    f: h5py.File
+        The HDF5 file created by the _create_data_structure() method.
+
+    Returns
+    -------
+    list
+        List of (particle_type, dim_key, field) tuples, e.g. ("stars", "dim2", "Masses").
+    """
+    datasets = []
+    for particle_type in f["Galaxies"]["Particles"].keys():
+        for d in f["Galaxies"]["Particles"][particle_type]["Images"].keys():
+            for field in f["Galaxies"]["Particles"][particle_type]["Images"][d].keys():
+                datasets.append((particle_type, d, field))
+    return datasets
+
+
+def _render_galaxy(
+    task,
+    simulation,
+    datasets,
+    galaxy_parameters,
+    fields,
+    plot_factor,
+    image_res,
+    galaxy_kwargs,
+    dtype="float32",
+    project_volume=False,
+    save_orientation=True,
+    save_cost=True,
+):
+    """Loads a single galaxy and renders all of its images.
+
+    This function does not touch the HDF5 file, so it can be run in a worker process of a multiprocessing pool.
+    The results are written to the file by the calling process.
+
+    Parameters
+    ----------
+    task: tuple
+        Tuple (row, haloid, halo_kwargs) with the row in the HDF5 datasets, the halo ID of the galaxy and a dict of keyword arguments
+        of the Galaxy class for this halo, e.g. its rotation matrix from an earlier run or its preloaded catalog row.
+    simulation: str
+        Simulation name (e.g. IllustrisTNG). Used to initialise the Galaxy class.
+    datasets: list
+        List of (particle_type, dim_key, field) tuples to render, see _image_datasets().
+    galaxy_parameters: list
+        List of galaxy parameters to be saved. These need to be attributes of the Galaxy class.
+    fields: dict
+        Dictionary of fields to be saved. The values of the dictionary are passed to the get_image() method of the Galaxy class.
+    plot_factor: float
+        Factor for the image range, see _calculate_images().
+    image_res: int
+        Image resolution.
+    galaxy_kwargs: dict
+        Keyword arguments passed to the Galaxy class. The halo ID is overwritten.
+    dtype: str, default="float32"
+        Storage data type of the images, see _encode_image().
+    project_volume: bool, default=False
+        If True and both 2D and 3D images are saved, only the 3D images are rendered and the 2D images are obtained by
+        projecting them, see the get_projected_images() method of the Galaxy class.
+    save_orientation: bool, default=True
+        Whether to save the rotation matrix, centre and halo ID of the galaxy in the "Orientation" group.
+    save_cost: bool, default=True
+        Whether to save the number of rendered particles, the time to load, rotate and render the galaxy, the time of every stage and the peak memory
+        in the "Cost" group.
+
+    Returns
+    -------
+    tuple
+        (row, data, stats) where data is a dict with the HDF5 dataset names as keys and the values of this galaxy to save in
+        these datasets, i.e. the galaxy parameters, the orientation, the images and for quantized images their scale and offset.
+        stats is a dict with the number of particle cache hits, misses and evictions of this galaxy (see the cache.py module), the number
+        of particles passed to the render functions ("cull_particles") and how many of them were culled ("culled", see cull_particles in
+        the image.py module), the time of every stage as "time_<stage>" (see the timing.py module), the total time and the number of
+        rendered particles.
+    """
+    row, haloid, halo_kwargs = task
+    start_galaxy()
+    start = time.perf_counter()
+    cache_counts = get_cache_counts()
+    cull_counts = get_cull_counts()
+    stage_times = get_stage_times()
+    kwargs = dict(galaxy_kwargs)
+    kwargs.update(halo_kwargs)
+    kwargs["halo_id"] = haloid
+    if "fields" not in kwargs and "fields" in inspect.signature(str_to_class(simulation)).parameters:
+        # Simulation classes that support it only load the particle fields of the images
+        kwargs["fields"] = required_fields(fields)
+
+    # TODO: This loads the particle type specified in the kwargs. Need to change this to load all particle types
+    g = Galaxy(simulation=simulation, **kwargs)
+
+    # Get the galaxy parameters
+    data = dict()
+    for parameter in galaxy_parameters:
+        if hasattr(g, parameter):
+            data[f"Galaxies/Attributes/{parameter}"] = getattr(g, parameter)
+        else:
+            raise ValueError(f"Galaxy class does not have the attribute {parameter}")
+    if save_orientation:
+        data[f"{ORIENTATION_GROUP}/rotation_matrix"] = np.asarray(g.get_rotation_matrix())
+        data[f"{ORIENTATION_GROUP}/center"] = np.asarray(g.center)
+        data[f"{ORIENTATION_GROUP}/halo_id"] = haloid
+
+    # Get the particle data. All fields of one dimension are rendered together
+    groups = dict()
+    for particle_type, d, field in datasets:
+        groups.setdefault((particle_type, d), []).append(field)
+    rendered = dict()
+    for (particle_type, d), group_fields in groups.items():
+        if (particle_type, d) in rendered:
+            continue
+        group_fields = {field: fields[field] for field in group_fields}
+        if (
+            project_volume
+            and d == "dim2"
+            and groups.get((particle_type, "dim3")) == list(group_fields)
+        ):
+            # Only render the 3D images and project them to get the 2D images
+            with timed("render_dim3"):
+                (
+                    rendered[(particle_type, "dim2")],
+                    rendered[(particle_type, "dim3")],
+                ) = g.get_projected_images(group_fields, res=image_res, plotfactor=plot_factor)
+            continue
+        dim = int(d[-1])  # TODO: This is a bit hacky. Maybe change this
+        with timed(f"render_{d}"):
+            rendered[(particle_type, d)] = g.get_images(
+                group_fields,
+                dim=dim,
+                res=image_res,
+                plotfactor=plot_factor,
+            )
+    with timed("encode"):
+        for (particle_type, d), images in rendered.items():
+            for field, image in images.items():
+                image, scale, offset = _encode_image(image, dtype)
+                data[f"Galaxies/Particles/{particle_type}/Images/{d}/{field}"] = image
+                if scale is not None:
+                    quantization = _quantization_path(particle_type, d, field)
+                    data[f"{quantization}/scale"] = scale
+                    data[f"{quantization}/offset"] = offset
+    stats = {key: value - cache_counts[key] for key, value in get_cache_counts().items()}
+    cull = {key: value - cull_counts[key] for key, value in get_cull_counts().items()}
+    stats["cull_particles"] = cull["particles"]
+    stats["culled"] = cull["culled"]
+    stats.update(
+        {f"time_{stage}": value - stage_times[stage] for stage, value in get_stage_times().items()}
+    )
+    stats["time"] = time.perf_counter() - start
+    memory = stop_galaxy()
+    stats["n_particles"] = len(g.get_coordinates())
+    if save_cost:
+        data[f"{COST_GROUP}/n_particles"] = stats["n_particles"]
+        data[f"{COST_GROUP}/time"] = stats["time"]
+        data[f"{COST_GROUP}/stage_time"] = np.array([stats[f"time_{stage}"] for stage in STAGES])
+        data[f"{COST_GROUP}/process_max_rss"] = memory["process_max_rss"]
+        data[f"{COST_GROUP}/peak_traced"] = memory["peak_traced"]
+    return row, data, stats
+
+
+def _check_storage_dtype(fields, dtype):
+    """Checks that the images of all fields fit into the storage data type, before any galaxy is rendered.
+
+    float16 overflows above 65504, which images in physical units exceed for most galaxies, e.g. the surface density of the masses.
+    The images of all fields therefore need to be normalized to [0, 1] with normed=True (see the norm function of the image.py module).
+    Quantized dtypes store any range.
+
+    Parameters
+    ----------
+    fields: dict or list
+        The fields of the images, see generate_data(). Fields given as a list are not normalized.
+    dtype: str
+        Storage data type of the images.
+
+    Raises
+    ------
+    ValueError
+        If the dtype is "float16" and a field is not normalized.
+    """
+    if dtype != "float16":
+        return
+    if not isinstance(fields, dict):
+        fields = {field: {} for field in fields}
+    not_normed = [field for field, field_kwargs in fields.items() if not field_kwargs.get("normed", False)]
+    if not_normed:
+        raise ValueError(
+            f"Images stored as float16 need to be normalized, but the fields {not_normed} are not normed. "
+            "Set normed to True for these fields or use a quantized dtype."
+        )
+
+
+def _encode_image(image, dtype="float32"):
+    """Converts an image to its storage data type.
+
+    Images stored as "uint8" or "uint16" are linearly quantized between their minimum and maximum value.
+    The image is recovered as image = stored_image * scale + offset, with an absolute error of at most scale / 2.
+    This works best for normalized images, since faint pixels of images spanning several orders of magnitude are rounded to the minimum.
+
+    Parameters
+    ----------
+    image: numpy.array
+        The rendered image.
+    dtype: str, default="float32"
+        Storage data type. One of "float32", "float16", "uint8" or "uint16".
+
+    Returns
+    -------
+    tuple
+        (stored_image, scale, offset). scale and offset are None if the image is not quantized.
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"dtype should be one of {STORAGE_DTYPES}.")
+    if dtype in ["float32", "float16"]:
+        stored_image = image.astype(dtype)
+        if np.any(np.isinf(stored_image) & np.isfinite(image)):
+            raise ValueError(
+                f"Image values exceed the range of {dtype}. Use normalized images or a quantized dtype."
+            )
+        return stored_image, None, None
+
+    offset = float(image.min())
+    scale = (float(image.max()) - offset) / np.iinfo(dtype).max
+    if scale == 0:
+        # Constant image, the offset alone recovers it
+        return np.zeros(image.shape, dtype=dtype), 1.0, offset
+    stored_image = np.round((image - offset) / scale).astype(dtype)
+    return stored_image, scale, offset
+
+
+class _SlabWriter:
+    """Writes the rendered galaxies to the HDF5 file in contiguous slabs from a background thread.
+
+    Galaxies can be handed over in any order. They are buffered until batch_size consecutive rows are finished,
+    which are then written with a single write per dataset. The index_position attribute is only advanced
+    after the slab is flushed to disk, so resuming a calculation never skips a galaxy.
+
+    The writer thread is the only one accessing the HDF5 file while the writer is open. The time of every slab is split evenly across its
+    rows and saved in the "write" column of the stage times in the "Cost" group.
+
+    Parameters
+    ----------
+    f: h5py.File
+        The HDF5 file created by the _create_data_structure() method, opened in append mode.
+    start: int
+        First row to write, i.e. the index position the calculation starts from.
+    batch_size: int
+        Number of rows per slab.
+    """
+
+    def __init__(self, f, start, batch_size):
+        self.f = f
+        self.batch_size = batch_size
+        self._next_row = start  # First row that has not been handed to the writer thread
+        self.write_time = 0.0  # Time in seconds spent writing slabs
+        # Columns of the stage times in the file, which has fewer columns if it was created with fewer stages
+        self._stage_columns = None
+        self._write_column = None
+        if f"{COST_GROUP}/stage_time" in f:
+            stages = [
+                stage.decode() if isinstance(stage, bytes) else str(stage)
+                for stage in f[f"{COST_GROUP}/stage_time"].attrs["stages"]
+            ]
+            self._stage_columns = [STAGES.index(stage) for stage in stages]
+            if "write" in stages:
+                self._write_column = stages.index("write")
+        self._pending = dict()  # Finished rows that are not yet part of a slab
+        self._error = None
+        # Allow one slab waiting in the queue, while the thread writes the other
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, row, data):
+        """Adds a rendered galaxy and hands over all complete slabs to the writer thread.
+
+        data is a dict with the HDF5 dataset names as keys and the values of the galaxy, see _render_galaxy().
+        """
+        self._raise_error()
+        self._pending[row] = data
+        while all(
+            r in self._pending
+            for r in range(self._next_row, self._next_row + self.batch_size)
+        ):
+            self._submit(self.batch_size)
+
+    def close(self):
+        """Writes the remaining consecutive rows and waits for the writer thread to finish."""
+        n = 0
+        while self._next_row + n in self._pending:
+            n += 1
+        if n > 0 and self._error is None:
+            self._submit(n)
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _submit(self, n):
+        rows = [self._pending.pop(r) for r in range(self._next_row, self._next_row + n)]
+        self._queue.put((self._next_row, rows))
+        self._next_row += n
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Writing to the HDF5 file failed.") from self._error
+
+    def _run(self):
+        while True:
+            slab = self._queue.get()
+            if slab is None:
+                return
+            # After an error keep emptying the queue, so the rendering loop is not blocked
+            if self._error is not None:
+                continue
+            try:
+                self._write(*slab)
+            except Exception as error:
+                self._error = error
+
+    def _write(self, start, rows):
+        write_start = time.perf_counter()
+        stop = start + len(rows)
+        for name in rows[0]:
+            values = np.stack([row[name] for row in rows])
+            if name == f"{COST_GROUP}/stage_time":
+                values = values[:, self._stage_columns]
+            self.f[name][start:stop] = values
+        # Make sure the data is on disk before the index position is advanced
+        self.f.flush()
+        slab_time = time.perf_counter() - write_start
+        self.write_time += slab_time
+        if self._write_column is not None and f"{COST_GROUP}/stage_time" in rows[0]:
+            self.f[f"{COST_GROUP}/stage_time"][start:stop, self._write_column] = slab_time / len(rows)
+        self.f.attrs["index_position"] = stop
+        self.f.flush()
+
+
+def _tasks(simulation, halo_ids, index_position, fields, rotations=None, bulk_read=False, order="cost", order_window=256, **kwargs):
+    """Creates the tasks for _render_galaxy() of all galaxies from the index position on.
+
+    If the simulation class defines a load_catalog classmethod, the catalog data of all galaxies is loaded at once and every task gets the part of its galaxy.
+    If it defines a particle_counts classmethod, the number of particles of every galaxy is predicted from the catalog. With order="cost", the
+    galaxies of every block of order_window rows are handed out with the largest galaxy first (longest processing time first), so the workers
+    do not wait for a few large galaxies at the end of a block. Blocks are handed out in the order of the rows, which limits the number of finished
+    galaxies the writer keeps in memory until the rows before them are done.
+
+    With bulk_read and an iter_particles classmethod of the simulation class, the particles are loaded here in the order the class yields them
+    (the order of the snapshot for IllustrisTNG, galaxies in the particle cache first, without particles) and every task carries the particles
+    of its galaxy. This is meant for a single process (workers=1), see _calculate_images(). The order argument is ignored in this case.
+    The halo IDs should be sorted like the snapshot (e.g. by ID for IllustrisTNG), otherwise the finished galaxies are kept in memory until the
+    galaxies before them are done.
+
+    Parameters
+    ----------
+    simulation: str
+        Simulation name, used to get the simulation class.
+    halo_ids: list
+        List of halo IDs of all galaxies.
+    index_position: int
+        First row to calculate.
+    fields: dict
+        Dictionary of the fields to be saved.
+    rotations: dict, default=None
+        Rotation matrices of an earlier run with the halo IDs as keys, see _load_rotations().
+    bulk_read: bool, default=False
+        Whether to load the particles of all galaxies in one sweep.
+    order: str, default="cost"
+        Either "cost" to hand out the largest galaxies of every block first or "index" to hand out the galaxies in the order of the rows.
+    order_window: int, default=256
+        Number of rows per block of the "cost" order.
+    **kwargs: dict
+        Keyword arguments of the Galaxy class.
+
+    Returns
+    -------
+    tuple
+        (tasks, predicted) where tasks is a generator of (row, haloid, halo_kwargs) tuples, see _render_galaxy(), and predicted is a dict
+        with the predicted number of particles of every row. predicted is empty if the simulation class can not predict them.
+    """
+    if order not in SCHEDULE_ORDERS:
+        raise ValueError(f"order should be one of {SCHEDULE_ORDERS}.")
+    if order_window < 1:
+        raise ValueError("order_window should be at least 1.")
+    if rotations is None:
+        rotations = dict()
+    simulation_class = str_to_class(simulation)
+    remaining = halo_ids[index_position:]
+    catalog = None
+    if hasattr(simulation_class, "load_catalog") and len(remaining) > 0:
+        # Load the catalog rows of all galaxies at once, so the galaxies do not read the catalog
+        catalog = simulation_class.load_catalog(remaining, **kwargs)
+    predicted = dict()
+    if hasattr(simulation_class, "particle_counts") and len(remaining) > 0:
+        counts = simulation_class.particle_counts(remaining, catalog=catalog, **kwargs)
+        predicted = {row: int(count) for row, count in enumerate(counts, start=index_position)}
+
+    def task(row, halo_kwargs):
+        haloid = halo_ids[row]
+        if int(haloid) in rotations:
+            halo_kwargs["rotation_matrix"] = rotations[int(haloid)]
+        if catalog is not None:
+            # Only send the row of this galaxy to the worker
+            halo_kwargs["catalog"] = catalog.select([haloid])
+        return row, haloid, halo_kwargs
+
+    def ordered_tasks():
+        rows = list(range(index_position, len(halo_ids)))
+        if order == "cost" and predicted:
+            rows = [
+                row
+                for start in range(0, len(rows), order_window)
+                for row in sorted(rows[start : start + order_window], key=lambda row: -predicted[row])
+            ]
+        for row in rows:
+            yield task(row, dict())
+
+    def bulk_tasks():
+        rows = dict()
+        for row in range(index_position, len(halo_ids)):
+            rows.setdefault(int(halo_ids[row]), []).append(row)
+        particle_kwargs = dict(kwargs)
+        particle_kwargs.setdefault("fields", required_fields(fields))
+        for haloid, halo_kwargs in simulation_class.iter_particles(
+            np.array(list(rows)), catalog=catalog, **particle_kwargs
+        ):
+            for row in rows[int(haloid)]:
+                yield task(row, dict(halo_kwargs))
+
+    if bulk_read and hasattr(simulation_class, "iter_particles"):
+        return bulk_tasks(), predicted
+    return ordered_tasks(), predicted
+
+
+class _TaskLimiter:
+    """Limits the galaxies handed to the worker pool by their number and their predicted memory.
+
+    A galaxy is admitted if fewer than max_tasks galaxies are in progress and the predicted memory of all galaxies in progress stays
+    within the memory budget. A galaxy that alone exceeds the budget is admitted once no other galaxy is in progress.
+
+    Parameters
+    ----------
+    max_tasks: int
+        Maximum number of galaxies in progress.
+    memory_budget: float, optional
+        Maximum predicted memory of the galaxies in progress in bytes. If None, only the number of galaxies is limited.
+    """
+
+    def __init__(self, max_tasks, memory_budget=None):
+        self.max_tasks = max_tasks
+        self.memory_budget = memory_budget
+        self._running = dict()  # Predicted memory of the rows in progress
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _admits(self, memory):
+        if self._closed or not self._running:
+            return True
+        if len(self._running) >= self.max_tasks:
+            return False
+        return self.memory_budget is None or sum(self._running.values()) + memory <= self.memory_budget
+
+    def acquire(self, row, memory):
+        """Waits until the galaxy of the row can be started."""
+        with self._condition:
+            self._condition.wait_for(lambda: self._admits(memory))
+            self._running[row] = memory
+
+    def release(self, row):
+        """Marks the galaxy of the row as finished."""
+        with self._condition:
+            self._running.pop(row, None)
+            self._condition.notify_all()
+
+    def close(self):
+        """Admits all waiting galaxies, so the task handler of the pool can be terminated."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+def _limited(tasks, limiter, memory):
+    """Yields the tasks, but waits until the limiter admits the galaxy of each task. memory maps the rows to their predicted memory."""
+    for task in tasks:
+        limiter.acquire(task[0], memory(task[0]))
+        yield task
 
 
 def _calculate_images(
@@ -109,6 +752,16 @@ def _calculate_images(
     image_res,
     path="./",
     resume=None,
+    workers=1,
+    filename="galaxy_data.hdf5",
+    batch_size=16,
+    project_volume=False,
+    rotations=None,
+    bulk_read=False,
+    order="cost",
+    order_window=256,
+    memory_budget=None,
+    memory_per_particle=MEMORY_PER_PARTICLE,
     **kwargs,
 ):
     """Calculates the images for the galaxies and saves them to the HDF5 file
@@ -130,18 +783,62 @@ def _calculate_images(
         Path to the HDF5 file to save the data to. This file should be created using create_data_structure() method.
     resume: int, default=None
         Flag to resume the calculation from the last halo ID. If None, the calculation starts from the first halo ID in the list.
+    workers: int, default=1
+        Number of worker processes. If larger than 1, loading, rotating and rendering the galaxies is done in a
+        multiprocessing pool, while this process is the only one writing to the HDF5 file. Results are written to
+        the row of their halo ID, independent of the order in which the workers finish.
+    filename: str, default="galaxy_data.hdf5"
+        Name of the HDF5 file in path.
+    batch_size: int, default=16
+        Number of galaxies that are buffered and written as one contiguous slab per dataset by a background thread.
+        The index position used to resume the calculation is only advanced after a slab is flushed to the file.
+    project_volume: bool, default=False
+        If True and both 2D and 3D images are saved, the 2D images are obtained by projecting the 3D images along the line of sight
+        instead of rendering them separately.
+    rotations: dict, default=None
+        Rotation matrices of an earlier run with the halo IDs as keys, see _load_rotations(). Galaxies with a rotation matrix are
+        only rotated with it, all other galaxies are aligned by the Galaxy class.
+    bulk_read: bool, default=False
+        If True and the simulation class defines iter_particles, the particles of all galaxies are read by this process in a single sweep over
+        the snapshot, see _tasks(). The galaxies are then rendered in the order of the snapshot. Only supported with workers=1, since the
+        sweep runs in this process; with several workers every worker reads its own galaxies in parallel instead.
+    order: str, default="cost"
+        Order in which the galaxies are handed to the workers, either "cost" (largest galaxies of every block of order_window rows first,
+        if the simulation class can predict the number of particles) or "index". See _tasks(). The rows of the HDF5 file do not depend on the order.
+    order_window: int, default=256
+        Number of rows per block of the "cost" order.
+    memory_budget: float, default=None
+        Maximum predicted memory in GB of the galaxies rendered at the same time by the workers. The memory of a galaxy is predicted as
+        memory_per_particle times its number of particles. If None, only the number of galaxies in progress is limited.
+    memory_per_particle: float, default=MEMORY_PER_PARTICLE
+        Predicted peak memory of a worker per particle of a galaxy in bytes.
     **kwargs: dict
         Keyword arguments passed to the Galaxy class. Halo ID and particle type are overwritten in the loop.
+
+    The predicted number of particles and the measured number of particles, time, stage times and peak memory of every galaxy are saved in the
+    "Cost" group. At the end of the run the time of every stage, the throughput and a linear model of the time are printed. Set the MEGS_PROFILE
+    environment variable to trace the memory or profile the workers, see the timing.py module.
     """
     # Check if the HDF5 file exists, which should be created using create_data_structure() method.
-    if not os.path.exists(os.path.join(path, "galaxy_data.hdf5")):
+    if not os.path.exists(os.path.join(path, filename)):
         raise FileNotFoundError(
-            f"{os.path.join(path, 'galaxy_data.hdf5')} does not exist. This should have been created using the _create_data_structure() method."
+            f"{os.path.join(path, filename)} does not exist. This should have been created using the _create_data_structure() method."
         )
+    if workers < 1:
+        raise ValueError("workers should be at least 1.")
+    if bulk_read and workers > 1:
+        # The sweep runs in this process and would send every galaxy's particles through the pool
+        raise ValueError("bulk_read reads the particles of all galaxies in this process and is only supported with workers=1.")
+    # Check the MEGS_PROFILE environment variable before starting the workers
+    profile_options()
+    if batch_size < 1:
+        raise ValueError("batch_size should be at least 1.")
 
     n_galaxies = len(halo_ids)
     # Open the HDF5 file in "append" mode
-    with h5py.File(os.path.join(path, "galaxy_data.hdf5"), "a") as f:
+    with h5py.File(os.path.join(path, filename), "a") as f:
+        # The images are encoded with the dtype of the file, e.g. of a file that is resumed
+        _check_storage_dtype(fields, f.attrs.get("dtype", "float32"))
         # Check if the "index_position" attribute exists
         if "index_position" in f.attrs:
             index_position = f.attrs["index_position"]
@@ -178,54 +875,156 @@ def _calculate_images(
         print(
             f"Starting to calculate data from index position {index_position} out of {n_galaxies} galaxies."
         )
-        # Loop through the galaxies
-        for index, haloid in enumerate(tqdm(halo_ids[index_position:])):
-            # Create the galaxy object
-            kwargs["halo_id"] = haloid
-
-            # TODO: This loads the particle type specified in the kwargs. Need to change this to load all particle types
-            g = Galaxy(simulation=simulation, **kwargs)
-
-            # Get the galaxy parameters
-            for parameter in f["Galaxies/Attributes"].keys():
-                if hasattr(g, parameter):
-                    f["Galaxies/Attributes"][parameter][index] = getattr(g, parameter)
-                else:
-                    raise ValueError(
-                        f"Galaxy class does not have the attribute {parameter}"
-                    )
 
-            # Get the particle data
-            for particle_type in f["Galaxies"]["Particles"].keys():
-                # loop thorugh the dimensions
-                for d in f["Galaxies"]["Particles"][particle_type]["Images"].keys():
-                    # loop through the fields
-                    for field in f["Galaxies"]["Particles"][particle_type]["Images"][
-                        d
-                    ].keys():
-                        # Get the image
-                        dim = int(d[-1])  # TODO: This is a bit hacky. Maybe change this
-                        image = g.get_image(
-                            field=field,
-                            plotfactor=plot_factor,
-                            res=image_res,
-                            dim=dim,
-                            **fields[field],
-                        )
-                        f["Galaxies"]["Particles"][particle_type]["Images"][d][field][
-                            index
-                        ] = image
+        datasets = _image_datasets(f)
+        # Files created before the cost was saved do not have the group
+        save_cost = COST_GROUP in f
+        render = partial(
+            _render_galaxy,
+            simulation=simulation,
+            datasets=datasets,
+            galaxy_parameters=list(f["Galaxies/Attributes"].keys()),
+            fields=fields,
+            plot_factor=plot_factor,
+            image_res=image_res,
+            galaxy_kwargs=kwargs,
+            dtype=f.attrs.get("dtype", "float32"),
+            project_volume=project_volume,
+            # Files created before the orientation was saved do not have the group
+            save_orientation=ORIENTATION_GROUP in f,
+            save_cost=save_cost,
+        )
+        tasks, predicted = _tasks(
+            simulation,
+            halo_ids,
+            index_position,
+            fields,
+            rotations=rotations,
+            bulk_read=bulk_read,
+            order=order,
+            order_window=order_window,
+            **kwargs,
+        )
+        n_tasks = n_galaxies - index_position
 
-            # Update the index position
-            f.attrs["index_position"] += 1
+        pool = None
+        # Limits the tasks the pool takes from the tasks generator, so the large galaxies rendered at the same time fit into the memory budget
+        limiter = _TaskLimiter(
+            4 * workers, memory_budget=None if memory_budget is None else memory_budget * 1024**3
+        )
+        if workers > 1:
+            pool = multiprocessing.Pool(processes=workers)
+            results = pool.imap_unordered(
+                render, _limited(tasks, limiter, lambda row: predicted.get(row, 0) * memory_per_particle)
+            )
+        else:
+            results = map(render, tasks)
 
+        writer = _SlabWriter(f, start=index_position, batch_size=batch_size)
+        totals = dict()
+        costs = []
+        memory = {"process_max_rss": -1, "peak_traced": -1}
+        run_start = time.perf_counter()
+        try:
+            # Loop through the galaxies. The writer thread writes the slabs while the next galaxies are rendered
+            for row, data, stats in tqdm(results, total=n_tasks):
+                limiter.release(row)
+                costs.append((predicted.get(row, -1), stats["time"]))
+                if save_cost:
+                    data[f"{COST_GROUP}/predicted_particles"] = predicted.get(row, -1)
+                    for key in memory:
+                        memory[key] = max(memory[key], data[f"{COST_GROUP}/{key}"])
+                writer.put(row, data)
+                for key, value in stats.items():
+                    totals[key] = totals.get(key, 0) + value
+        finally:
+            if pool is not None:
+                # Unblock the task handler of the pool, so it can be terminated
+                limiter.close()
+                pool.terminate()
+                pool.join()
+            # Write all galaxies that are finished without gaps, also if the loop was interrupted
+            writer.close()
+
+        if totals.get("hits", 0) + totals.get("misses", 0) > 0:
+            print(
+                f"Particle cache: {totals['hits']} hits, {totals['misses']} misses, {totals['evictions']} evicted halos."
+            )
+        if totals.get("cull_particles", 0) > 0:
+            print(
+                f"Culling: {totals['culled']} of {totals['cull_particles']} particles "
+                f"({100 * totals['culled'] / totals['cull_particles']:.1f}%) did not overlap the images and were not rendered."
+            )
+        _print_timing(totals, len(costs), time.perf_counter() - run_start, writer.write_time, memory)
+        _print_cost_model(costs)
+        if "cprofile" in profile_options():
+            print(f"cProfile statistics of every process written to {profile_path('<pid>')}.")
         # Show the user that the images have been calculated
         print(
             "Images calculated and saved to HDF5 file: ",
-            os.path.join(path, "galaxy_data.hdf5"),
+            os.path.join(path, filename),
         )
 
 
+def _print_timing(totals, n_galaxies, wall_time, write_time, memory):
+    """Prints the time of every stage summed over all galaxies, the throughput and the peak memory of a run.
+
+    Parameters
+    ----------
+    totals: dict
+        The stats of _render_galaxy() summed over all galaxies.
+    n_galaxies: int
+        Number of rendered galaxies.
+    wall_time: float
+        Wall time of the run in seconds.
+    write_time: float
+        Time in seconds the writer thread spent writing to the HDF5 file, see _SlabWriter. It is listed as the "write" stage, and the
+        fractions of the stages are relative to the time of all galaxies plus the write time.
+    memory: dict
+        The largest "process_max_rss" (resident set size of a worker process) and "peak_traced" (memory allocated for a single galaxy)
+        of all galaxies in bytes, -1 if unknown.
+    """
+    if n_galaxies == 0 or wall_time <= 0:
+        return
+    # The write stage runs in the writer thread and is not part of the time of the galaxies
+    stage_times = {stage: totals.get(f"time_{stage}", 0.0) for stage in STAGES}
+    stage_times["write"] = write_time
+    total = totals.get("time", 0.0) + write_time
+    print(
+        f"Rendered {n_galaxies} galaxies in {wall_time:.1f} s: {n_galaxies / wall_time:.3g} galaxies/s, "
+        f"{totals.get('n_particles', 0) / wall_time:.3g} particles/s."
+    )
+    print(f"{'stage':<12} {'time [s]':>10} {'fraction':>9}")
+    for stage in STAGES:
+        note = "   (writer thread, overlaps the rendering)" if stage == "write" else ""
+        print(f"{stage:<12} {stage_times[stage]:>10.2f} {stage_times[stage] / total if total > 0 else 0:>9.1%}{note}")
+    other = total - sum(stage_times.values())
+    print(f"{'other':<12} {other:>10.2f} {other / total if total > 0 else 0:>9.1%}")
+    if memory["process_max_rss"] > 0:
+        print(f"Maximum resident memory of a worker process: {memory['process_max_rss'] / 1024**3:.2f} GB.")
+    if memory["peak_traced"] > 0:
+        print(f"Largest memory allocated for a single galaxy: {memory['peak_traced'] / 1024**3:.2f} GB.")
+
+
+def _print_cost_model(costs):
+    """Fits and prints the time per galaxy as a linear function of the predicted number of particles.
+
+    Parameters
+    ----------
+    costs: list
+        List of (predicted_particles, time) tuples of the rendered galaxies. Galaxies without a prediction (-1) are ignored.
+    """
+    costs = np.array([cost for cost in costs if cost[0] >= 0], dtype=np.float64).reshape(-1, 2)
+    if len(costs) < 2 or np.ptp(costs[:, 0]) == 0:
+        return
+    slope, intercept = np.polyfit(costs[:, 0], costs[:, 1], 1)
+    correlation = np.corrcoef(costs[:, 0], costs[:, 1])[0, 1]
+    print(
+        f"Cost model: {slope * 1e6:.3g} s per million particles + {intercept:.3g} s per galaxy "
+        f"(correlation {correlation:.2f}, {len(costs)} galaxies). See the {COST_GROUP} group for every galaxy."
+    )
+
+
 # TODO: Maybe specify all the parameters in a seperate JSON file and load them in the function. Maybe more convenient for the user.
 def generate_data(
     simulation,
@@ -239,6 +1038,14 @@ def generate_data(
     resume=None,
     path="./",
     dim=None,
+    workers=1,
+    shard=None,
+    batch_size=16,
+    storage=None,
+    project_volume=False,
+    rotation_file=None,
+    bulk_read=False,
+    schedule=None,
     **kwargs,
 ):
     """
@@ -255,7 +1062,8 @@ def generate_data(
         List of halo IDs to calculate the images for. The halo_ids are used to load the galaxy data from the simulation.
     fields: dict
         Dictionary of fields to be saved, where the key is the field name. The values of the dictionary are passed to the get_image() method of the Galaxy class.
-        For more information on the fields see the get_image() method of the Galaxy class.
+        For more information on the fields see the get_image() method of the Galaxy class. Derived fields are given by an expression of particle fields
+        as name or in the "expression" value, e.g. {"log_metallicity": {"expression": "log10(GFM_Metallicity)"}}, see the fields.py module.
     plot_factor: float
         Factor for the image range. The image range is calculated as halfmass_radius*plot_factor and the image is centred on the galaxy centre.
         For the halfmass_radius only the particle type specified in the particle_type argument are used.
@@ -263,6 +1071,30 @@ def generate_data(
         Path to the HDF5 file to save the data to. This file should be created using create_data_structure() method.
     dim: int, default = None
         Dimension of the images to be calculated. If None, both 2D and 3D images are calculated. Set to 2 or 3 to calculate only 2D or 3D images.
+    workers: int, default = 1
+        Number of worker processes used to load, rotate and render the galaxies. The HDF5 file is only written by the calling process.
+    shard: tuple, default = None
+        Tuple (k, K) to only render the k-th of K contiguous slices of the halo IDs into the file galaxy_data_shard_k_of_K.hdf5.
+        This way K jobs, e.g. of a batch array, can run on different nodes without sharing a file. Combine the shards with merge_shards() afterwards.
+    batch_size: int, default = 16
+        Number of galaxies written to the HDF5 file at once by a background thread, see _calculate_images().
+    storage: dict, default = None
+        Storage layout of the image datasets with the keys "chunks", "compression", "compression_opts", "shuffle" and "dtype".
+        Missing keys use the defaults of _create_data_structure(), i.e. one uncompressed chunk per galaxy.
+        e.g. {"chunks": "galaxy", "compression": "gzip", "compression_opts": 4, "shuffle": True, "dtype": "uint16"}
+    project_volume: bool, default = False
+        If True and dim is None, only the 3D images are rendered and the 2D images are obtained by projecting them along the line of sight.
+    rotation_file: str, default = None
+        Path to the HDF5 file of an earlier run. The galaxies saved in its "Orientation" group are rotated with their saved rotation matrix
+        instead of being aligned again, e.g. to re-render a catalog with a different image_res or plot_factor. Galaxies not found in the file are aligned as usual.
+    bulk_read: bool, default = False
+        If True, the particles of all galaxies are read in a single sweep over the snapshot files instead of one read per galaxy, if the simulation class
+        supports it (see IllustrisTNG.iter_particles). The halo IDs should be sorted like the snapshot, e.g. by ID as returned by select_illustris_galaxies().
+        Only supported with workers=1.
+    schedule: dict, default = None
+        Scheduling of the galaxies on the workers with the keys "order", "order_window", "memory_budget" (in GB) and "memory_per_particle" (in bytes).
+        Missing keys use the defaults of _calculate_images(), i.e. the largest galaxies of every 256 rows first and no memory budget.
+        e.g. {"order": "cost", "memory_budget": 64}
     **kwargs: dict
         Keyword arguments passed to the Galaxy class. Halo ID and particle type are overwritten in the loop.
         e.g. {"base_path":basePath,"halo_id":0,"particle_type": "stars", "snapshot":99} for IllustrisTNG
@@ -297,6 +1129,10 @@ def generate_data(
         │   ├── Attributes: Group
         │   │   ├── mass: (10,)
         │   │   └── halo_id: (10,)
+        │   ├── Orientation: Group
+        │   │   ├── rotation_matrix: (10, 3, 3)
+        │   │   ├── center: (10, 3)
+        │   │   └── halo_id: (10,)
         │   └── Particles: Group
         │       ├── gas: Group
         │       │   └── Images: Group
@@ -333,27 +1169,46 @@ def generate_data(
     
     This data file is later used to build the morphology model.
     """
+    filename = "galaxy_data.hdf5"
+    attrs = None
+    if shard is not None:
+        # Only render the slice of the halo IDs that belongs to this shard into its own file
+        shard_index, n_shards = shard
+        start, stop = _shard_slice(len(halo_ids), shard_index, n_shards)
+        attrs = {
+            "shard_index": shard_index,
+            "n_shards": n_shards,
+            "shard_start": start,
+            "n_galaxies_total": len(halo_ids),
+        }
+        halo_ids = halo_ids[start:stop]
+        filename = _shard_filename(shard_index, n_shards)
+
     n_galaxies = len(halo_ids)
+    structure_kwargs = dict(
+        n_galaxies=n_galaxies,
+        image_res=image_res,
+        galaxy_parameters=galaxy_parameters,
+        particle_types=particle_types,
+        fields=fields,
+        path=path,
+        dim=dim,
+        filename=filename,
+        attrs=attrs,
+        **(storage if storage is not None else {}),
+    )
 
     # If File does not exist, create it
-    if not os.path.exists(os.path.join(path, "galaxy_data.hdf5")):
+    if not os.path.exists(os.path.join(path, filename)):
         # Create the HDF5 file and the data structure
-        _create_data_structure(
-            n_galaxies=n_galaxies,
-            image_res=image_res,
-            galaxy_parameters=galaxy_parameters,
-            particle_types=particle_types,
-            fields=fields,
-            path=path,
-            dim=dim,
-        )
+        _create_data_structure(**structure_kwargs)
     else:
         # Check if overwrite Flag is set
         if overwrite is None:
             # Ask if the file should be overwritten
             if (
                 input(
-                    f"The file {os.path.join(path,'galaxy_data.hdf5')} already exists. Do you want to overwrite it? (y/n)"
+                    f"The file {os.path.join(path, filename)} already exists. Do you want to overwrite it? (y/n)"
                 )
                 == "y"
             ):
@@ -361,19 +1216,11 @@ def generate_data(
         if overwrite is True:
             print(
                 "Overwriting the existing file: ",
-                os.path.join(path, "galaxy_data.hdf5"),
-            )
-            _create_data_structure(
-                n_galaxies=n_galaxies,
-                image_res=image_res,
-                galaxy_parameters=galaxy_parameters,
-                particle_types=particle_types,
-                fields=fields,
-                path=path,
-                dim=dim,
+                os.path.join(path, filename),
             )
+            _create_data_structure(**structure_kwargs)
         else:
-            print("Loading the existing file: ", os.path.join(path, "galaxy_data.hdf5"))
+            print("Loading the existing file: ", os.path.join(path, filename))
     # Calculate the images
     _calculate_images(
         simulation,
@@ -383,15 +1230,205 @@ def generate_data(
         image_res,
         path,
         resume=resume,
+        workers=workers,
+        filename=filename,
+        batch_size=batch_size,
+        project_volume=project_volume,
+        rotations=None if rotation_file is None else _load_rotations(rotation_file),
+        bulk_read=bulk_read,
+        **(schedule if schedule is not None else {}),
         **kwargs,
     )
 
 
+def _load_rotations(filename):
+    """Loads the rotation matrices of the galaxies saved in an HDF5 file created by generate_data().
+
+    Only the galaxies before the "index_position" of the file are used, since the rows after it are not written yet.
+
+    Parameters
+    ----------
+    filename: str
+        Path to the HDF5 file.
+
+    Returns
+    -------
+    dict
+        Dictionary with the halo IDs as keys and the (3, 3) rotation matrices as values.
+    """
+    with h5py.File(filename, "r") as f:
+        if ORIENTATION_GROUP not in f:
+            raise ValueError(f"{filename} does not contain the rotation matrices of the galaxies.")
+        n_finished = f.attrs.get("index_position", 0)
+        halo_ids = f[f"{ORIENTATION_GROUP}/halo_id"][:n_finished]
+        rotation_matrices = f[f"{ORIENTATION_GROUP}/rotation_matrix"][:n_finished]
+    return {int(halo_id): matrix for halo_id, matrix in zip(halo_ids, rotation_matrices)}
+
+
+def _shard_filename(shard_index, n_shards):
+    """Name of the HDF5 file of shard shard_index out of n_shards."""
+    return f"galaxy_data_shard_{shard_index}_of_{n_shards}.hdf5"
+
+
+def _shard_slice(n_galaxies, shard_index, n_shards):
+    """Start and stop index of the halo IDs rendered by a shard.
+
+    The halo IDs are split in n_shards contiguous blocks whose lengths differ by at most one,
+    so the shards can be concatenated in shard order by merge_shards().
+
+    Parameters
+    ----------
+    n_galaxies: int
+        Total number of galaxies.
+    shard_index: int
+        Index of the shard, 0 <= shard_index < n_shards.
+    n_shards: int
+        Number of shards.
+
+    Returns
+    -------
+    tuple
+        (start, stop) so that halo_ids[start:stop] is the slice of the shard.
+    """
+    if n_shards < 1:
+        raise ValueError("n_shards should be at least 1.")
+    if not 0 <= shard_index < n_shards:
+        raise ValueError(f"shard_index should be between 0 and {n_shards - 1}.")
+    size, remainder = divmod(n_galaxies, n_shards)
+    start = shard_index * size + min(shard_index, remainder)
+    stop = start + size + (1 if shard_index < remainder else 0)
+    return start, stop
+
+
+def merge_shards(path, n_shards, virtual=False, overwrite=None):
+    """Merges the shard files of a sharded run into one galaxy_data.hdf5 file.
+
+    The shard files are only read, never rewritten. Every dataset of the shards is concatenated along the galaxy axis
+    in shard order, giving the same layout as a run without shards, which can be loaded with the Gamma class.
+
+    Parameters
+    ----------
+    path: str
+        Path to the directory containing the shard files. The merged file is saved in the same directory.
+    n_shards: int
+        Number of shards of the run.
+    virtual: bool, default=False
+        If True, the merged file contains HDF5 virtual datasets pointing to the shard files instead of a copy of the data.
+        The shard files then need to stay next to the merged file.
+    overwrite: bool, optional
+        Whether to overwrite an existing galaxy_data.hdf5 file. If None, the user is asked.
+
+    Example
+    -------
+    Render the halo IDs in four batch jobs with generate_data(..., shard=(k, 4)) for k = 0, 1, 2, 3 and merge them afterwards:
+
+    >>> merge_shards("./", n_shards=4, virtual=True)
+    """
+    shard_files = [
+        os.path.join(path, _shard_filename(k, n_shards)) for k in range(n_shards)
+    ]
+    for shard_file in shard_files:
+        if not os.path.exists(shard_file):
+            raise FileNotFoundError(f"Shard file {shard_file} does not exist.")
+
+    merged_file = os.path.join(path, "galaxy_data.hdf5")
+    if os.path.exists(merged_file):
+        if overwrite is None:
+            overwrite = (
+                input(
+                    f"The file {merged_file} already exists. Do you want to overwrite it? (y/n)"
+                )
+                == "y"
+            )
+        if not overwrite:
+            print("Keeping the existing file: ", merged_file)
+            return
+
+    shards = [h5py.File(shard_file, "r") for shard_file in shard_files]
+    try:
+        # Check that all shards are finished and belong to the same run
+        n_total = shards[0].attrs["n_galaxies_total"]
+        for k, shard in enumerate(shards):
+            start, stop = _shard_slice(n_total, k, n_shards)
+            if shard.attrs["shard_index"] != k or shard.attrs["n_shards"] != n_shards:
+                raise ValueError(f"{shard_files[k]} is not shard {k} of {n_shards}.")
+            if shard.attrs["n_galaxies_total"] != n_total:
+                raise ValueError(
+                    f"{shard_files[k]} belongs to a run with a different number of galaxies."
+                )
+            if shard.attrs.get("index_position", 0) < stop - start:
+                raise ValueError(
+                    f"{shard_files[k]} is not finished yet ({shard.attrs.get('index_position', 0)} of {stop - start} galaxies)."
+                )
+
+        # Collect the names of all datasets in the shards
+        datasets = []
+        shards[0].visititems(
+            lambda name, obj: datasets.append(name)
+            if isinstance(obj, h5py.Dataset)
+            else None
+        )
+
+        with h5py.File(merged_file, "w") as f:
+            for key, value in shards[0].attrs.items():
+                if key not in ["shard_index", "n_shards", "shard_start"]:
+                    f.attrs[key] = value
+            f.attrs["index_position"] = n_total
+
+            for name in datasets:
+                dataset = shards[0][name]
+                shape = (n_total,) + dataset.shape[1:]
+                if virtual:
+                    layout = h5py.VirtualLayout(shape=shape, dtype=dataset.dtype)
+                    for k, shard in enumerate(shards):
+                        start, stop = _shard_slice(n_total, k, n_shards)
+                        # Use the relative path, so the merged file can be moved together with the shards
+                        layout[start:stop] = h5py.VirtualSource(
+                            os.path.basename(shard_files[k]),
+                            name,
+                            shape=shard[name].shape,
+                        )
+                    f.create_virtual_dataset(name, layout)
+                else:
+                    merged = f.create_dataset(
+                        name,
+                        shape=shape,
+                        dtype=dataset.dtype,
+                        maxshape=None if dataset.chunks is None else (None,) * len(shape),
+                        chunks=dataset.chunks,
+                        compression=dataset.compression,
+                        compression_opts=dataset.compression_opts,
+                        shuffle=dataset.shuffle,
+                    )
+                    # Copy in blocks of rows to keep the memory usage bounded for large 3D datasets
+                    row_bytes = max(1, dataset.dtype.itemsize * int(np.prod(shape[1:])))
+                    block = max(1, _MERGE_BLOCK_BYTES // row_bytes)
+                    for k, shard in enumerate(shards):
+                        start, stop = _shard_slice(n_total, k, n_shards)
+                        for i in range(0, stop - start, block):
+                            j = min(i + block, stop - start)
+                            merged[start + i : start + j] = shard[name][i:j]
+                for key, value in dataset.attrs.items():
+                    f[name].attrs[key] = value
+    finally:
+        for shard in shards:
+            shard.close()
+
+    print(f"Merged {n_shards} shards into HDF5 file: ", merged_file)
+
+
 def main():
     # Parse the command line arguments
     parser = argparse.ArgumentParser(
         description="Generate the data for the morphology model."
     )
+    parser.add_argument(
+        "command",
+        help="generate: render the galaxies (default). merge: combine the shard files of a sharded run into one file.",
+        nargs="?",
+        choices=["generate", "merge"],
+        default="generate",
+    )
     parser.add_argument(
         "--config," "-c",
         help="Path to the configuration file",
@@ -412,6 +1449,40 @@ def main():
         type=bool,
         dest="resume",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        help="Number of worker processes used to render the galaxies.",
+        type=int,
+        default=1,
+        dest="workers",
+    )
+    parser.add_argument(
+        "--batch-size",
+        "-b",
+        help="Number of galaxies written to the HDF5 file at once.",
+        type=int,
+        default=16,
+        dest="batch_size",
+    )
+    parser.add_argument(
+        "--shard-index",
+        help="Index k of the shard to render, 0 <= k < n_shards. Requires --n-shards.",
+        type=int,
+        dest="shard_index",
+    )
+    parser.add_argument(
+        "--n-shards",
+        help="Number of shards the halo IDs are split into.",
+        type=int,
+        dest="n_shards",
+    )
+    parser.add_argument(
+        "--virtual",
+        help="Merge the shards into HDF5 virtual datasets instead of copying the data.",
+        action="store_true",
+        dest="virtual",
+    )
     args = parser.parse_args()
     # Load the configuration file
     try:
@@ -437,6 +1508,21 @@ def main():
                 "The configuration file does not contain the required parameter: ", key
             )
 
+    if args.command == "merge":
+        if args.n_shards is None:
+            raise ValueError("--n-shards is required to merge the shards.")
+        merge_shards(
+            path=config["path"],
+            n_shards=args.n_shards,
+            virtual=args.virtual,
+            overwrite=args.overwrite,
+        )
+        return
+
+    if (args.shard_index is None) != (args.n_shards is None):
+        raise ValueError("--shard-index and --n-shards need to be set together.")
+    shard = None if args.n_shards is None else (args.shard_index, args.n_shards)
+
     # Check if halo_ids in the configuration file is a list
     if (
         isinstance(config["halo_ids"], list)
@@ -494,6 +1580,11 @@ def main():
         ]  # List of galaxy parameters to be saved
         fields = config["fields"]  # Dictionary of fields to be saved
         dim = config["dim"]
+        storage = config.get("storage")  # Optional storage layout of the image datasets
+        project_volume = config.get("project_volume", False)  # Optional projection of the 3D images
+        rotation_file = config.get("rotation_file")  # Optional HDF5 file of an earlier run with the rotation matrices
+        bulk_read = config.get("bulk_read", False)  # Optional single sweep over the snapshot
+        schedule = config.get("schedule")  # Optional order and memory budget of the workers
         kwargs = config["GalaxyArgs"]  # Keyword arguments passed to the Galaxy class
 
     except:
@@ -515,6 +1606,14 @@ def main():
         overwrite=args.overwrite,
         resume=args.resume,
         dim=dim,
+        workers=args.workers,
+        shard=shard,
+        batch_size=args.batch_size,
+        storage=storage,
+        project_volume=project_volume,
+        rotation_file=rotation_file,
+        bulk_read=bulk_read,
+        schedule=schedule,
         **kwargs,
     )
 
@@ -8,7 +8,17 @@ The image render functions are called by the get_image function of the Galaxy cl
 import numpy as np
 
 from swiftsimio.visualisation.projection import scatter as scatter2D
+from swiftsimio.visualisation.projection import scatter_parallel as scatter2D_parallel
 from swiftsimio.visualisation.volume_render import scatter as scatter3D
+from swiftsimio.visualisation.volume_render import scatter_parallel as scatter3D_parallel
+from .kernels import (
+    scatter2D_multi,
+    scatter3D_multi,
+    scatter2D_multi_parallel,
+    scatter3D_multi_parallel,
+    kernel_gamma_2D,
+    kernel_gamma_3D,
+)
 
 import matplotlib.pyplot as plt
 import os 
@@ -16,9 +26,19 @@ from tqdm import trange, tqdm
 
 from sklearn.decomposition import PCA
 
+# Render backends of image2D and image3D. "auto" uses the parallel scatter for at least PARALLEL_THRESHOLD particles
+RENDER_BACKENDS = ["serial", "parallel", "auto"]
+PARALLEL_THRESHOLD = 100000
 
 
-def image3D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, res = 64):
+def _use_parallel(backend, n_particles, parallel_threshold):
+    '''Check if the parallel scatter should be used for the given backend and number of particles.'''
+    if backend not in RENDER_BACKENDS:
+        raise ValueError(f"backend must be one of {RENDER_BACKENDS}.")
+    return backend == "parallel" or (backend == "auto" and n_particles >= parallel_threshold)
+
+
+def image3D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, res = 64, cull = True, backend = "serial", parallel_threshold = PARALLEL_THRESHOLD):
     ''' Image Render Module for 3D images.
     
     This function renders a 3D image of the given field. The image is rendered using the scatter function from the swiftsimio.visualisation.volume_render module.
@@ -32,28 +52,45 @@ def image3D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, re
         The half mass radius of the galaxy used to set the plot range.
     weights : numpy.array
         The weights of the particles. This is the field that is rendered.
+        Several fields can be rendered in a single pass over the particles by passing an array of shape (N_particles, N_fields).
     smoothing_length : numpy.array
         The smoothing length of the particles used for the SPH kernel.    
     plot_factor : float
         The factor by which the image is zoomed in. The image is calculated for -plot_factor*R_half < x,y,z < plot_factor*R_half
     res : int
         The resolution of the image. The image is res x res pixels. The default is 64. 
+    cull : bool
+        If True, only the particles whose kernel overlaps the image cube are passed to the scatter function, see cull_particles.
+        This does not change the image. The default is True.
+    backend : str
+        The scatter implementation. "serial" uses a single core, "parallel" the multithreaded scatter, which splits the particles
+        over the numba threads, and "auto" the parallel scatter for at least parallel_threshold particles. The parallel scatter
+        only changes the order in which the contributions are summed. The default is "serial".
+    parallel_threshold : int
+        The number of particles (after culling) from which on the "auto" backend uses the parallel scatter. See exp/benchmark_render_backend.py
+        to find the crossover point on your machine. The default is PARALLEL_THRESHOLD.
 
     Returns
     -------
     numpy.array
-        The rendered image.
+        The rendered image. For two dimensional weights the images of all fields with shape (N_fields, res, res, res).
     '''
     
     plot_range = plot_factor*R_half
     
-    x = coordinates[:,0].copy()
-    y = coordinates[:,1].copy()
-    z = coordinates[:,2].copy()
-    
-    m =  weights
-    
-    h = smoothing_length.copy()
+    if cull:
+        keep = cull_particles(coordinates, smoothing_length, plot_range, res, dim = 3)
+        x = coordinates[keep,0]
+        y = coordinates[keep,1]
+        z = coordinates[keep,2]
+        m = weights[keep]
+        h = smoothing_length[keep]
+    else:
+        x = coordinates[:,0].copy()
+        y = coordinates[:,1].copy()
+        z = coordinates[:,2].copy()
+        m =  weights
+        h = smoothing_length.copy()
     
     #Transform Particles s.t -factor*r_halfmassrad < x <factor*r_halfmassrad -> 0 < x <1
     x = x/(2*plot_range) +1/2  
@@ -62,10 +99,18 @@ def image3D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, re
 
     h = h/(2*plot_range)
     
-    SPH_hist = scatter3D(x=x, y = y,z = z,h = h, m = m ,res= res)
+    if _use_parallel(backend, len(x), parallel_threshold):
+        if m.ndim == 2:
+            SPH_hist = scatter3D_multi_parallel(x, y, z, m, h, res)
+        else:
+            SPH_hist = scatter3D_parallel(x=x, y = y,z = z,h = h, m = m ,res= res)
+    elif m.ndim == 2:
+        SPH_hist = scatter3D_multi(x, y, z, m, h, res)
+    else:
+        SPH_hist = scatter3D(x=x, y = y,z = z,h = h, m = m ,res= res)
         
     return(SPH_hist)
-def image2D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, res = 64):
+def image2D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, res = 64, cull = True, backend = "serial", parallel_threshold = PARALLEL_THRESHOLD):
     ''' Image Render Module for 2D images.
     
     This function renders a 2D image of the given field. The image is rendered using the scatter2D function from the swiftsimio.visualisation.projection module.
@@ -79,28 +124,44 @@ def image2D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, re
         The half mass radius of the galaxy used to set the plot range.
     weights : numpy.array
         The weights of the particles. This is the field that is rendered.
+        Several fields can be rendered in a single pass over the particles by passing an array of shape (N_particles, N_fields).
     smoothing_length : numpy.array
         The smoothing length of the particles used for the SPH kernel.    
     plot_factor : float
         The factor by which the image is zoomed in. The image is calculated for -plot_factor*R_half < x < plot_factor*R_half
     res : int
         The resolution of the image. The image is res x res pixels. The default is 64. 
+    cull : bool
+        If True, only the particles whose kernel overlaps the image in the xy-plane are passed to the scatter function, see cull_particles.
+        This does not change the image. The default is True.
+    backend : str
+        The scatter implementation. "serial" uses a single core, "parallel" the multithreaded scatter, which splits the particles
+        over the numba threads, and "auto" the parallel scatter for at least parallel_threshold particles. The parallel scatter
+        only changes the order in which the contributions are summed. The default is "serial".
+    parallel_threshold : int
+        The number of particles (after culling) from which on the "auto" backend uses the parallel scatter. See exp/benchmark_render_backend.py
+        to find the crossover point on your machine. The default is PARALLEL_THRESHOLD.
 
     Returns
     -------
     numpy.array
-        The rendered image.
+        The rendered image. For two dimensional weights the images of all fields with shape (N_fields, res, res).
     
     '''
     
     plot_range = plot_factor*R_half
     
-    x = coordinates[:,0].copy()
-    y = coordinates[:,1].copy()
-    
-    m =  weights
-    
-    h = smoothing_length.copy()
+    if cull:
+        keep = cull_particles(coordinates, smoothing_length, plot_range, res, dim = 2)
+        x = coordinates[keep,0]
+        y = coordinates[keep,1]
+        m = weights[keep]
+        h = smoothing_length[keep]
+    else:
+        x = coordinates[:,0].copy()
+        y = coordinates[:,1].copy()
+        m =  weights
+        h = smoothing_length.copy()
     
     #Transform Particles s.t -factor*r_halfmassrad < x <factor*r_halfmassrad -> 0 < x <1
     x = x/(2*plot_range) +1/2  
@@ -108,7 +169,15 @@ def image2D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, re
 
     h = h/(2*plot_range)
     
-    SPH_hist = scatter2D(x=x, y = y,h = h, m = m ,res= res)
+    if _use_parallel(backend, len(x), parallel_threshold):
+        if m.ndim == 2:
+            SPH_hist = scatter2D_multi_parallel(x, y, m, h, res)
+        else:
+            SPH_hist = scatter2D_parallel(x=x, y = y,h = h, m = m ,res= res)
+    elif m.ndim == 2:
+        SPH_hist = scatter2D_multi(x, y, m, h, res)
+    else:
+        SPH_hist = scatter2D(x=x, y = y,h = h, m = m ,res= res)
         
     return(SPH_hist)
 
@@ -117,6 +186,73 @@ def image2D(coordinates, R_half, weights, smoothing_length, plot_factor = 10, re
 
 
 
+# Number of particles passed to the render functions and how many of them were culled, see cull_particles
+_cull_counts = {"particles": 0, "culled": 0}
+
+
+def cull_particles(coordinates, smoothing_length, plot_range, res, dim = 2):
+    '''Select the particles whose SPH kernel overlaps the image.
+
+    Particles further than plot_range plus their kernel support from the centre in x or y (and z for 3D images) can not contribute to
+    any pixel. A margin of two pixels accounts for the cell arithmetic of the scatter functions, so culling does not change the image.
+    The coordinates are only read column by column, without copying the coordinate array.
+
+    The number of culled particles is counted and can be accessed with get_cull_counts.
+
+    Parameters
+    ----------
+    coordinates : numpy.array
+        The coordinates of the particles, centered at the origin.
+    smoothing_length : numpy.array
+        The smoothing length of the particles.
+    plot_range : float
+        Half the side length of the image, i.e. plot_factor*R_half.
+    res : int
+        The resolution of the image.
+    dim : int, optional
+        The dimension of the image. For 2D images only the x and y coordinates are checked. The default is 2.
+
+    Returns
+    -------
+    numpy.array
+        The indices of the particles that overlap the image.
+    '''
+    kernel_gamma = kernel_gamma_2D if dim == 2 else kernel_gamma_3D
+    reach = kernel_gamma*smoothing_length
+    reach += plot_range*(1 + 4/res)
+
+    inside = np.abs(coordinates[:,0]) <= reach
+    for axis in range(1, dim):
+        inside &= np.abs(coordinates[:,axis]) <= reach
+    keep = np.flatnonzero(inside)
+
+    _cull_counts["particles"] += len(inside)
+    _cull_counts["culled"] += len(inside) - len(keep)
+    return keep
+
+
+def get_cull_counts(reset = False):
+    '''Get the number of particles passed to the render functions of this process and how many of them were culled.
+
+    Parameters
+    ----------
+    reset : bool, optional
+        If True, the counters are set to zero after reading them. The default is False.
+
+    Returns
+    -------
+    dict
+        Dictionary with the total number of particles ("particles") and the number of culled particles ("culled").
+    '''
+    counts = dict(_cull_counts)
+    if reset:
+        _cull_counts["particles"] = 0
+        _cull_counts["culled"] = 0
+    return counts
+
+
+
+
 def clip_image(data, lower = 0.1, upper = 1.):
     """Clip image to [lower,upper] quantile.
     
@@ -414,6 +550,10 @@ def horizontal_rotation(img, coordinates, halfmassrad,plotfactor=10, return_rota
     '''Rotate the galaxy to be horizontal.
     
     The galaxy is rotated to be horizontal using the angle of the galaxy bar in the image calculated with the PCA.
+
+    Note: the image is clipped to its [0.9,1] quantile before get_horizontal_angle selects the pixels above the 75% quantile, so all pixels
+    are selected and the PCA of the full pixel grid gives an angle of 0. The rotation matrix is therefore the identity for every galaxy.
+    Use moment_horizontal_rotation to align the major axis with the x-axis.
     
     Parameters
     ----------
@@ -445,6 +585,75 @@ def horizontal_rotation(img, coordinates, halfmassrad,plotfactor=10, return_rota
 
 
 
+def get_moment_angle(coordinates, particle_masses, halfmassrad, radius = 2):
+    '''Calculate the position angle of the galaxy in the xy-plane from the particles.
+
+    The angle of the major axis is calculated from the mass weighted second moment tensor
+
+    M_ij = sum(m*x_i*x_j)  for i,j in {x,y}
+
+    of the face-on rotated coordinates of the particles within radius*halfmassrad of the center. This does not need an image of the galaxy.
+
+    Parameters
+    ----------
+    coordinates : numpy.array
+        The face-on rotated coordinates of the particles, centered at the origin.
+    particle_masses : numpy.array
+        The masses of the particles.
+    halfmassrad : float
+        The half mass radius of the galaxy.
+    radius : float, optional
+        The radius in units of the half mass radius within which the particles are used. The default is 2.
+
+    Returns
+    -------
+    float
+        The angle between the major axis and the x-axis in radians.
+    '''
+    x = np.asarray(coordinates[:,0], dtype = np.float64)
+    y = np.asarray(coordinates[:,1], dtype = np.float64)
+    inside = x**2 + y**2 <= (radius*halfmassrad)**2
+    x, y, m = x[inside], y[inside], np.asarray(particle_masses, dtype = np.float64)[inside]
+
+    M_xx = np.sum(m*x*x)
+    M_yy = np.sum(m*y*y)
+    M_xy = np.sum(m*x*y)
+    return 0.5*np.arctan2(2*M_xy, M_xx - M_yy)
+
+
+def moment_horizontal_rotation(coordinates, particle_masses, halfmassrad, radius = 2, return_rotation_matrix = False):
+    '''Rotate the galaxy to be horizontal using the second moments of the particles.
+
+    Alternative to horizontal_rotation, which does not need a rendered image. The galaxy is rotated around the z-axis such that
+    the major axis calculated with get_moment_angle lies along the x-axis.
+
+    Parameters
+    ----------
+    coordinates : numpy.array
+        The face-on rotated coordinates of the particles, centered at the origin.
+    particle_masses : numpy.array
+        The masses of the particles.
+    halfmassrad : float
+        The half mass radius of the galaxy.
+    radius : float, optional
+        The radius in units of the half mass radius within which the particles are used. The default is 2.
+
+    Returns
+    -------
+    numpy.array
+        The rotated coordinates of the particles.
+    '''
+    angle = get_moment_angle(coordinates, particle_masses, halfmassrad, radius = radius)
+
+    #Rotate
+    horizontal_rotation_matrix = calc_rotation_matrix(-angle)
+    rotated_coordinates = np.dot(horizontal_rotation_matrix, coordinates.T).T
+    if return_rotation_matrix == True:
+        return rotated_coordinates, horizontal_rotation_matrix
+    return rotated_coordinates
+
+
+
 #------------- Visualisation -------------
 import plotly.graph_objects as go
 def volume(hist ,opacity = .1, isomin = None, isomax = None, surface_count = 30, add_small_number = True, norm_hist = True, **kwargs):
@@ -0,0 +1,393 @@
+'''
+SPH Scatter Kernels for the Image Render Modules
+
+This module contains numba implementations of the SPH scatter used by the image render functions in the image.py file.
+They follow the serial scatter functions of swiftsimio.visualisation.projection and swiftsimio.visualisation.volume_render
+and use the same Wendland-C2 kernels, but render several weight channels in a single pass over the particles.
+The kernel of a particle is evaluated once per pixel and then added to all channels.
+The parallel versions split the particles over the numba threads, see NUMBA_NUM_THREADS.
+The deposit functions add the particles to the pixels without smoothing (nearest grid point or cloud-in-cell) for the cheap renderers of the renderers.py module.
+
+'''
+from math import sqrt
+
+import numpy as np
+from numba import njit, prange, get_num_threads
+
+from swiftsimio.visualisation.projection_backends.kernels import (
+    kernel_single_precision as kernel_2D,
+    kernel_gamma as kernel_gamma_2D,
+)
+from swiftsimio.visualisation.slice import (
+    kernel as kernel_3D,
+    kernel_gamma as kernel_gamma_3D,
+)
+
+
+@njit(fastmath=True, cache=True)
+def scatter2D_multi(x, y, m, h, res):
+    ''' Multi-channel 2D SPH scatter.
+
+    Renders the weights m of shape (N_particles, N_channels) on a res x res pixel grid in one pass over the particles.
+    Each channel is identical to the result of the swiftsimio projection scatter with the weights of that channel.
+
+    Parameters
+    ----------
+    x, y : numpy.array
+        The positions of the particles. Must be bounded by [0, 1] to lie in the image.
+    m : numpy.array
+        The weights of the particles with shape (N_particles, N_channels).
+    h : numpy.array
+        The smoothing lengths of the particles in the same units as x and y.
+    res : int
+        The resolution of the image.
+
+    Returns
+    -------
+    numpy.array
+        The rendered images with shape (N_channels, res, res).
+    '''
+    n_channels = m.shape[1]
+    # Accumulate with the channels as the last axis, so all channels of a pixel are next to each other in memory
+    image = np.zeros((res, res, n_channels), dtype=np.float32)
+    maximal_array_index = np.int32(res) - 1
+    float_res = np.float32(res)
+    pixel_width = 1.0 / float_res
+    float_res_64 = np.float64(res)
+    inverse_cell_area = res * res
+
+    for i in range(x.shape[0]):
+        x_pos = x[i]
+        y_pos = y[i]
+        particle_cell_x = np.int32(float_res_64 * x_pos)
+        particle_cell_y = np.int32(float_res_64 * y_pos)
+        kernel_width = kernel_gamma_2D * h[i]
+        cells_spanned = np.int32(1.0 + kernel_width * float_res)
+
+        if (
+            particle_cell_x + cells_spanned < 0
+            or particle_cell_x - cells_spanned > maximal_array_index
+            or particle_cell_y + cells_spanned < 0
+            or particle_cell_y - cells_spanned > maximal_array_index
+        ):
+            continue
+
+        if cells_spanned <= 1:
+            if (
+                particle_cell_x >= 0
+                and particle_cell_x <= maximal_array_index
+                and particle_cell_y >= 0
+                and particle_cell_y <= maximal_array_index
+            ):
+                for c in range(n_channels):
+                    image[particle_cell_x, particle_cell_y, c] += (
+                        m[i, c] * inverse_cell_area
+                    )
+        else:
+            for cell_x in range(
+                max(0, particle_cell_x - cells_spanned),
+                min(particle_cell_x + cells_spanned + 1, maximal_array_index + 1),
+            ):
+                distance_x = (np.float32(cell_x) + 0.5) * pixel_width - np.float32(x_pos)
+                distance_x_2 = distance_x * distance_x
+                for cell_y in range(
+                    max(0, particle_cell_y - cells_spanned),
+                    min(particle_cell_y + cells_spanned + 1, maximal_array_index + 1),
+                ):
+                    distance_y = (np.float32(cell_y) + 0.5) * pixel_width - np.float32(y_pos)
+                    distance_y_2 = distance_y * distance_y
+                    r = sqrt(distance_x_2 + distance_y_2)
+                    kernel_eval = kernel_2D(r, kernel_width)
+                    for c in range(n_channels):
+                        image[cell_x, cell_y, c] += m[i, c] * kernel_eval
+
+    return np.ascontiguousarray(image.transpose(2, 0, 1))
+
+
+@njit(fastmath=True, cache=True)
+def scatter3D_multi(x, y, z, m, h, res):
+    ''' Multi-channel 3D SPH scatter.
+
+    Renders the weights m of shape (N_particles, N_channels) on a res x res x res voxel grid in one pass over the particles.
+    Each channel is identical to the result of the swiftsimio volume_render scatter with the weights of that channel.
+
+    Parameters
+    ----------
+    x, y, z : numpy.array
+        The positions of the particles. Must be bounded by [0, 1] to lie in the image.
+    m : numpy.array
+        The weights of the particles with shape (N_particles, N_channels).
+    h : numpy.array
+        The smoothing lengths of the particles in the same units as x, y and z.
+    res : int
+        The resolution of the image.
+
+    Returns
+    -------
+    numpy.array
+        The rendered images with shape (N_channels, res, res, res).
+    '''
+    n_channels = m.shape[1]
+    # Accumulate with the channels as the last axis, so all channels of a voxel are next to each other in memory
+    image = np.zeros((res, res, res, n_channels), dtype=np.float32)
+    maximal_array_index = np.int32(res) - 1
+    float_res = np.float32(res)
+    pixel_width = 1.0 / float_res
+    float_res_64 = np.float64(res)
+    drop_to_single_cell = pixel_width * 0.5
+    inverse_cell_volume = res * res * res
+
+    for i in range(x.shape[0]):
+        x_pos = x[i]
+        y_pos = y[i]
+        z_pos = z[i]
+        particle_cell_x = np.int32(float_res_64 * x_pos)
+        particle_cell_y = np.int32(float_res_64 * y_pos)
+        particle_cell_z = np.int32(float_res_64 * z_pos)
+        kernel_width = kernel_gamma_3D * h[i]
+        cells_spanned = np.int32(1.0 + kernel_width * float_res)
+
+        if (
+            particle_cell_x + cells_spanned < 0
+            or particle_cell_x - cells_spanned > maximal_array_index
+            or particle_cell_y + cells_spanned < 0
+            or particle_cell_y - cells_spanned > maximal_array_index
+            or particle_cell_z + cells_spanned < 0
+            or particle_cell_z - cells_spanned > maximal_array_index
+        ):
+            continue
+
+        if kernel_width < drop_to_single_cell:
+            if (
+                particle_cell_x >= 0
+                and particle_cell_x <= maximal_array_index
+                and particle_cell_y >= 0
+                and particle_cell_y <= maximal_array_index
+                and particle_cell_z >= 0
+                and particle_cell_z <= maximal_array_index
+            ):
+                for c in range(n_channels):
+                    image[particle_cell_x, particle_cell_y, particle_cell_z, c] += (
+                        m[i, c] * inverse_cell_volume
+                    )
+        else:
+            for cell_x in range(
+                max(0, particle_cell_x - cells_spanned),
+                min(particle_cell_x + cells_spanned, maximal_array_index + 1),
+            ):
+                distance_x = (np.float32(cell_x) + 0.5) * pixel_width - np.float32(x_pos)
+                distance_x_2 = distance_x * distance_x
+                for cell_y in range(
+                    max(0, particle_cell_y - cells_spanned),
+                    min(particle_cell_y + cells_spanned, maximal_array_index + 1),
+                ):
+                    distance_y = (np.float32(cell_y) + 0.5) * pixel_width - np.float32(y_pos)
+                    distance_y_2 = distance_y * distance_y
+                    for cell_z in range(
+                        max(0, particle_cell_z - cells_spanned),
+                        min(particle_cell_z + cells_spanned, maximal_array_index + 1),
+                    ):
+                        distance_z = (np.float32(cell_z) + 0.5) * pixel_width - np.float32(z_pos)
+                        distance_z_2 = distance_z * distance_z
+                        r = sqrt(distance_x_2 + distance_y_2 + distance_z_2)
+                        kernel_eval = kernel_3D(r, kernel_width)
+                        for c in range(n_channels):
+                            image[cell_x, cell_y, cell_z, c] += m[i, c] * kernel_eval
+
+    return np.ascontiguousarray(image.transpose(3, 0, 1, 2))
+
+
+@njit(fastmath=True, parallel=True)
+def scatter2D_multi_parallel(x, y, m, h, res):
+    ''' Parallel multi-channel 2D SPH scatter.
+
+    Splits the particles into one block per thread, renders every block with scatter2D_multi and sums the images.
+    This follows scatter_parallel of swiftsimio and needs one image per thread. The result only differs from
+    scatter2D_multi by the order in which the float32 contributions are summed.
+
+    Parameters
+    ----------
+    x, y, m, h, res :
+        See scatter2D_multi.
+
+    Returns
+    -------
+    numpy.array
+        The rendered images with shape (N_channels, res, res).
+    '''
+    number_of_particles = x.shape[0]
+    n_threads = get_num_threads()
+    core_particles = number_of_particles // n_threads
+    output = np.zeros((m.shape[1], res, res), dtype=np.float32)
+
+    for thread in prange(n_threads):
+        left_edge = thread * core_particles
+        right_edge = number_of_particles if thread == n_threads - 1 else (thread + 1) * core_particles
+        output += scatter2D_multi(
+            x[left_edge:right_edge],
+            y[left_edge:right_edge],
+            m[left_edge:right_edge],
+            h[left_edge:right_edge],
+            res,
+        )
+
+    return output
+
+
+@njit(fastmath=True, parallel=True)
+def scatter3D_multi_parallel(x, y, z, m, h, res):
+    ''' Parallel multi-channel 3D SPH scatter.
+
+    Splits the particles into one block per thread, renders every block with scatter3D_multi and sums the images.
+    This follows scatter_parallel of swiftsimio and needs one image per thread. The result only differs from
+    scatter3D_multi by the order in which the float32 contributions are summed.
+
+    Parameters
+    ----------
+    x, y, z, m, h, res :
+        See scatter3D_multi.
+
+    Returns
+    -------
+    numpy.array
+        The rendered images with shape (N_channels, res, res, res).
+    '''
+    number_of_particles = x.shape[0]
+    n_threads = get_num_threads()
+    core_particles = number_of_particles // n_threads
+    output = np.zeros((m.shape[1], res, res, res), dtype=np.float32)
+
+    for thread in prange(n_threads):
+        left_edge = thread * core_particles
+        right_edge = number_of_particles if thread == n_threads - 1 else (thread + 1) * core_particles
+        output += scatter3D_multi(
+            x[left_edge:right_edge],
+            y[left_edge:right_edge],
+            z[left_edge:right_edge],
+            m[left_edge:right_edge],
+            h[left_edge:right_edge],
+            res,
+        )
+
+    return output
+
+
+@njit(fastmath=True, cache=True)
+def deposit2D_multi(x, y, m, res, cloud_in_cell):
+    ''' Multi-channel 2D particle deposit without smoothing.
+
+    Adds the weights of every particle to the pixel it lies in (nearest grid point), or shares them between the four nearest
+    pixel centres (cloud-in-cell). Particles or shares outside of the image are dropped.
+
+    Parameters
+    ----------
+    x, y : numpy.array
+        The positions of the particles. Must be bounded by [0, 1] to lie in the image.
+    m : numpy.array
+        The weights of the particles with shape (N_particles, N_channels).
+    res : int
+        The resolution of the image.
+    cloud_in_cell : bool
+        If True, use the cloud-in-cell assignment, otherwise the nearest grid point.
+
+    Returns
+    -------
+    numpy.array
+        The images with shape (N_channels, res, res) in the units of scatter2D_multi, i.e. the weights per pixel area.
+    '''
+    n_channels = m.shape[1]
+    image = np.zeros((res, res, n_channels), dtype=np.float64)
+    float_res = np.float64(res)
+
+    for i in range(x.shape[0]):
+        if cloud_in_cell:
+            # The pixel centres are at (cell + 1/2) / res
+            grid_x = x[i] * float_res - 0.5
+            grid_y = y[i] * float_res - 0.5
+            cell_x = np.int64(np.floor(grid_x))
+            cell_y = np.int64(np.floor(grid_y))
+            fraction_x = grid_x - cell_x
+            fraction_y = grid_y - cell_y
+            for offset_x in range(2):
+                target_x = cell_x + offset_x
+                if target_x < 0 or target_x >= res:
+                    continue
+                share_x = fraction_x if offset_x else 1.0 - fraction_x
+                for offset_y in range(2):
+                    target_y = cell_y + offset_y
+                    if target_y < 0 or target_y >= res:
+                        continue
+                    share = share_x * (fraction_y if offset_y else 1.0 - fraction_y)
+                    for c in range(n_channels):
+                        image[target_x, target_y, c] += m[i, c] * share
+        else:
+            cell_x = np.int64(np.floor(x[i] * float_res))
+            cell_y = np.int64(np.floor(y[i] * float_res))
+            if cell_x < 0 or cell_x >= res or cell_y < 0 or cell_y >= res:
+                continue
+            for c in range(n_channels):
+                image[cell_x, cell_y, c] += m[i, c]
+
+    image *= float_res * float_res
+    return np.ascontiguousarray(image.transpose(2, 0, 1)).astype(np.float32)
+
+
+@njit(fastmath=True, cache=True)
+def deposit3D_multi(x, y, z, m, res, cloud_in_cell):
+    ''' Multi-channel 3D particle deposit without smoothing.
+
+    The 3D version of deposit2D_multi, which shares the weights between the eight nearest voxel centres for the cloud-in-cell assignment.
+
+    Parameters
+    ----------
+    x, y, z, m, res, cloud_in_cell :
+        See deposit2D_multi.
+
+    Returns
+    -------
+    numpy.array
+        The images with shape (N_channels, res, res, res) in the units of scatter3D_multi, i.e. the weights per voxel volume.
+    '''
+    n_channels = m.shape[1]
+    image = np.zeros((res, res, res, n_channels), dtype=np.float64)
+    float_res = np.float64(res)
+
+    for i in range(x.shape[0]):
+        if cloud_in_cell:
+            grid_x = x[i] * float_res - 0.5
+            grid_y = y[i] * float_res - 0.5
+            grid_z = z[i] * float_res - 0.5
+            cell_x = np.int64(np.floor(grid_x))
+            cell_y = np.int64(np.floor(grid_y))
+            cell_z = np.int64(np.floor(grid_z))
+            fraction_x = grid_x - cell_x
+            fraction_y = grid_y - cell_y
+            fraction_z = grid_z - cell_z
+            for offset_x in range(2):
+                target_x = cell_x + offset_x
+                if target_x < 0 or target_x >= res:
+                    continue
+                share_x = fraction_x if offset_x else 1.0 - fraction_x
+                for offset_y in range(2):
+                    target_y = cell_y + offset_y
+                    if target_y < 0 or target_y >= res:
+                        continue
+                    share_xy = share_x * (fraction_y if offset_y else 1.0 - fraction_y)
+                    for offset_z in range(2):
+                        target_z = cell_z + offset_z
+                        if target_z < 0 or target_z >= res:
+                            continue
+                        share = share_xy * (fraction_z if offset_z else 1.0 - fraction_z)
+                        for c in range(n_channels):
+                            image[target_x, target_y, target_z, c] += m[i, c] * share
+        else:
+            cell_x = np.int64(np.floor(x[i] * float_res))
+            cell_y = np.int64(np.floor(y[i] * float_res))
+            cell_z = np.int64(np.floor(z[i] * float_res))
+            if cell_x < 0 or cell_x >= res or cell_y < 0 or cell_y >= res or cell_z < 0 or cell_z >= res:
+                continue
+            for c in range(n_channels):
+                image[cell_x, cell_y, cell_z, c] += m[i, c]
+
+    image *= float_res * float_res * float_res
+    return np.ascontiguousarray(image.transpose(3, 0, 1, 2)).astype(np.float32)
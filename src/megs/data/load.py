@@ -1,4 +1,8 @@
 
+import os
+import queue
+import threading
+
 import h5py
 import numpy as np
 
@@ -17,10 +21,196 @@ def print_hdf5_group_structure(group, indent=0):
             print("{0}Dataset: {1} ({2}) ({3})".format(" " * indent, key, sub_group.dtype, sub_group.shape))
 
 
+def _quantization_path(particle_type, dimension, field):
+    """Path of the group holding the per-image scale and offset datasets of a quantized image dataset."""
+    return f"Galaxies/Particles/{particle_type}/Quantization/{dimension}/{field}"
+
+
+def _dequantize(images, scale, offset):
+    """Converts quantized images back to float32 using image = stored_image * scale + offset."""
+    scale = np.asarray(scale, dtype=np.float32)
+    offset = np.asarray(offset, dtype=np.float32)
+    # Broadcast the per-image scale and offset over the pixels
+    expand = (...,) + (None,) * (images.ndim - scale.ndim)
+    return images.astype(np.float32) * scale[expand] + offset[expand]
+
+
+# Time of a single read call expressed in bytes that could be read in the same time. A read of a few rows costs about as much as
+# reading 32 kB more in one call (see exp/benchmark_masked_reads.py), so selections with many short runs are cheaper to read in
+# one block and mask in memory.
+_READ_CALL_BYTES = 32 * 1024
+# Maximum size of the blocks read by the "block" strategy of _masked_read in bytes
+_MASKED_READ_BLOCK_BYTES = 256 * 1024**2
+
+
+def _mask_runs(mask):
+    """Start and stop indices of the contiguous runs of True values of a boolean mask."""
+    edges = np.diff(np.concatenate([[False], mask, [False]]).astype(np.int8))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _plan_masked_read(mask, row_bytes):
+    """Choose how to read the rows of a dataset selected by a boolean mask.
+
+    "runs" reads every contiguous run of selected rows with its own call, "block" reads all rows between the first and the last
+    selected row in blocks and masks them in memory. The strategy with the smaller estimated cost is returned, where a read call
+    costs _READ_CALL_BYTES.
+
+    Parameters
+    ----------
+    mask : np.ndarray
+        Boolean mask over the first axis of the dataset.
+    row_bytes : int
+        Size of a row of the dataset in bytes.
+
+    Returns
+    -------
+    strategy : str
+        "runs" or "block".
+    starts, stops : np.ndarray
+        Start and stop indices of the runs of selected rows.
+    """
+    starts, stops = _mask_runs(mask)
+    if len(starts) == 0:
+        return "runs", starts, stops
+    runs_cost = len(starts) * _READ_CALL_BYTES + (stops - starts).sum() * row_bytes
+    n_blocks = -(-(stops[-1] - starts[0]) * row_bytes // _MASKED_READ_BLOCK_BYTES)
+    block_cost = n_blocks * _READ_CALL_BYTES + (stops[-1] - starts[0]) * row_bytes
+    return ("runs" if runs_cost <= block_cost else "block"), starts, stops
+
+
+def _masked_read(dataset, mask, strategy=None):
+    """Read the rows of a dataset selected by a boolean mask.
+
+    Equivalent to dataset[mask], which h5py converts to a point selection that is slow for masks with many selected rows. The selected
+    rows are coalesced into contiguous runs and read either run by run or in blocks that are masked in memory, see _plan_masked_read.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        The dataset to read.
+    mask : np.ndarray
+        Boolean mask over the first axis of the dataset.
+    strategy : str, optional
+        "runs" or "block" to override the strategy chosen by _plan_masked_read. The default is None.
+
+    Returns
+    -------
+    np.ndarray
+        The selected rows.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != dataset.shape[:1]:
+        raise ValueError(f"Mask of shape {mask.shape} does not match the dataset of shape {dataset.shape}.")
+    row_shape = dataset.shape[1:]
+    row_bytes = max(int(np.prod(row_shape)) * dataset.dtype.itemsize, 1)
+    planned, starts, stops = _plan_masked_read(mask, row_bytes)
+    strategy = strategy or planned
+    if len(starts) == 0:
+        return np.empty((0,) + row_shape, dtype=dataset.dtype)
+    if strategy not in ("runs", "block"):
+        raise ValueError(f"Unknown strategy {strategy}. Available strategies: runs, block.")
+    out = np.empty((int((stops - starts).sum()),) + row_shape, dtype=dataset.dtype)
+    _read_rows(dataset, out, starts, stops, mask=mask if strategy == "block" else None)
+    return out
+
+
+def _index_runs(indices):
+    """Start and stop indices of the runs of consecutive indices, in the given order of the indices."""
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    if len(indices) == 0:
+        return indices, indices
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = indices[np.concatenate([[0], breaks])]
+    stops = indices[np.concatenate([breaks - 1, [len(indices) - 1]])] + 1
+    return starts, stops
+
+
+def _read_rows(dataset, out, starts, stops, channel=(), mask=None):
+    """Read the rows starts[i]:stops[i] of a dataset one after another into out.
+
+    The rows are read with read_direct, so they are converted to the dtype of out by HDF5 while reading. If channel is given, the rows
+    are written to out[:, channel] instead, e.g. channel=(1,) fills the second channel of a (N, C, H, W) array. If mask is given, all
+    rows between starts[0] and stops[-1] are read in blocks of at most _MASKED_READ_BLOCK_BYTES and the rows selected by the mask are
+    copied to out (the "block" strategy of _plan_masked_read).
+    """
+    position = 0
+    if mask is None:
+        for start, stop in zip(starts, stops):
+            dataset.read_direct(out, np.s_[start:stop], (slice(position, position + stop - start),) + tuple(channel))
+            position += stop - start
+        return
+    if len(starts) == 0:
+        return
+    row_shape = dataset.shape[1:]
+    block_rows = max(_MASKED_READ_BLOCK_BYTES // max(int(np.prod(row_shape)) * dataset.dtype.itemsize, 1), 1)
+    block = np.empty((min(block_rows, stops[-1] - starts[0]),) + row_shape, dtype=dataset.dtype)
+    for start in range(starts[0], stops[-1], block_rows):
+        stop = min(start + block_rows, stops[-1])
+        dataset.read_direct(block, np.s_[start:stop], np.s_[0 : stop - start])
+        selected = block[: stop - start][mask[start:stop]]
+        out[(slice(position, position + len(selected)),) + tuple(channel)] = selected
+        position += len(selected)
+
+
+# Rows of a contiguous dataset that are read as one block by Gamma.iter_batches, in bytes
+_BATCH_BLOCK_BYTES = 1024**2
+
+
+def _prefetch(iterator, prefetch):
+    """Run an iterator in a background thread that stays up to prefetch items ahead of the consumer.
+
+    Exceptions of the iterator are raised in the consumer. If the consumer stops early, the thread is stopped before the next item.
+    """
+    if prefetch <= 0:
+        yield from iterator
+        return
+    items = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(end)
+        except BaseException as error:
+            put(error)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is end:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 # TODO: maybe add get_galaxy function to get all the data of a specific galaxy
 
 class Gamma():
     '''Class to load the data generated by the generate_data.py script.
+
+    The file is opened once on the first read and stays open until close() is called, so reading single galaxies does not
+    reopen the file and parse its metadata every time. Gamma can be used as a context manager, which closes the file at the end.
+    A process created with fork (e.g. a DataLoader worker) opens its own handle on its first read, and pickled Gamma objects
+    reopen the file after unpickling.
     
     Parameters:
     -----------
@@ -32,6 +222,14 @@ class Gamma():
             The minimum mass of the galaxies to load. If None, no filter is applied.
         m_max : float, optional
             The maximum mass of the galaxies to load. If None, no filter is applied.
+        rdcc_nbytes : int, optional
+            Size of the raw data chunk cache of every dataset in bytes. If None, the h5py default (1 MB) is used. Chunks of recently read 
+            galaxies are served from the cache, so it should hold at least a few chunks of the images that are read repeatedly.
+        rdcc_nslots : int, optional
+            Number of hash table slots of the chunk cache, ideally a prime about 100 times the number of chunks fitting into the cache.
+            If None, the h5py default is used.
+        rdcc_w0 : float, optional
+            Preemption policy of the chunk cache between 0 and 1. If None, the h5py default is used.
             
     Attributes:
     -----------
@@ -46,8 +244,18 @@ class Gamma():
         _image_fields : dict    
             The fields of the images.
     '''
-    def __init__(self,path, show_structure = True, m_min = None, m_max = None):
+    def __init__(self,path, show_structure = True, m_min = None, m_max = None, rdcc_nbytes = None, rdcc_nslots = None, rdcc_w0 = None):
         self.path = path
+        # Keyword arguments of h5py.File for the chunk cache, only the ones that are set
+        self._file_kwargs = {
+            key: value
+            for key, value in [("rdcc_nbytes", rdcc_nbytes), ("rdcc_nslots", rdcc_nslots), ("rdcc_w0", rdcc_w0)]
+            if value is not None
+        }
+        self._file = None
+        self._pid = None
+        self._datasets = dict()
+        self._memmaps = dict()
         self._load_keys()
         if show_structure:
             self.show_structure()
@@ -57,23 +265,103 @@ class Gamma():
             self.mask = self._create_mass_mask(m_min, m_max)
             
     def __getitem__(self, key):
-        with h5py.File(self.path, 'r') as f:
-            return f[key][()]
+        return self._open()[key][()]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # The file handle can not be pickled, the unpickled object opens the file again
+        state = self.__dict__.copy()
+        state["_file"] = None
+        state["_pid"] = None
+        state["_datasets"] = dict()
+        state["_memmaps"] = dict()
+        return state
+
+    def _open(self):
+        '''Return the open file handle, and open the file if it is not open in this process.'''
+        if self._file is None or self._pid != os.getpid():
+            # A handle inherited through fork is not used, the HDF5 library state is not shared between processes.
+            # Release it before opening the file again, so the new handle does not share its state.
+            self._file = None
+            self._datasets = dict()
+            self._memmaps = dict()
+            self._file = h5py.File(self.path, 'r', **self._file_kwargs)
+            self._pid = os.getpid()
+        return self._file
+
+    def _dataset(self, name):
+        '''Return the open dataset name. The datasets stay open with the file, so their chunk caches are kept between reads.'''
+        f = self._open()
+        if name not in self._datasets:
+            self._datasets[name] = f[name]
+        return self._datasets[name]
+
+    def _memmap(self, name):
+        '''Return a read-only memory map of the dataset name, or None if the dataset can not be mapped.
+
+        Only contiguous datasets (which have no filters) with their data allocated in a single file can be mapped. The memory map reads
+        the data through the page cache of the operating system, which is shared by all processes reading the file.
+        '''
+        if name not in self._memmaps:
+            dataset = self._dataset(name)
+            offset = dataset.id.get_offset()
+            mappable = (
+                dataset.chunks is None
+                and offset is not None
+                and dataset.size > 0
+                and dataset.dtype.kind in "biuf"
+                and not dataset.is_virtual
+                and not dataset.external
+                and self._file.driver == "sec2"
+            )
+            self._memmaps[name] = (
+                np.memmap(self.path, dtype=dataset.dtype, mode="r", offset=offset, shape=dataset.shape) if mappable else None
+            )
+        return self._memmaps[name]
+
+    def _image_path(self, particle_type, field, dim):
+        '''Check the particle type, field and dimension of an image dataset and return its path in the file.'''
+        # check if dimension is string or int
+        if isinstance(dim, str):
+            dimension = dim
+        else:
+            dimension = "dim2" if dim == 2 else "dim3"
+        #Check if the particle type is valid
+        if particle_type not in self._particles_keys:
+            raise ValueError(f"Particle type {particle_type} not found. Valid particle types are: {self._particles_keys}")
+        #Check if the field is valid
+        if field not in self._image_fields[particle_type][dimension]:
+            raise ValueError(f"Field {field} not found. Valid fields are: {self._image_fields[particle_type]}")
+        return f"Galaxies/Particles/{particle_type}/Images/{dimension}/{field}"
+
+    def close(self):
+        '''Close the file. It is opened again by the next read.'''
+        if self._file is not None and self._pid == os.getpid():
+            self._file.close()
+        self._file = None
+        self._pid = None
+        self._datasets = dict()
+        self._memmaps = dict()
         
     def _load_keys(self):
     
         # Load the data from the hdf5 file generated by the generate_data.py script without loading into memory
-        with h5py.File(self.path, 'r') as f:
-            self._galaxy_attributes_keys = [keys for keys in f["Galaxies/Attributes"].keys()]
-            self._particles_keys = [keys for keys in f["Galaxies/Particles"].keys()]
-        
-            # Load the fields of the images
-            self._image_fields = dict()
-            for particle in f["Galaxies/Particles"].keys():
-                particle_field = dict()
-                for dim in f["Galaxies/Particles"][particle]["Images"].keys():
-                    particle_field[dim]= [keys for keys in f["Galaxies/Particles"][particle]["Images"][dim].keys()]
-                self._image_fields[particle] = particle_field
+        f = self._open()
+        self._galaxy_attributes_keys = [keys for keys in f["Galaxies/Attributes"].keys()]
+        self._particles_keys = [keys for keys in f["Galaxies/Particles"].keys()]
+    
+        # Load the fields of the images
+        self._image_fields = dict()
+        for particle in f["Galaxies/Particles"].keys():
+            particle_field = dict()
+            for dim in f["Galaxies/Particles"][particle]["Images"].keys():
+                particle_field[dim]= [keys for keys in f["Galaxies/Particles"][particle]["Images"][dim].keys()]
+            self._image_fields[particle] = particle_field
     def get_attribute(self, attribute, index = None, ignore_mask = False):
         '''
         Get a galaxy attribute.
@@ -109,20 +397,19 @@ class Gamma():
         if attribute not in self._galaxy_attributes_keys:
             raise ValueError(f"Attribute {attribute} not found. Valid attributes are: {self._galaxy_attributes_keys}")
         
-        # Open the hdf5 file in read-only mode
-        with h5py.File(self.path, 'r') as f:
-            if index is None:
-                # Check if mask is defined
-                if hasattr(self, 'mask') and not ignore_mask:
-                    return f["Galaxies/Attributes"][attribute][self.mask]
-                else:
-                    return f["Galaxies/Attributes"][attribute][()]
+        dataset = self._dataset(f"Galaxies/Attributes/{attribute}")
+        if index is None:
+            # Check if mask is defined
+            if hasattr(self, 'mask') and not ignore_mask:
+                return _masked_read(dataset, self.mask)
             else:
-                return f["Galaxies/Attributes"][attribute][index]
+                return dataset[()]
+        else:
+            return dataset[index]
         
    
     
-    def get_image(self, particle_type, field, index=None, ignore_mask = False, dim=2):
+    def get_image(self, particle_type, field, index=None, ignore_mask = False, dim=2, dequantize = True, mmap = False):
         '''
         Get the image of the specified particle type and field.
         
@@ -138,6 +425,14 @@ class Gamma():
                 The galaxy index ind the dataset to return. If None, return all images.  
             dim : int, optional
                 The dimension of the image. If 2, return a 2D image. If 3, return a 3D image.  
+            dequantize : bool, optional
+                If the images are stored with a reduced precision (float16, uint8 or uint16), convert them back to float32. 
+                Quantized images are rescaled with their stored scale and offset. If False, the stored values are returned. Default is True.
+            mmap : bool, optional
+                If True, read the images through a read-only memory map of the file. Images of all galaxies and of a single galaxy are 
+                returned as views of the memory map without copying, and the pages are shared by all processes reading the file through 
+                the page cache. Only contiguous datasets (chunks="contiguous") can be mapped, other datasets are read normally. 
+                Dequantized images and masked selections are copies. Default is False.
             
         Returns:
         --------
@@ -149,34 +444,242 @@ class Gamma():
             >>> data = Gamma("data.hdf5")
             >>> image = data.get_image("stars", "Masses", 10) # Get the stars masses image of the 10th galaxy in the dataset
             >>> all_images = data.get_image("stars", "Masses") # Get all stars masses images in the dataset 
+            >>> all_images = data.get_image("stars", "Masses", mmap=True) # Memory map of all images, read on access
             '''
         
-        # check if dimension is string or int
-        if isinstance(dim, str):
-            dimension = dim
-        else:
-            dimension = "dim2" if dim == 2 else "dim3"
-        #Check if the particle type is valid
-        if particle_type not in self._particles_keys:
-            raise ValueError(f"Particle type {particle_type} not found. Valid particle types are: {self._particles_keys}")
-        #Check if the field is valid
-        if field not in self._image_fields[particle_type][dimension]:
-            raise ValueError(f"Field {field} not found. Valid fields are: {self._image_fields[particle_type]}")
-        
-        
-        
+        path = self._image_path(particle_type, field, dim)
+        dimension = path.split("/")[-2]
         
-        # OPen the hdf5 file in read-only mode
-        with h5py.File(self.path, 'r') as f:
-            if index is None:
-                # Check if mask is defined
-                if hasattr(self, 'mask') and not ignore_mask:
-                    return f[f"Galaxies/Particles/{particle_type}/Images/{dimension}/{field}"][self.mask]
-                else:
-                    return f[f"Galaxies/Particles/{particle_type}/Images/{dimension}/{field}"][()]
+        if index is None:
+            # Check if mask is defined
+            if hasattr(self, 'mask') and not ignore_mask:
+                selection = self.mask
             else:
-                return f[f"Galaxies/Particles/{particle_type}/Images/{dimension}/{field}"][index]
+                selection = ()
+        else:
+            selection = index
+        def read(dataset):
+            # Boolean masks are read with _masked_read, which is much faster than the point selection of h5py
+            if isinstance(selection, np.ndarray) and selection.dtype == bool:
+                return _masked_read(dataset, selection)
+            return dataset[selection]
+
+        dataset = self._dataset(path)
+        view = self._memmap(path) if mmap else None
+        images = read(dataset) if view is None else view[selection]
+        if dequantize and dataset.dtype.kind == "u":
+            quantization = _quantization_path(particle_type, dimension, field)
+            scale = read(self._dataset(f"{quantization}/scale"))
+            offset = read(self._dataset(f"{quantization}/offset"))
+            return _dequantize(images, scale, offset)
+        if dequantize and dataset.dtype == np.float16:
+            return images.astype(np.float32)
+        return images
+
+    def get_images(self, particle_type, fields, indices=None, out=None, dtype=None, ignore_mask=False, dim=2, dequantize=True):
+        '''
+        Get the images of several fields stacked into one array of shape (N, C, H, W) or (N, C, H, W, D).
+
+        Every field is read directly into its channel of a preallocated array (or of out), so no intermediate copies of the images are
+        made. Consecutive indices are read with a single call, and boolean masks are read like in get_image.
+
+        Parameters:
+        -----------
+            particle_type : str
+                The particle type of the images.
+            fields : list
+                The fields of the images, in the order of the channels.
+            indices : array_like, slice or None, optional
+                The galaxy indices in the dataset, a boolean mask or a slice. If None, all galaxies (filtered by the mass mask of Gamma) are read.
+            out : np.ndarray, optional
+                C-contiguous array of shape (N, C, ...) to fill. If None, a new array is returned.
+            dtype : data-type, optional
+                Data type of the returned array. The images are converted by HDF5 while reading. If None, float32 is used for images stored
+                with a reduced precision if dequantize is True and the stored data type otherwise. Ignored if out is given.
+            ignore_mask : bool, optional
+                If True, the mass mask is not applied when indices is None. Default is False.
+            dim : int, optional
+                The dimension of the images. If 2, return 2D images. If 3, return 3D images.
+            dequantize : bool, optional
+                If True, quantized images are rescaled with their stored scale and offset, like in get_image. Default is True.
+
+        Returns:
+        --------
+            images : np.ndarray
+                The images with shape (N, len(fields), ...).
+
+        Examples:
+        ---------
+            >>> data = Gamma("data.hdf5")
+            >>> images = data.get_images("stars", ["Masses", "GFM_Metallicity"], indices=range(64)) # (64, 2, res, res)
+            >>> batch = np.empty((64, 2, 64, 64), dtype=np.float32)
+            >>> data.get_images("stars", ["Masses", "GFM_Metallicity"], indices=range(64, 128), out=batch) # Reuse the array
+        '''
+        paths = [self._image_path(particle_type, field, dim) for field in fields]
+        datasets = [self._dataset(path) for path in paths]
+        n_galaxies = datasets[0].shape[0]
+
+        # Convert the indices to runs of consecutive galaxies, or to a boolean mask
+        mask = None
+        if indices is None:
+            if hasattr(self, 'mask') and not ignore_mask:
+                mask = np.asarray(self.mask, dtype=bool)
+            else:
+                indices = slice(None)
+        elif isinstance(indices, np.ndarray) and indices.dtype == bool:
+            mask = indices
+        if mask is not None:
+            if mask.shape != (n_galaxies,):
+                raise ValueError(f"Mask of shape {mask.shape} does not match the {n_galaxies} galaxies in the dataset.")
+            n = int(mask.sum())
+        else:
+            if isinstance(indices, slice):
+                indices = np.arange(n_galaxies)[indices]
+            indices = np.asarray(indices, dtype=np.int64).ravel()
+            if np.any((indices < -n_galaxies) | (indices >= n_galaxies)):
+                raise IndexError(f"Galaxy indices out of range for {n_galaxies} galaxies.")
+            indices = np.where(indices < 0, indices + n_galaxies, indices)
+            starts, stops = _index_runs(indices)
+            n = len(indices)
+
+        shape = (n, len(fields)) + datasets[0].shape[1:]
+        if out is None:
+            if dtype is None:
+                dtype = np.result_type(
+                    *[
+                        np.float32 if dequantize and (dataset.dtype.kind == "u" or dataset.dtype == np.float16) else dataset.dtype
+                        for dataset in datasets
+                    ]
+                )
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError(f"out has the shape {out.shape}, but the images have the shape {shape}.")
+        elif not out.flags.c_contiguous:
+            raise ValueError("out has to be C-contiguous.")
+
+        for channel, (field, path, dataset) in enumerate(zip(fields, paths, datasets)):
+            if dataset.shape[1:] != shape[2:]:
+                raise ValueError(f"The images of {path} have the shape {dataset.shape[1:]}, expected {shape[2:]}.")
+            if mask is not None:
+                strategy, starts, stops = _plan_masked_read(mask, max(int(np.prod(shape[2:])) * dataset.dtype.itemsize, 1))
+                channel_mask = mask if strategy == "block" else None
+            else:
+                channel_mask = None
+            _read_rows(dataset, out, starts, stops, channel=(channel,), mask=channel_mask)
+            if dequantize and dataset.dtype.kind == "u":
+                if out.dtype.kind != "f":
+                    raise ValueError(f"Quantized images can only be dequantized to a floating point dtype, got {out.dtype}.")
+                quantization = _quantization_path(particle_type, path.split("/")[-2], field)
+                parameters = []
+                for name in ["scale", "offset"]:
+                    values = np.empty(n, dtype=np.float32)
+                    _read_rows(self._dataset(f"{quantization}/{name}"), values, starts, stops, mask=channel_mask)
+                    parameters.append(values[(...,) + (None,) * (len(shape) - 2)])
+                out[:, channel] *= parameters[0]
+                out[:, channel] += parameters[1]
+        return out
            
+    def iter_batches(
+        self,
+        particle_type,
+        fields,
+        batch_size,
+        shuffle=True,
+        seed=None,
+        drop_last=False,
+        prefetch=2,
+        buffer_size=None,
+        dim=2,
+        dtype=np.float32,
+        ignore_mask=False,
+        dequantize=True,
+    ):
+        '''
+        Iterate once over the galaxies in mini-batches of stacked images, reading from the file while the batches are used.
+
+        The galaxies are shuffled at the granularity of the chunks of the image datasets: the order of the chunks is shuffled, buffer_size
+        galaxies of consecutive chunks in this order are read at once with get_images, and the galaxies of the buffer are shuffled in memory.
+        Every chunk is therefore read once per epoch, and only buffer_size galaxies are held in memory. A background thread reads up to
+        prefetch batches ahead. Use a different seed for every epoch to get a different order.
+
+        Parameters:
+        -----------
+            particle_type : str
+                The particle type of the images.
+            fields : list
+                The fields of the images, in the order of the channels.
+            batch_size : int
+                Number of galaxies per batch.
+            shuffle : bool, optional
+                If True, shuffle the galaxies. Otherwise the galaxies are returned in the order of the file. Default is True.
+            seed : int, optional
+                Seed of the random order. Default is None.
+            drop_last : bool, optional
+                If True, the last batch is dropped if it has less than batch_size galaxies. Default is False.
+            prefetch : int, optional
+                Number of batches read ahead in a background thread. If 0, the batches are read when they are requested. Default is 2.
+            buffer_size : int, optional
+                Number of galaxies read and shuffled at once, rounded up to a multiple of batch_size. Larger buffers mix the chunks better.
+                If None, 8 * batch_size is used, but at least one chunk.
+            dim : int, optional
+                The dimension of the images. Default is 2.
+            dtype : data-type, optional
+                Data type of the batches, see get_images. Default is np.float32.
+            ignore_mask : bool, optional
+                If True, the mass mask of Gamma is not applied. Default is False.
+            dequantize : bool, optional
+                If True, quantized images are rescaled, see get_images. Default is True.
+
+        Returns:
+        --------
+            batches : iterator
+                Iterator of (indices, images) with the galaxy indices in the dataset and the images of shape (batch_size, len(fields), ...).
+
+        Examples:
+        ---------
+            >>> data = Gamma("data.hdf5")
+            >>> for epoch in range(10):
+            ...     for indices, images in data.iter_batches("stars", ["Masses", "GFM_Metallicity"], 64, seed=epoch):
+            ...         train_step(images)
+        '''
+        if batch_size < 1:
+            raise ValueError(f"batch_size should be a positive integer, got {batch_size}.")
+        paths = [self._image_path(particle_type, field, dim) for field in fields]
+        dataset = self._dataset(paths[0])
+        if hasattr(self, 'mask') and not ignore_mask:
+            galaxies = np.flatnonzero(self.mask)
+        else:
+            galaxies = np.arange(dataset.shape[0])
+
+        # Galaxies in the same chunk (or block of a contiguous dataset) form a block, which is read at once
+        if dataset.chunks is not None:
+            block_rows = dataset.chunks[0]
+        else:
+            block_rows = max(_BATCH_BLOCK_BYTES // max(int(np.prod(dataset.shape[1:])) * dataset.dtype.itemsize, 1), 1)
+        if buffer_size is None:
+            buffer_size = max(8 * batch_size, block_rows)
+        buffer_size = -(-max(buffer_size, 1) // batch_size) * batch_size
+        rng = np.random.default_rng(seed)
+        if shuffle:
+            blocks = np.split(galaxies, np.flatnonzero(np.diff(galaxies // block_rows)) + 1)
+            galaxies = np.concatenate([blocks[i] for i in rng.permutation(len(blocks))]) if len(galaxies) else galaxies
+
+        def batches():
+            for start in range(0, len(galaxies), buffer_size):
+                # Read the buffer in the order of the file and shuffle it in memory
+                indices = np.sort(galaxies[start : start + buffer_size])
+                if drop_last and len(indices) < batch_size:
+                    return
+                images = self.get_images(particle_type, fields, indices, dtype=dtype, dim=dim, dequantize=dequantize)
+                order = rng.permutation(len(indices)) if shuffle else np.arange(len(indices))
+                for batch in range(0, len(indices), batch_size):
+                    selection = order[batch : batch + batch_size]
+                    if drop_last and len(selection) < batch_size:
+                        return
+                    yield indices[selection], images[selection]
+
+        return _prefetch(batches(), prefetch)
+
     def show_structure(self):
         '''
         Print the structure of the HDF5 file.
@@ -229,4 +732,74 @@ class Gamma():
         
  
  
- 
\ No newline at end of file
+ 
+
+class GammaDataset():
+    '''Map-style dataset of the galaxy images of a Gamma file, e.g. for a PyTorch DataLoader.
+
+    Every sample is the (C, H, W) or (C, H, W, D) array of the images of one galaxy, read with Gamma.get_images. The dataset can be
+    shared by several DataLoader workers: forked workers open their own file handle on their first read, and the dataset can be
+    pickled for workers that are started with spawn. A batch sampler can use __getitems__, which reads a whole batch at once.
+
+    Parameters:
+    -----------
+        data : Gamma
+            The data to read the images from.
+        particle_type : str
+            The particle type of the images.
+        fields : list
+            The fields of the images, in the order of the channels.
+        dim : int, optional
+            The dimension of the images. Default is 2.
+        dtype : data-type, optional
+            Data type of the samples. Default is np.float32.
+        ignore_mask : bool, optional
+            If True, the mass mask of Gamma is not applied. Otherwise the dataset only contains the galaxies selected by the mask. Default is False.
+        dequantize : bool, optional
+            If True, quantized images are rescaled, see Gamma.get_images. Default is True.
+
+    Examples:
+    ---------
+    >>> from torch.utils.data import DataLoader
+    >>> dataset = GammaDataset(Gamma("data.hdf5", show_structure=False), "stars", ["Masses", "GFM_Metallicity"])
+    >>> loader = DataLoader(dataset, batch_size=64, shuffle=True, num_workers=4)
+    '''
+
+    def __init__(self, data, particle_type, fields, dim=2, dtype=np.float32, ignore_mask=False, dequantize=True):
+        if not isinstance(data, Gamma):
+            raise ValueError("data must be an instance of Gamma")
+        self.data = data
+        self.particle_type = particle_type
+        self.fields = list(fields)
+        self.dim = dim
+        self.dtype = dtype
+        self.dequantize = dequantize
+        paths = [data._image_path(particle_type, field, dim) for field in self.fields]
+        # Galaxy index in the file of every sample
+        if hasattr(data, 'mask') and not ignore_mask:
+            self.galaxy_indices = np.flatnonzero(data.mask)
+        else:
+            self.galaxy_indices = np.arange(data._dataset(paths[0]).shape[0])
+
+    def __len__(self):
+        return len(self.galaxy_indices)
+
+    def _read(self, indices):
+        return self.data.get_images(
+            self.particle_type, self.fields, self.galaxy_indices[indices], dtype=self.dtype, dim=self.dim, dequantize=self.dequantize
+        )
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(f"Index {index} out of range for a dataset with {len(self)} galaxies.")
+        return self._read([index])[0]
+
+    def __getitems__(self, indices):
+        # The galaxies are read in the order of the file and returned in the requested order
+        indices = np.asarray(indices, dtype=np.int64)
+        order = np.argsort(indices, kind="stable")
+        images = self._read(indices[order])
+        samples = [None] * len(indices)
+        for position, image in zip(order, images):
+            samples[position] = image
+        return samples
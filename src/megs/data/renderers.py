@@ -0,0 +1,132 @@
+'''
+Renderer Registry for the Image Rendering
+
+This module contains a registry of named image renderers, which can be selected with the renderer argument of the Galaxy class
+(or in the GalaxyArgs of the config file). All renderers share the signature of the image2D and image3D functions
+
+    renderer(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs)
+
+and return images in the same units, i.e. the weights per unit area (2D) or volume (3D) of the image with the side length 1.
+Two dimensional weights of shape (N_particles, N_fields) render all fields in one pass and return an array of shape (N_fields, res, res[, res]).
+Keyword arguments that a renderer does not use (e.g. backend for the deposit renderers) are ignored.
+
+The following renderers are registered:
+
+- "sph": The exact SPH scatter of image2D and image3D (default).
+- "sph_parallel": The SPH scatter with the multithreaded backend, see image2D.
+- "cic": Cloud-in-cell deposit. Every particle is distributed over the nearest 2^dim pixels, the smoothing lengths are ignored.
+- "histogram": Nearest grid point deposit, equivalent to np.histogram2d. Every particle is added to the pixel it lies in.
+
+The deposit renderers are much cheaper than the SPH scatter, but the images are noisier where the smoothing lengths are larger than the pixels.
+They are meant for quick-look catalogs. Own renderers can be added with the register_renderer decorator:
+
+>>> @register_renderer("my_renderer", dim=2)
+... def my_renderer(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs):
+...     ...
+>>> galaxy = Galaxy("IllustrisTNG", halo_id=0, particle_type="stars", renderer="my_renderer")
+'''
+import numpy as np
+
+from .image import image2D, image3D
+from .kernels import deposit2D_multi, deposit3D_multi
+
+# Registered renderers, maps the name to the render function of each dimension
+RENDERERS = {}
+
+
+def register_renderer(name, dim):
+    '''Decorator to register a render function under the given name for images of dimension dim.
+
+    Parameters
+    ----------
+    name : str
+        The name of the renderer, used to select it in the Galaxy class.
+    dim : int
+        The dimension of the images rendered by the function. Can be either 2 or 3.
+
+    Returns
+    -------
+    function
+        The decorator, which returns the unchanged render function.
+    '''
+    if dim not in [2, 3]:
+        raise ValueError("dim must be 2 or 3.")
+
+    def decorator(render_function):
+        RENDERERS.setdefault(name, {})[dim] = render_function
+        return render_function
+
+    return decorator
+
+
+def get_renderer(name, dim):
+    '''Return the render function registered under the given name for images of dimension dim.
+
+    Raises
+    ------
+    ValueError
+        If no renderer is registered under the name for this dimension.
+    '''
+    if name not in RENDERERS or dim not in RENDERERS[name]:
+        available = sorted(key for key, functions in RENDERERS.items() if dim in functions)
+        raise ValueError(f"Renderer {name} not available for {dim}D images. Available renderers: {available}.")
+    return RENDERERS[name][dim]
+
+
+def _deposit(coordinates, R_half, weights, plot_factor, res, dim, cloud_in_cell):
+    '''Deposit the weights on the pixel grid with the nearest grid point or the cloud-in-cell assignment.
+
+    The coordinates are mapped to the image like in image2D and image3D and the images have the same units.
+    '''
+    plot_range = plot_factor * R_half
+    # Transform Particles s.t. -factor*r_halfmassrad < x < factor*r_halfmassrad -> 0 < x < 1
+    positions = [coordinates[:, axis] / (2 * plot_range) + 1 / 2 for axis in range(dim)]
+    weights = np.asarray(weights)
+    channels = weights.reshape(len(weights), -1)
+    if dim == 2:
+        images = deposit2D_multi(*positions, channels, res, cloud_in_cell)
+    else:
+        images = deposit3D_multi(*positions, channels, res, cloud_in_cell)
+    return images if weights.ndim == 2 else images[0]
+
+
+@register_renderer("cic", dim=2)
+def cic2D(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs):
+    '''Cloud-in-cell deposit for 2D images. The smoothing lengths are ignored. See image2D for the parameters.'''
+    return _deposit(coordinates, R_half, weights, plot_factor, res, dim=2, cloud_in_cell=True)
+
+
+@register_renderer("cic", dim=3)
+def cic3D(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs):
+    '''Cloud-in-cell deposit for 3D images. The smoothing lengths are ignored. See image3D for the parameters.'''
+    return _deposit(coordinates, R_half, weights, plot_factor, res, dim=3, cloud_in_cell=True)
+
+
+@register_renderer("histogram", dim=2)
+def histogram2D(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs):
+    '''Nearest grid point deposit for 2D images. The smoothing lengths are ignored. See image2D for the parameters.'''
+    return _deposit(coordinates, R_half, weights, plot_factor, res, dim=2, cloud_in_cell=False)
+
+
+@register_renderer("histogram", dim=3)
+def histogram3D(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs):
+    '''Nearest grid point deposit for 3D images. The smoothing lengths are ignored. See image3D for the parameters.'''
+    return _deposit(coordinates, R_half, weights, plot_factor, res, dim=3, cloud_in_cell=False)
+
+
+register_renderer("sph", dim=2)(image2D)
+register_renderer("sph", dim=3)(image3D)
+
+
+@register_renderer("sph_parallel", dim=2)
+def sph_parallel2D(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs):
+    '''SPH scatter for 2D images with the multithreaded backend. See image2D for the parameters.'''
+    kwargs["backend"] = "parallel"
+    return image2D(coordinates, R_half, weights, smoothing_length, plot_factor=plot_factor, res=res, **kwargs)
+
+
+@register_renderer("sph_parallel", dim=3)
+def sph_parallel3D(coordinates, R_half, weights, smoothing_length, plot_factor=10, res=64, **kwargs):
+    '''SPH scatter for 3D images with the multithreaded backend. See image3D for the parameters.'''
+    kwargs["backend"] = "parallel"
+    return image3D(coordinates, R_half, weights, smoothing_length, plot_factor=plot_factor, res=res, **kwargs)
@@ -28,6 +28,9 @@ class YourSimulation():
 
         return field
 
+Optionally the class can define a classmethod load_catalog(halo_ids, **kwargs), which loads the catalog data of all galaxies at once.
+generate_data() calls it with the GalaxyArgs and passes each galaxy its part of the result with the catalog argument, see IllustrisTNG.
+
 Note that the class name should be the same as the simulation name, since this is used to create the galaxy object.
 """
 
@@ -37,6 +40,10 @@ from astropy.cosmology import Planck15 as cosmo
 import requests
 import os
 import h5py
+from functools import lru_cache
+
+from .cache import ParticleCache
+from .timing import timed
 
 class illustrisAPI:
     DATAPATH = "./tempdata"
@@ -287,50 +294,515 @@ def select_illustris_galaxies(basepath, snapshot, M_min, M_max, particle_type="s
     return halo_ids
 
 
-def scale_to_physical_units(x, field):
-    """get rid of the Illustris units."""
+# Nodes of the scale factor -> lookback time table of stellar_age()
+_AGE_TABLE_NODES = 16384
+_AGE_TABLE_MIN_SCALE = 1e-3
+# Number of particles interpolated at once, limits the float64 temporaries of np.interp
+_AGE_CHUNK = 2**20
+
+
+@lru_cache(maxsize=1)
+def _age_table():
+    """Scale factors and lookback times in yr for the interpolation in stellar_age().
+
+    The lookback time t(a) = 1/H0 * int_a^1 da' / (a' E(a')) is integrated with the trapezoidal rule on a grid uniform in ln(a).
+    This only needs the vectorized E(z) of astropy instead of one quadrature per particle like cosmo.age. The table is built once per process.
+    """
+    scale = np.geomspace(_AGE_TABLE_MIN_SCALE, 1, _AGE_TABLE_NODES)
+    integrand = 1 / cosmo.efunc(1 / scale - 1)
+    segments = 0.5 * (integrand[1:] + integrand[:-1]) * np.diff(np.log(scale))
+    lookback = np.zeros_like(scale)
+    lookback[:-1] = np.cumsum(segments[::-1])[::-1]
+    return scale, lookback * cosmo.hubble_time.to_value("yr")
+
+
+def stellar_age(scale_factor, out=None):
+    """Age of star particles in yr from their formation scale factor (GFM_StellarFormationTime).
+
+    The ages are interpolated linearly in a table of the lookback time (see _age_table), which is orders of magnitude faster than cosmo.age
+    for large arrays. For scale factors between 1e-3 and 1 the interpolated ages deviate by less than 200 yr from cosmo.lookback_time in float64.
+    Stored in a float32 out array, like the in-place conversion of get_field, the ages are rounded to multiples of 1024 yr above 8.6 Gyr and
+    deviate by less than 650 yr from cosmo.lookback_time. cosmo.age(0) - cosmo.age(z) differs from the lookback time by the error of the
+    astropy quadrature: the float32 ages are within 2.2 kyr of it for scale factors above 0.01, but within 0.22 Myr close to 1e-3.
+    Other positive scale factors are converted with cosmo.age, the age of non-positive values (wind particles) is NaN.
+
+    Parameters
+    ----------
+    scale_factor: numpy array
+        Formation scale factors of the star particles.
+    out: numpy array, optional
+        Float array of the same shape to store the ages in, e.g. scale_factor itself to convert a float32 buffer in place.
+        If None, a new array is returned. Default: None
+
+    Returns
+    -------
+    numpy array
+        Ages of the star particles in yr.
+    """
+    scale, lookback = _age_table()
+    scale_factor = np.asarray(scale_factor)
+    if out is None:
+        out = np.empty(scale_factor.shape, dtype=np.result_type(scale_factor.dtype, np.float32))
+    outside = (scale_factor < scale[0]) | (scale_factor > scale[-1])
+    undefined = scale_factor <= 0
+    outside &= ~undefined
+    exact = None
+    if np.any(outside):
+        # Calculated before the interpolation, which can overwrite scale_factor
+        exact = (_age - cosmo.age(1 / scale_factor[outside] - 1).value) * 1e9
+    values = np.atleast_1d(scale_factor)
+    ages = np.atleast_1d(out)
+    for start in range(0, len(values), _AGE_CHUNK):
+        ages[start : start + _AGE_CHUNK] = np.interp(values[start : start + _AGE_CHUNK], scale, lookback)
+    if exact is not None:
+        out[outside] = exact
+    out[undefined] = np.nan
+    return out
+
+
+def scale_to_physical_units(x, field, out=None):
+    """get rid of the Illustris units.
+
+    If out is given, the converted values are written into it and out is returned. out can be x itself to convert a float32 buffer in place,
+    so no temporary arrays are created.
+    """
 
     # If the field string contains the word "Mass"
     if "Mass" in field:
-        return x * 1e10 / _h
+        return np.multiply(x, 1e10 / _h, out=out)
     if field == "Masses":
-        return x * 1e10 / _h
+        return np.multiply(x, 1e10 / _h, out=out)
 
     elif field == "Coordinates":
-        return x / _h
+        return np.divide(x, _h, out=out)
 
     elif field == "SubfindHsml":
-        return x / _h
+        return np.divide(x, _h, out=out)
 
     elif field == "SubfindDensity":
-        return x * 1e10 * _h * _h
+        return np.multiply(x, 1e10 * _h * _h, out=out)
 
     elif field == "GFM_StellarFormationTime":
         # Calculates Age of Stars
-        return (_age - cosmo.age(1 / x - 1).value) * 1e9  # Gyr
+        return stellar_age(x, out=out)  # yr
     elif field == "GFM_Metallicity":
-        return x / 0.0127  # Solar Metallicity
+        return np.divide(x, 0.0127, out=out)  # Solar Metallicity
     else:
         print("No unit conversion for Field {}. Return without changes.".format(field))
-        return x
+        if out is None:
+            return x
+        out[...] = x
+        return out
+
+
+@lru_cache(maxsize=None)
+def snapshot_fields(base_path, snapshot, particle_type):
+    """Names of the particle fields stored in the snapshot for a particle type.
+
+    Like il.snapshot.loadSubset, the fields are read from the first chunk file that contains the particle type.
+
+    Parameters
+    ----------
+    base_path : str
+        Path to the output directory of the simulation.
+    snapshot : int
+        Snapshot number.
+    particle_type : str
+        Particle type, e.g. "stars".
+
+    Returns
+    -------
+    frozenset
+        The field names, empty if no chunk file contains the particle type.
+    """
+    group = f"PartType{il.util.partTypeNum(particle_type)}"
+    with h5py.File(il.snapshot.snapPath(base_path, snapshot), "r") as f:
+        n_files = f["Header"].attrs["NumFilesPerSnapshot"]
+    for file_number in range(n_files):
+        with h5py.File(il.snapshot.snapPath(base_path, snapshot, file_number), "r") as f:
+            if group in f:
+                return frozenset(f[group].keys())
+    return frozenset()
+
+
+def iter_subhalo_particles(base_path, snapshot, halo_ids, particle_type, fields, catalog=None):
+    """Load the particles of many subhalos with a single sweep over the snapshot chunk files.
+
+    Loading the subhalos one by one with il.snapshot.loadSubhalo jumps between the chunk files of the snapshot. This generator sorts the subhalos
+    by their offset in the snapshot and reads the chunk files in order, every file is opened once and read front to back. The particles of a subhalo
+    are yielded as soon as they are read, so the subhalos can be rendered while the next ones are loaded.
+
+    Parameters
+    ----------
+    base_path : str
+        Path to the output directory of the simulation.
+    snapshot : int
+        Snapshot number.
+    halo_ids : list
+        Subhalo IDs to load.
+    particle_type : str
+        Particle type to load, e.g. "stars".
+    fields : list
+        Particle fields to load.
+    catalog : IllustrisCatalog, optional
+        Catalog with the lengths and offsets of the subhalos. If None, it is loaded for the halo IDs. The default is None.
+
+    Yields
+    ------
+    tuple
+        (halo_id, particles) in the order of the snapshot, where particles is a dict with the fields and the "count" of the particles,
+        like the dict returned by il.snapshot.loadSubhalo. The wind particles are not removed.
+    """
+    particle_type_number = il.util.partTypeNum(particle_type)
+    halo_ids = np.asarray(halo_ids, dtype=np.int64)
+    if catalog is None:
+        catalog = IllustrisCatalog(base_path, snapshot, halo_ids)
+    rows = [catalog._rows[int(halo_id)] for halo_id in halo_ids]
+    starts = catalog.columns["SnapByType"][rows, particle_type_number].astype(np.int64)
+    lengths = catalog.columns["SubhaloLenType"][rows, particle_type_number].astype(np.int64)
+
+    # Number of particles in each chunk file of the snapshot
+    with h5py.File(il.snapshot.snapPath(base_path, snapshot), "r") as f:
+        n_files = f["Header"].attrs["NumFilesPerSnapshot"]
+    file_counts = []
+    for file_number in range(n_files):
+        with h5py.File(il.snapshot.snapPath(base_path, snapshot, file_number), "r") as f:
+            file_counts.append(f["Header"].attrs["NumPart_ThisFile"][particle_type_number])
+    file_offsets = np.concatenate([[0], np.cumsum(file_counts)])
+
+    # Subhalos without particles of this type
+    for index in np.where(lengths == 0)[0]:
+        yield halo_ids[index], {"count": 0}
+
+    group = f"PartType{particle_type_number}"
+    order = np.array([index for index in np.argsort(starts, kind="stable") if lengths[index] > 0], dtype=np.int64)
+    next_halo = 0
+    active = []  # Subhalos whose particles are read, as (index, {field: list of arrays})
+    for file_number in range(n_files):
+        file_start, file_stop = file_offsets[file_number], file_offsets[file_number + 1]
+        while next_halo < len(order) and starts[order[next_halo]] < file_stop:
+            active.append((order[next_halo], {field: [] for field in fields}))
+            next_halo += 1
+        if not active:
+            continue
+        with h5py.File(il.snapshot.snapPath(base_path, snapshot, file_number), "r") as f:
+            finished = []
+            for index, parts in active:
+                start = max(starts[index], file_start) - file_start
+                stop = min(starts[index] + lengths[index], file_stop) - file_start
+                if stop > start:
+                    for field in fields:
+                        parts[field].append(f[group][field][start:stop])
+                if starts[index] + lengths[index] <= file_stop:
+                    finished.append(index)
+                    particles = {field: np.concatenate(arrays) for field, arrays in parts.items()}
+                    particles["count"] = lengths[index]
+                    yield halo_ids[index], particles
+            active = [(index, parts) for index, parts in active if index not in finished]
+
+
+class IllustrisCatalog:
+    """Rows of the IllustrisTNG subhalo catalog for many subhalos, loaded in one pass.
+
+    Creating an IllustrisTNG object for every galaxy with il.groupcat.loadSingle opens the group catalog chunk files once per galaxy.
+    This class loads the needed columns of the catalog for all subhalos with il.groupcat.loadSubhalos and keeps the rows of the requested halo IDs.
+    Passed to the IllustrisTNG class with the catalog argument, creating a galaxy does not read the group catalog anymore.
+
+    Parameters
+    ----------
+    base_path : str
+        Path to the output directory of the simulation.
+    snapshot : int
+        Snapshot number.
+    halo_ids : list
+        Subhalo IDs to keep the rows of.
+    fields : list, optional
+        Columns of the subhalo catalog to load. The default is FIELDS, the columns used by the IllustrisTNG class.
+    offsets : bool, optional
+        If True, the offsets of the subhalos in the snapshot ("SnapByType" of the offsets file) are loaded as well. The default is True.
+
+    Examples
+    --------
+    >>> catalog = IllustrisCatalog(base_path, 99, halo_ids)
+    >>> galaxies = [Galaxy("IllustrisTNG", halo_id=i, particle_type="stars", base_path=base_path, snapshot=99, catalog=catalog) for i in halo_ids]
+    """
+
+    FIELDS = ["SubhaloPos", "SubhaloMassType", "SubhaloHalfmassRadType", "SubhaloLenType"]
+
+    def __init__(self, base_path, snapshot, halo_ids, fields=None, offsets=True):
+        self.base_path = base_path
+        self.snapshot = snapshot
+        self.halo_ids = np.asarray(halo_ids, dtype=np.int64)
+        fields = list(self.FIELDS if fields is None else fields)
+
+        subhalos = il.groupcat.loadSubhalos(self.base_path, self.snapshot, fields=fields)
+        if not isinstance(subhalos, dict):
+            # illustris_python returns the array itself if only one field is loaded
+            subhalos = {fields[0]: subhalos}
+        self.columns = {field: subhalos[field][self.halo_ids] for field in fields}
+        if offsets:
+            # h5py needs increasing indices, so read the unique sorted rows and map them back
+            unique_ids, inverse = np.unique(self.halo_ids, return_inverse=True)
+            with h5py.File(il.groupcat.offsetPath(self.base_path, self.snapshot), "r") as f:
+                self.columns["SnapByType"] = f["Subhalo/SnapByType"][unique_ids][inverse]
+        self._rows = {int(halo_id): i for i, halo_id in enumerate(self.halo_ids)}
+
+    def __contains__(self, halo_id):
+        return int(halo_id) in self._rows
+
+    def __len__(self):
+        return len(self.halo_ids)
+
+    def get(self, halo_id):
+        """Get the catalog row of a subhalo.
+
+        Returns
+        -------
+        dict
+            Dictionary with the loaded columns as keys, like the dictionary returned by il.groupcat.loadSingle.
+        """
+        row = self._rows[int(halo_id)]
+        return {field: values[row] for field, values in self.columns.items()}
+
+    def select(self, halo_ids):
+        """Get a catalog with only the rows of the given subhalos, e.g. to send it to a worker process."""
+        rows = [self._rows[int(halo_id)] for halo_id in halo_ids]
+        catalog = IllustrisCatalog.__new__(IllustrisCatalog)
+        catalog.base_path = self.base_path
+        catalog.snapshot = self.snapshot
+        catalog.halo_ids = self.halo_ids[rows]
+        catalog.columns = {field: values[rows] for field, values in self.columns.items()}
+        catalog._rows = {int(halo_id): i for i, halo_id in enumerate(catalog.halo_ids)}
+        return catalog
 
 
 class IllustrisTNG:
-    """Class for the IllustrisTNG simulation."""
+    """Class for the IllustrisTNG simulation.
+
+    Parameters
+    ----------
+    halo_id : int
+        Subhalo ID of the galaxy.
+    particle_type : str
+        Particle type of the galaxy, e.g. "stars".
+    base_path : str
+        Path to the output directory of the simulation.
+    snapshot : int
+        Snapshot number.
+    fields : list, optional
+        Particle fields to load together with the fields needed for the rotation and rendering (Coordinates, Masses, the smoothing length and for stars
+        GFM_StellarFormationTime to remove the wind particles). All other fields are loaded from the snapshot when they are first requested with get_field.
+        The default is None, i.e. only the needed fields are loaded.
+    catalog : IllustrisCatalog, optional
+        Preloaded rows of the subhalo catalog. If it contains the halo, its row is used instead of loading it with il.groupcat.loadSingle. The default is None.
+    particles : dict, optional
+        Particle arrays of the halo loaded beforehand in the units of the snapshot, e.g. by iter_subhalo_particles. They are used instead of reading
+        the snapshot if they contain all fields to load. The default is None.
+    cache_dir : str, optional
+        Directory of a local ParticleCache, see the cache.py module. The subhalo catalog row and the masked particle arrays of the halo are saved there
+        and loaded from there instead of the snapshot the next time. The default is None, i.e. no cache.
+    cache_size : float, optional
+        Maximum size of the cache in GB. The least recently used halos are removed if it is exceeded. The default is None, i.e. no limit.
+    """
 
-    def __init__(self, halo_id, particle_type, base_path, snapshot):
+    def __init__(self, halo_id, particle_type, base_path, snapshot, fields=None, catalog=None, particles=None, cache_dir=None, cache_size=None):
         self.base_path = base_path
         self.halo_id = halo_id
         self.particle_type = particle_type
         self.snapshot = snapshot
+        self.fields = [] if fields is None else list(fields)
+        self.catalog = catalog
+        self._preloaded_particles = particles
+        self.cache = None if cache_dir is None else ParticleCache(cache_dir, max_size=cache_size)
 
         self._load_data()
 
-    def _load_data(self):
-        """Load the data from the snapshot and subhalo catalog."""
-        self.subhalo = il.groupcat.loadSingle(
+    @classmethod
+    def load_catalog(cls, halo_ids, base_path, snapshot, **kwargs):
+        """Load the subhalo catalog rows of all halo IDs in one pass. Used by generate_data() to pass the catalog to the galaxies.
+
+        Parameters
+        ----------
+        halo_ids : list
+            Subhalo IDs of the galaxies.
+        base_path, snapshot :
+            See the parameters of the class.
+        **kwargs : dict
+            Other arguments of the class, which are ignored.
+
+        Returns
+        -------
+        IllustrisCatalog
+            The catalog rows of the subhalos.
+        """
+        return IllustrisCatalog(base_path, snapshot, halo_ids)
+
+    @classmethod
+    def particle_counts(cls, halo_ids, base_path, snapshot, particle_type, catalog=None, **kwargs):
+        """Number of particles of the galaxies from SubhaloLenType of the subhalo catalog. Used by generate_data() to predict the cost of the galaxies.
+
+        For stars the wind particles are included, which are removed when the galaxy is loaded.
+
+        Parameters
+        ----------
+        halo_ids : list
+            Subhalo IDs of the galaxies.
+        base_path, snapshot, particle_type :
+            See the parameters of the class.
+        catalog : IllustrisCatalog, optional
+            Catalog with the rows of all halo IDs. If None, it is loaded. The default is None.
+        **kwargs : dict
+            Other arguments of the class, which are ignored.
+
+        Returns
+        -------
+        numpy.array
+            The number of particles of every halo ID.
+        """
+        if catalog is None:
+            catalog = cls.load_catalog(halo_ids, base_path, snapshot)
+        part_type = il.util.partTypeNum(particle_type)
+        return np.array([catalog.get(halo_id)["SubhaloLenType"][part_type] for halo_id in halo_ids], dtype=np.int64)
+
+    @staticmethod
+    def _halo_cache_key(snapshot, particle_type, halo_id):
+        return f"IllustrisTNG_{snapshot}_{particle_type}_{halo_id}"
+
+    def _cache_key(self):
+        return self._halo_cache_key(self.snapshot, self.particle_type, self.halo_id)
+
+    def _load_subhalo(self):
+        """Load the row of the subhalo catalog, from the preloaded catalog or the cache if possible."""
+        if self.catalog is not None and self.halo_id in self.catalog:
+            # The preloaded row only has the columns of the catalog, see _complete_subhalo
+            self._subhalo_complete = False
+            return self.catalog.get(self.halo_id)
+        self._subhalo_complete = True
+        return self._load_full_subhalo()
+
+    def _load_full_subhalo(self):
+        """Load all columns of the subhalo catalog row with il.groupcat.loadSingle, or from the cache."""
+        if self.cache is not None:
+            # The catalog row is small, so it is read into memory
+            subhalo = self.cache.get(self._cache_key(), "catalog", mmap_mode=None, count=False)
+            if subhalo is not None:
+                return subhalo
+        subhalo = il.groupcat.loadSingle(
             self.base_path, self.snapshot, subhaloID=self.halo_id
         )
+        if self.cache is not None:
+            self.cache.put(self._cache_key(), "catalog", subhalo)
+        return subhalo
+
+    def _complete_subhalo(self):
+        """Add all columns of the subhalo catalog to a row taken from the preloaded catalog, which only has the catalog columns."""
+        if not self._subhalo_complete:
+            with timed("catalog"):
+                self.subhalo = {**self._load_full_subhalo(), **self.subhalo}
+            self._subhalo_complete = True
+        return self.subhalo
+
+    def _hsml_field(self):
+        # Is this correct? Is this the smoothing length used for visualization?
+        return "StellarHsml" if self.particle_type == "stars" else "SubfindHsml"
+
+    @staticmethod
+    def _particle_fields(particle_type, fields=None):
+        """Particle fields loaded with a galaxy: the fields needed for the rotation and rendering and the requested fields."""
+        load_fields = ["Coordinates", "Masses", "StellarHsml" if particle_type == "stars" else "SubfindHsml"]
+        if particle_type == "stars":
+            # Needed to remove the wind particles
+            load_fields.append("GFM_StellarFormationTime")
+        return load_fields + [field for field in (fields or []) if field not in load_fields]
+
+    @classmethod
+    def iter_particles(cls, halo_ids, base_path, snapshot, particle_type, fields=None, catalog=None, cache_dir=None, **kwargs):
+        """Load the particles of many galaxies in the order of the snapshot. Used by generate_data() with bulk_read.
+
+        See iter_subhalo_particles. The loaded fields are the ones the class loads for every galaxy. Galaxies whose particles are in the
+        particle cache of cache_dir are yielded first without particles, so they are loaded from the cache, and are not read from the snapshot.
+        The particles read from the snapshot are saved in the cache by the galaxies.
+
+        Yields
+        ------
+        tuple
+            (halo_id, halo_kwargs) with the keyword arguments of the class for this galaxy, i.e. its particles.
+        """
+        load_fields = cls._particle_fields(particle_type, fields)
+        if cache_dir is not None:
+            cache = ParticleCache(cache_dir)
+            cached = [
+                cache.contains(cls._halo_cache_key(snapshot, particle_type, halo_id), "particles", load_fields) for halo_id in halo_ids
+            ]
+            for halo_id in np.asarray(halo_ids)[cached]:
+                yield halo_id, dict()
+            halo_ids = np.asarray(halo_ids)[np.logical_not(cached)]
+        if len(halo_ids) == 0:
+            return
+        for halo_id, particles in iter_subhalo_particles(
+            base_path, snapshot, halo_ids, particle_type, load_fields, catalog=catalog
+        ):
+            yield halo_id, {"particles": particles}
+
+    def _load_particles(self, fields, count=True):
+        """Load particle fields of the subhalo, from the cache if possible.
+
+        For stars only the real stars are kept, not the wind particles. The arrays are in the units of the snapshot.
+
+        Parameters
+        ----------
+        fields : list
+            Names of the particle fields to load.
+        count : bool, optional
+            If True, the cache lookup is counted as a hit or miss of a halo load. The fields loaded later by get_field are not counted.
+            The default is True.
+
+        Returns
+        -------
+        dict
+            Dictionary with the field names and the particle arrays.
+
+        Raises
+        ------
+        KeyError
+            If a field has to be read from the snapshot and is not stored there.
+        """
+        if self.cache is not None:
+            particles = self.cache.get(self._cache_key(), "particles", fields, count=count)
+            if particles is not None:
+                return particles
+        load_fields = list(fields)
+        if self.particle_type == "stars" and "GFM_StellarFormationTime" not in load_fields:
+            # Needed to remove the wind particles
+            load_fields.append("GFM_StellarFormationTime")
+        if self._preloaded_particles is not None and all(
+            field in self._preloaded_particles for field in load_fields
+        ):
+            particles = {field: self._preloaded_particles[field] for field in load_fields}
+        else:
+            # illustris_python raises a plain Exception for missing fields, check them first to tell them apart from other errors
+            missing = [field for field in load_fields if field not in snapshot_fields(self.base_path, self.snapshot, self.particle_type)]
+            if missing:
+                raise KeyError(f"Particle type {self.particle_type} has no fields {missing} in the snapshot.")
+            particles = il.snapshot.loadSubhalo(
+                self.base_path, self.snapshot, self.halo_id, self.particle_type, fields=load_fields
+            )
+            if not isinstance(particles, dict):
+                # illustris_python returns the array itself if only one field is loaded
+                particles = {load_fields[0]: particles}
+            particles.pop("count", None)
+        if self.particle_type == "stars":
+            # Get only real stars, not wind particles
+            real_star_mask = np.where(particles["GFM_StellarFormationTime"] > 0)[0]
+            particles = {field: particles[field][real_star_mask] for field in fields}
+        if self.cache is not None:
+            self.cache.put(self._cache_key(), "particles", particles)
+        return particles
+
+    def _load_data(self):
+        """Load the data from the snapshot and subhalo catalog."""
+        with timed("catalog"):
+            self.subhalo = self._load_subhalo()
         self.center = self.subhalo["SubhaloPos"]
         self.mass = scale_to_physical_units(
             self.subhalo["SubhaloMassType"][il.util.partTypeNum(self.particle_type)],
@@ -342,31 +814,32 @@ class IllustrisTNG:
         self.halfmassrad_DM = self.subhalo["SubhaloHalfmassRadType"][
             il.util.partTypeNum("DM")
         ]
-        self.particles = il.snapshot.loadSubhalo(
-            self.base_path, self.snapshot, self.halo_id, self.particle_type
-        )
+        # Only load the fields needed for the rotation and rendering and the requested fields, all other fields are loaded in get_field
+        with timed("particles"):
+            self.particles = self._load_particles(self._particle_fields(self.particle_type, self.fields))
+        # Fields that are requested later are loaded from the snapshot
+        self._preloaded_particles = None
+        # The wind particles are already removed from the particle arrays
+        self.real_star_mask = slice(None)
 
-        if self.particle_type == "stars":
-            # Get only real stars, not wind particles
-            self.real_star_mask = np.where(
-                self.particles["GFM_StellarFormationTime"] > 0
-            )[0]
-            self.hsml = self.particles["StellarHsml"][self.real_star_mask]
-        else:
-            self.real_star_mask = np.ones(
-                len(self.particles["Coordinates"]), dtype=bool
-            )
-            # Is this correct? Is this the smoothing length used for visualization?
-            self.hsml = self.particles["SubfindHsml"]
+        self.hsml = self.particles[self._hsml_field()]
 
         self.particle_coordinates = self.particles["Coordinates"][self.real_star_mask]
-        self.particle_masses = scale_to_physical_units(
-            self.particles["Masses"][self.real_star_mask], "Masses"
-        )
+        self.particle_masses = self._physical_field("Masses")
+
+    def _physical_field(self, field):
+        """Particle field converted to physical units. Float fields are converted into a new buffer of their own dtype, the particle arrays stay unchanged."""
+        with timed("units"):
+            values = self.particles[field][self.real_star_mask]
+            if values.dtype.kind != "f":
+                return scale_to_physical_units(values, field)
+            return scale_to_physical_units(values, field, out=np.empty(values.shape, dtype=values.dtype))
 
     def get_field(self, field, particle_type=None):
         """Load a field from the particle data. Used for the image generation.
         The field is returned as a numpy array and converted to physical units.
+        Particle fields that were not loaded with the galaxy are loaded from the snapshot (or the cache) on the first request.
+        Subhalo catalog fields ("Subhalo*") that are not in the preloaded catalog row are taken from the full row of the subhalo catalog.
 
         Parameters
         ----------
@@ -389,13 +862,22 @@ class IllustrisTNG:
         """
 
         if field in self.particles.keys():
-            return_field = scale_to_physical_units(
-                self.particles[field][self.real_star_mask], field
-            )
+            return_field = self._physical_field(field)
         elif field in self.subhalo.keys():
             return_field = scale_to_physical_units(self.subhalo[field], field)
+        elif field.startswith("Subhalo"):
+            # Columns of the subhalo catalog that are not in the preloaded catalog row are taken from the full row
+            if field not in self._complete_subhalo().keys():
+                raise ValueError("Field {} not in subhalo catalog.".format(field))
+            return_field = scale_to_physical_units(self.subhalo[field], field)
         else:
-            raise ValueError("Field {} not in snapshot.".format(field))
+            # All other fields are particle fields, they are loaded without reading the subhalo catalog
+            try:
+                with timed("particles"):
+                    self.particles.update(self._load_particles([field], count=False))
+            except KeyError as err:
+                raise ValueError("Field {} not in snapshot.".format(field)) from err
+            return_field = self._physical_field(field)
 
         # If "Type" is in the field name, check which particle type is requested
         if "Type" in field:
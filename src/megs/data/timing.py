@@ -0,0 +1,169 @@
+"""Timing of the stages of the galaxy generation.
+
+The stages of loading, rotating and rendering a galaxy are wrapped in the timed context manager, which adds the elapsed time to a
+counter of this process, like the counters of the particle cache (see cache.py). Nested stages are excluded from the stage they
+are called from, e.g. the particles loaded on demand while rendering count as "particles" and not as "render_dim2", so the stage
+times of a galaxy add up to its total time. _render_galaxy of the generate.py module saves the stage times of every galaxy.
+The "write" stage is not timed with timed: the writer thread of generate.py (_SlabWriter) measures the time of every slab it writes
+to the HDF5 file and splits it evenly across the galaxies of the slab. It runs in parallel to the rendering and is not part of the
+total time of a galaxy.
+
+Profiling can be switched on with the MEGS_PROFILE environment variable, a comma separated list of
+
+- "tracemalloc": Trace the memory allocations to measure the peak memory of every galaxy, see start_galaxy and stop_galaxy.
+  Without it only the maximum resident memory of each process so far is recorded, which does not resolve single galaxies.
+  This slows down the generation.
+- "cprofile": Profile every process with cProfile. The statistics are written to megs_profile_<pid>.prof in the directory
+  MEGS_PROFILE_DIR (default: the current directory) and can be read with pstats or snakeviz.
+
+Example
+-------
+$ MEGS_PROFILE=tracemalloc,cprofile MEGS_PROFILE_DIR=profiles python src/megs/data/generate.py --config config.json
+"""
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Stages timed during the generation of a galaxy
+STAGES = [
+    "catalog",
+    "particles",
+    "units",
+    "fields",
+    "face_on",
+    "horizontal",
+    "render_dim2",
+    "render_dim3",
+    "encode",
+    "write",
+]
+
+# Time in seconds spent in every stage by this process
+_stage_times = {stage: 0.0 for stage in STAGES}
+# Stages that are running in this thread, with their start time and the time spent in nested stages
+_local = threading.local()
+# cProfile profiler of this process, if switched on
+_profiler = None
+
+
+def profile_options():
+    """Get the profiling options of the MEGS_PROFILE environment variable.
+
+    Returns
+    -------
+    set
+        The switched on options, a subset of {"tracemalloc", "cprofile"}.
+    """
+    options = {option.strip().lower() for option in os.environ.get("MEGS_PROFILE", "").split(",") if option.strip()}
+    unknown = options - {"tracemalloc", "cprofile"}
+    if unknown:
+        raise ValueError(f"Unknown MEGS_PROFILE options {sorted(unknown)}. Available options: tracemalloc, cprofile.")
+    return options
+
+
+def profile_path(pid=None):
+    """Path of the cProfile statistics of the process pid (default: this process)."""
+    return os.path.join(os.environ.get("MEGS_PROFILE_DIR", "."), f"megs_profile_{os.getpid() if pid is None else pid}.prof")
+
+
+@contextmanager
+def timed(stage):
+    """Context manager adding the time of the enclosed code to the stage, without the time of nested stages.
+
+    Parameters
+    ----------
+    stage : str
+        One of STAGES.
+    """
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    entry = [time.perf_counter(), 0.0]
+    _local.stack.append(entry)
+    try:
+        yield
+    finally:
+        _local.stack.pop()
+        elapsed = time.perf_counter() - entry[0]
+        _stage_times[stage] += elapsed - entry[1]
+        if _local.stack:
+            _local.stack[-1][1] += elapsed
+
+
+def get_stage_times(reset=False):
+    """Get the time in seconds spent in every stage by this process.
+
+    Parameters
+    ----------
+    reset : bool, optional
+        If True, the times are set to zero after reading them. The default is False.
+
+    Returns
+    -------
+    dict
+        Dictionary with the STAGES as keys.
+    """
+    times = dict(_stage_times)
+    if reset:
+        for stage in _stage_times:
+            _stage_times[stage] = 0.0
+    return times
+
+
+def start_galaxy():
+    """Start the profiling of a galaxy according to profile_options()."""
+    global _profiler
+    options = profile_options()
+    if "tracemalloc" in options:
+        if hasattr(tracemalloc, "reset_peak"):
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        else:
+            # reset_peak was added in Python 3.9, restarting the tracing also resets the peak
+            tracemalloc.stop()
+            tracemalloc.start()
+    if "cprofile" in options:
+        if _profiler is None:
+            _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def stop_galaxy():
+    """Stop the profiling of a galaxy and get its memory usage.
+
+    The cProfile statistics of this process are written to profile_path() after every galaxy, so they are kept if a worker is terminated.
+
+    Returns
+    -------
+    dict
+        Dictionary with "process_max_rss", the largest resident set size of this process so far in bytes (not of this galaxy alone, -1 where
+        the resource module is not available), and "peak_traced", the peak of the memory allocated while rendering the galaxy in bytes, or -1
+        if tracemalloc is not switched on.
+    """
+    peak_traced = -1
+    if tracemalloc.is_tracing():
+        peak_traced = tracemalloc.get_traced_memory()[1]
+    if _profiler is not None:
+        _profiler.disable()
+        os.makedirs(os.path.dirname(profile_path()) or ".", exist_ok=True)
+        _profiler.dump_stats(profile_path())
+    return {"process_max_rss": _process_max_rss(), "peak_traced": peak_traced}
+
+
+def _process_max_rss():
+    """Largest resident set size of this process so far in bytes, or -1 if it can not be measured."""
+    if resource is None:
+        return -1
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux and the other Unix systems
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
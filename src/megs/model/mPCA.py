@@ -104,12 +104,14 @@ class mPCA():
         
     
     
-        for field in self._IMG_ORDER:
-            # Get the image of the specified particle type and field
-            image = self.data.get_image(self.particle_type, field, dim = dim)
+        # Read the images of all fields at once into an array of shape (n_galaxies, n_fields, ...)
+        images = self.data.get_images(self.particle_type, self._IMG_ORDER, dim = dim)
+        n_pixels = int(np.prod(images.shape[2:]))
+        self.datamatrix = np.empty((images.shape[0], len(self._IMG_ORDER) * n_pixels))
+        for channel, field in enumerate(self._IMG_ORDER):
             norm_params = self._norm_function_kwargs[field] if field in self._norm_function_kwargs.keys() else {}
-            image = np.array([self._norm_function(img, **norm_params).flatten() for img in image])
-            self.datamatrix = np.concatenate((self.datamatrix, image), axis=1)
+            for i, img in enumerate(images[:, channel]):
+                self.datamatrix[i, channel * n_pixels:(channel + 1) * n_pixels] = self._norm_function(img, **norm_params).flatten()
          
         print("Created datamatrix with shape: ", self.datamatrix.shape)
         